@@ -0,0 +1,111 @@
+from data_objects import KeyData, UserData
+
+
+class AuthorizationMatrix:
+    """
+    Authorization compiled at load time.
+
+    Every key gets a bit index, every user a bitset (a python int) of the keys
+    they may take, so a check is a dict lookup and a bit test. The reverse
+    index answers "who may take this key" without scanning the users.
+    Instances are never mutated, `updated` returns a patched copy.
+    """
+
+    _key_bit: dict[str, int]
+    # Key id owning each bit index, None once the key was removed (bits are never reused)
+    _key_ids: list[str | None]
+    _user_bits: dict[str, int]
+    _user_ids_by_key: dict[str, tuple[str, ...]]
+
+    def __init__(self, keys: list[KeyData], users: list[UserData]):
+        self._key_bit = {}
+        self._key_ids = []
+        self._user_bits = {}
+        self._user_ids_by_key = {}
+        self._add_keys([k.id for k in keys])
+        self._set_users(users)
+
+    def _add_keys(self, key_ids: list[str]):
+        for k_id in key_ids:
+            if k_id in self._key_bit:
+                continue
+            self._key_bit[k_id] = 1 << len(self._key_ids)
+            self._key_ids.append(k_id)
+            self._user_ids_by_key[k_id] = ()
+
+    def _key_ids_of(self, bits: int) -> list[str]:
+        key_ids = []
+        i = 0
+        while bits:
+            if bits & 1 and (k_id := self._key_ids[i]) is not None:
+                key_ids.append(k_id)
+            bits >>= 1
+            i += 1
+        return key_ids
+
+    def _set_users(self, users: list[UserData]):
+        added_user_ids: dict[str, list[str]] = {}
+        for u in users:
+            bits = 0
+            for k_id in u.authorized_for:
+                bit = self._key_bit.get(k_id)
+                if bit is None:
+                    continue
+                bits |= bit
+                added_user_ids.setdefault(k_id, []).append(u.id)
+            self._user_bits[u.id] = bits
+        for k_id, user_ids in added_user_ids.items():
+            self._user_ids_by_key[k_id] += tuple(user_ids)
+
+    def _remove_users(self, user_ids: list[str]):
+        removed = set(user_ids)
+        touched_keys = set()
+        for u_id in user_ids:
+            touched_keys.update(self._key_ids_of(self._user_bits.pop(u_id, 0)))
+        for k_id in touched_keys:
+            self._user_ids_by_key[k_id] = tuple(
+                u_id for u_id in self._user_ids_by_key[k_id] if u_id not in removed
+            )
+
+    def updated(
+        self,
+        *,
+        key_ids_added: list[str],
+        key_ids_removed: list[str],
+        users_upserted: list[UserData],
+        user_ids_removed: list[str],
+    ) -> "AuthorizationMatrix":
+        """Returns a copy with the changes applied, touching only the changed rows."""
+        matrix = AuthorizationMatrix.__new__(AuthorizationMatrix)
+        matrix._key_bit = dict(self._key_bit)
+        matrix._key_ids = list(self._key_ids)
+        matrix._user_bits = dict(self._user_bits)
+        matrix._user_ids_by_key = dict(self._user_ids_by_key)
+        for k_id in key_ids_removed:
+            bit = matrix._key_bit.pop(k_id, None)
+            if bit is not None:
+                matrix._key_ids[bit.bit_length() - 1] = None
+                del matrix._user_ids_by_key[k_id]
+        matrix._add_keys(key_ids_added)
+        matrix._remove_users(user_ids_removed + [u.id for u in users_upserted])
+        matrix._set_users(users_upserted)
+        return matrix
+
+    def is_authorized(self, user_id: str, key_id: str) -> bool:
+        bit = self._key_bit.get(key_id)
+        return bit is not None and (self._user_bits.get(user_id, 0) & bit) != 0
+
+    def user_ids_authorized_for(self, key_id: str) -> tuple[str, ...]:
+        return self._user_ids_by_key.get(key_id, ())
+
+
+def expand_roles(
+    authorized_for: list[str], roles: list[str], role_grants: dict[str, list[str]]
+) -> list[str]:
+    """Returns the user's direct grants followed by their roles' grants, deduplicated."""
+    expanded = dict.fromkeys(authorized_for)
+    for role in roles:
+        if role not in role_grants:
+            raise ValueError(f"Unknown role {role!r}")
+        expanded.update(dict.fromkeys(role_grants[role]))
+    return list(expanded)
@@ -0,0 +1,99 @@
+"""
+Measures badge taps per second through UserStore, on a simulated user
+reader. A tap reads a user's card and starts a session, then reads the empty
+field once the card is taken away, and the session ends the way it does when
+the user's slot relocks.
+
+    python badge_tap_benchmark.py [--taps 2000] [--users 100]
+
+"reader" taps go through read_id, "process_card" ones hand UserStore the card
+ids directly, which leaves only the session bookkeeping. The field's settle
+time is skipped (ANTENNA_SETTLE_S = 0) and the chip answers at once, so
+neither figure includes the hardware's cost.
+"""
+
+import argparse
+import logging
+import os
+import tempfile
+import time
+
+from database_benchmark import generate_database
+from mfrc522.SimpleMFRC522 import uid_to_num
+from simulated_mfrc522 import SimulatedSpi, anticoll_answer, simulated_reader
+
+# main.py's READER_TIMEOUT_S, MAX_CONCURRENT_SESSIONS and KEY_SELECTION_INPUT_TIMEOUT_S
+READER_TIMEOUT_S = 0.1
+MAX_SESSIONS = 4
+SESSION_TIMEOUT_S = 60
+
+
+def card_uid(i: int) -> bytes:
+    # Every byte >= 0x10, so card ids (unpadded hex) are unique too
+    return bytes(0x10 + (i // 240**k) % 240 for k in range(4))
+
+
+def benchmark_taps(taps: int, users: int, read: bool) -> float:
+    """Taps per second, in a database of the given number of users in the cwd."""
+    from database import UsersDB
+    from session_manager import SessionManager
+    from user_store import UserStore
+
+    # After logger_instance's setup
+    logging.getLogger("mfrc522Logger").setLevel(logging.ERROR)
+    spi = SimulatedSpi()
+    reader = simulated_reader(spi)
+    reader.ANTENNA_SETTLE_S = 0
+    session_manager = SessionManager(
+        max_sessions=MAX_SESSIONS, session_timeout_s=SESSION_TIMEOUT_S
+    )
+    user_store = UserStore(
+        user_reader=reader,
+        user_reader_timeout_s=READER_TIMEOUT_S,
+        session_manager=session_manager,
+        users_db=UsersDB(),
+    )
+    uids = [card_uid(i) for i in range(users)]
+    card_ids = [uid_to_num(anticoll_answer(v)) for v in uids]
+    start = time.perf_counter()
+    for i in range(taps):
+        if read:
+            spi.uid = uids[i % users]
+            user_store.tick()
+        else:
+            user_store.process_card(card_ids[i % users])
+        session = session_manager.state.sessions[0]
+        if read:
+            spi.uid = None
+            user_store.tick()
+        else:
+            user_store.process_card(None)
+        # The user took a key and its slot relocked
+        session_manager.claim_slot(session, 0)
+        session_manager.release_slot(0)
+    return taps / (time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Measure badge taps per second through UserStore."
+    )
+    parser.add_argument("--taps", type=int, default=2000)
+    parser.add_argument("--users", type=int, default=100)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        generate_database(
+            directory,
+            args.users,
+            rf_id=lambda i: uid_to_num(anticoll_answer(card_uid(i))),
+        )
+        os.chdir(directory)
+        for name, read in (("reader", True), ("process_card", False)):
+            taps_per_s = benchmark_taps(args.taps, args.users, read)
+            print(f"{name:>12} {taps_per_s:9.0f} taps/s")
+    print(f"({args.taps} taps, {args.users} users)")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,24 +1,41 @@
 from dataclasses import dataclass
+import sys
 
+# Records are immutable and slotted (no per-instance __dict__), and their
+# identifiers are interned so the indexes, grant sets and slot states all
+# share one copy of each id string.
 
-@dataclass
+
+@dataclass(frozen=True, slots=True)
 class KeyData:
     id: str
     rf_id: str
     name: str
 
+    def __post_init__(self):
+        object.__setattr__(self, "id", sys.intern(self.id))
+        object.__setattr__(self, "rf_id", sys.intern(self.rf_id))
+
     def __format__(self, format_spec):
         return f"{self.name} ({self.id}, RFID={self.rf_id})"
 
 
-@dataclass
+@dataclass(frozen=True, slots=True)
 class UserData:
     id: str
     rf_id: str
     username: str
     password: str
     name: str
-    authorized_for: list[str]
+    authorized_for: tuple[str, ...]
+
+    def __post_init__(self):
+        object.__setattr__(self, "id", sys.intern(self.id))
+        object.__setattr__(self, "rf_id", sys.intern(self.rf_id))
+        object.__setattr__(self, "username", sys.intern(self.username))
+        object.__setattr__(
+            self, "authorized_for", tuple(sys.intern(v) for v in self.authorized_for)
+        )
 
     def __format__(self, format_spec):
         return f"{self.name} ({self.username}, ID={self.id}, RFID={self.rf_id})"
@@ -1,34 +1,147 @@
+from collections.abc import Callable, Iterator
+from contextlib import contextmanager
+from dataclasses import dataclass
 import functools
-from typing import Dict
+import logging
+import os
+import threading
+import time
+from typing import Dict, Protocol, TypeVar
 
 import pyjson5
 
+from authorization import AuthorizationMatrix, expand_roles
 from data_objects import *
+from database_snapshot import load_snapshot, write_snapshot
+from event import Event
+from logger_instance import logger
+from password_verifier import BCRYPT_CHECK_SECONDS, PasswordVerifier
 from singleton import Singleton
+from user_search import UserSearchIndex
 import bcrypt
 
+DATABASE_FILE = "./database.json"
+PASSWORDS_FILE = "./passwords.json"
+# Compiled copy of the two files above, rebuilt whenever they change
+SNAPSHOT_FILE = "./database.snapshot"
+
+TRecord = TypeVar("TRecord", KeyData, UserData)
+
+
+# Work factor for new hashes, bcrypt's default until set_bcrypt_cost is called
+_bcrypt_cost: int | None = None
+# Called after a successful check of a hash made with a lower work factor
+_rehash_password: Callable[[UserData, str], None] | None = None
+
+
+def set_bcrypt_cost(
+    cost: int | None, rehash_password: Callable[[UserData, str], None] | None = None
+):
+    global _bcrypt_cost, _rehash_password
+    _bcrypt_cost = cost
+    _rehash_password = rehash_password
+
+
+def bcrypt_cost_of(hashed_password: str) -> int | None:
+    # "$2b$12$<salt and hash>", None for anything that isn't a bcrypt hash
+    parts = hashed_password.split("$")
+    if len(parts) != 4 or not parts[2].isdigit():
+        return None
+    return int(parts[2])
+
 
 def get_hashed_password(plain_text_password: str) -> str:
     # Hash a password for the first time
     #   (Using bcrypt, the salt is saved into the hash itself)
-    return bcrypt.hashpw(plain_text_password.encode(), bcrypt.gensalt()).decode()
+    salt = bcrypt.gensalt() if _bcrypt_cost is None else bcrypt.gensalt(_bcrypt_cost)
+    return bcrypt.hashpw(plain_text_password.encode(), salt).decode()
 
 
 def check_password(plain_text_password: str, hashed_password: str) -> bool:
     # Check hashed password. Using bcrypt, the salt is saved into the hash itself
-    return bcrypt.checkpw(plain_text_password.encode(), hashed_password.encode())
+    with BCRYPT_CHECK_SECONDS.time():
+        return bcrypt.checkpw(plain_text_password.encode(), hashed_password.encode())
 
 
-@functools.cache
-def parse_database() -> tuple[list[KeyData], list[UserData]]:
-    with open("./passwords.json") as json_data:
+# Set by set_password_verifier, without one passwords are checked inline
+_password_verifier: PasswordVerifier | None = None
+
+
+def set_password_verifier(verifier: PasswordVerifier | None):
+    global _password_verifier
+    _password_verifier = verifier
+
+
+def verify_user_password(user: UserData, password: str) -> bool:
+    # May raise PasswordVerifierBusy when a verifier is configured
+    if _password_verifier is None:
+        ok = check_password(password, user.password)
+    else:
+        ok = _password_verifier.check(user.username, password, user.password)
+    stored_cost = bcrypt_cost_of(user.password)
+    # Only ever upwards, a device calibrated below the hashes' cost (e.g. a
+    # slower replacement) must not weaken them
+    if (
+        ok
+        and _rehash_password is not None
+        and _bcrypt_cost is not None
+        and stored_cost is not None
+        and stored_cost < _bcrypt_cost
+    ):
+        _rehash_password(user, password)
+    return ok
+
+
+def database_fingerprint() -> tuple[tuple[int, int], ...]:
+    # Cheap change detection, (mtime, size) of every source file
+    return tuple(
+        (st.st_mtime_ns, st.st_size)
+        for st in (os.stat(PASSWORDS_FILE), os.stat(DATABASE_FILE))
+    )
+
+
+def validate_database(keys: list[KeyData], users: list[UserData]):
+    """Raises a ValueError describing the first inconsistency found."""
+
+    def check_unique(kind: str, field: str, values: list[str]):
+        seen = set()
+        for v in values:
+            if v in seen:
+                raise ValueError(f"Duplicate {kind} {field}: {v!r}")
+            seen.add(v)
+
+    check_unique("key", "id", [k.id for k in keys])
+    check_unique("key", "rf_id", [k.rf_id for k in keys])
+    check_unique("user", "id", [u.id for u in users])
+    check_unique("user", "rf_id", [u.rf_id for u in users])
+    check_unique("user", "username", [u.username for u in users])
+    key_ids = {k.id for k in keys}
+    for u in users:
+        for k_id in u.authorized_for:
+            if k_id not in key_ids:
+                raise ValueError(
+                    f"User {u.id!r} is authorized for unknown key {k_id!r}"
+                )
+
+
+def load_database_files(
+    database_file: str | os.PathLike, passwords_file: str | os.PathLike
+) -> tuple[list[KeyData], list[UserData]]:
+    with open(passwords_file) as json_data:
         d = pyjson5.load(json_data)
         passwords: Dict[str, str] = {v["id"]: v["password"] for v in d["passwords"]}
-    with open("./database.json") as json_data:
+    with open(database_file) as json_data:
         d = pyjson5.load(json_data)
         keys = [
             KeyData(id=v["id"], rf_id=v["rf_id"], name=v["name"]) for v in d["keys"]
         ]
+        missing = [v["id"] for v in d["users"] if v["id"] not in passwords]
+        if missing:
+            raise ValueError(f"No password set for users: {missing!r}")
+        # Roles are expanded here, a user's authorized_for is always the full key list
+        role_grants: Dict[str, list[str]] = {
+            v["id"]: v["authorized_for"] for v in d.get("roles", [])
+        }
         users = [
             UserData(
                 id=v["id"],
@@ -36,55 +149,446 @@ def parse_database() -> tuple[list[KeyData], list[UserData]]:
                 name=v["name"],
                 username=v["username"],
                 password=passwords[v["id"]],
-                authorized_for=v["authorized_for"],
+                authorized_for=tuple(
+                    expand_roles(
+                        v.get("authorized_for", []), v.get("roles", []), role_grants
+                    )
+                ),
             )
             for v in d["users"]
         ]
-        return keys, users
+    validate_database(keys, users)
+    return keys, users
 
 
-class KeysDB(Singleton):
-    _keys_by_id: Dict[str, KeyData]
-    _keys_by_rf_id: Dict[str, KeyData]
+@functools.lru_cache(maxsize=1)
+def _parse_database(
+    fingerprint: tuple[tuple[int, int], ...],
+) -> tuple[list[KeyData], list[UserData]]:
+    source_files = [PASSWORDS_FILE, DATABASE_FILE]
+    snapshot = load_snapshot(SNAPSHOT_FILE, fingerprint, source_files)
+    if snapshot is not None:
+        return snapshot
+    keys, users = load_database_files(DATABASE_FILE, PASSWORDS_FILE)
+    write_snapshot(SNAPSHOT_FILE, fingerprint, source_files, keys, users)
+    return keys, users
+
+
+def parse_database() -> tuple[list[KeyData], list[UserData]]:
+    # Parsed once per version of the files, KeysDB and UsersDB share the result
+    return _parse_database(database_fingerprint())
+
+
+def _reuse_unchanged(
+    records: list[TRecord], previous: Dict[str, TRecord]
+) -> list[TRecord]:
+    # Keep the old objects for records that did not change, so holders of a
+    # record (e.g. a slot's current key) keep an identical object across reloads
+    return [
+        old if (old := previous.get(v.id)) is not None and old == v else v
+        for v in records
+    ]
+
+
+class KeysBackend(Protocol):
+    """The lookup API shared by every key storage engine."""
+
+    def by_id(self, k_id: str) -> KeyData | None: ...
+
+    def by_rf_id(self, rf_id: str) -> KeyData | None: ...
+
+
+class UsersBackend(Protocol):
+    """The lookup API shared by every user storage engine."""
+
+    def by_id(self, k_id: str) -> UserData | None: ...
+
+    def by_rf_id(self, rf_id: str) -> UserData | None: ...
+
+    def by_username(self, username: str) -> UserData | None: ...
+
+    def by_username_check_password(
+        self, username: str, password: str
+    ) -> UserData | None: ...
+
+    def is_authorized(self, user: UserData, key: KeyData) -> bool: ...
+
+    def users_authorized_for(self, key: KeyData) -> list[UserData]: ...
+
+    def search(self, query: str, limit: int, fuzzy: bool = False) -> list[UserData]: ...
+
+
+@dataclass(frozen=True)
+class _KeysIndex:
+    by_id: Dict[str, KeyData]
+    by_rf_id: Dict[str, KeyData]
+
+
+@dataclass(frozen=True)
+class _UsersIndex:
+    by_id: Dict[str, UserData]
+    by_rf_id: Dict[str, UserData]
+    by_username: Dict[str, UserData]
+    authorization: AuthorizationMatrix
+    search: UserSearchIndex
+
+
+@dataclass(frozen=True)
+class _DatabaseIndex:
+    keys: _KeysIndex
+    users: _UsersIndex
+
+
+def _build_keys_index(keys: list[KeyData], previous: _KeysIndex | None) -> _KeysIndex:
+    if previous is not None:
+        keys = _reuse_unchanged(keys, previous.by_id)
+    return _KeysIndex(
+        by_id={v.id: v for v in keys},
+        by_rf_id={v.rf_id: v for v in keys},
+    )
+
+
+def _build_users_index(
+    users: list[UserData], keys: list[KeyData], previous: _UsersIndex | None
+) -> _UsersIndex:
+    if previous is not None:
+        users = _reuse_unchanged(users, previous.by_id)
+        # Reused records are unchanged, only the rest touch the search index
+        changed = [v for v in users if previous.by_id.get(v.id) is not v]
+        user_ids = {v.id for v in users}
+        removed = [u_id for u_id in previous.by_id if u_id not in user_ids]
+        search = previous.search.updated(changed, removed)
+    else:
+        search = UserSearchIndex(users)
+    return _UsersIndex(
+        by_id={v.id: v for v in users},
+        by_rf_id={v.rf_id: v for v in users},
+        by_username={v.username: v for v in users},
+        authorization=AuthorizationMatrix(keys, users),
+        search=search,
+    )
+
+
+def _patch_keys_index(
+    index: _KeysIndex, upserts: list[KeyData], deleted_ids: list[str]
+) -> _KeysIndex:
+    by_id = dict(index.by_id)
+    by_rf_id = dict(index.by_rf_id)
+    # Updated records keep their position, so all() stays in file order
+    deleted = set(deleted_ids)
+    for k_id in [*deleted_ids, *(v.id for v in upserts)]:
+        old = by_id.pop(k_id, None) if k_id in deleted else by_id.get(k_id)
+        if old is not None and by_rf_id.get(old.rf_id) is old:
+            del by_rf_id[old.rf_id]
+    for v in upserts:
+        by_id[v.id] = v
+        by_rf_id[v.rf_id] = v
+    return _KeysIndex(by_id=by_id, by_rf_id=by_rf_id)
+
+
+def _patch_users_index(
+    index: _UsersIndex,
+    upserts: list[UserData],
+    deleted_ids: list[str],
+    *,
+    key_ids_added: list[str],
+    key_ids_removed: list[str],
+) -> _UsersIndex:
+    by_id = dict(index.by_id)
+    by_rf_id = dict(index.by_rf_id)
+    by_username = dict(index.by_username)
+    deleted = set(deleted_ids)
+    for u_id in [*deleted_ids, *(v.id for v in upserts)]:
+        old = by_id.pop(u_id, None) if u_id in deleted else by_id.get(u_id)
+        if old is None:
+            continue
+        if by_rf_id.get(old.rf_id) is old:
+            del by_rf_id[old.rf_id]
+        if by_username.get(old.username) is old:
+            del by_username[old.username]
+    for v in upserts:
+        by_id[v.id] = v
+        by_rf_id[v.rf_id] = v
+        by_username[v.username] = v
+    return _UsersIndex(
+        by_id=by_id,
+        by_rf_id=by_rf_id,
+        by_username=by_username,
+        authorization=index.authorization.updated(
+            key_ids_added=key_ids_added,
+            key_ids_removed=key_ids_removed,
+            users_upserted=upserts,
+            user_ids_removed=deleted_ids,
+        ),
+        search=index.search.updated(upserts, deleted_ids),
+    )
+
+
+@dataclass(frozen=True)
+class DatabaseChange:
+    """The records a reload or a batch of changes inserted, updated or deleted."""
+
+    key_upserts: list[KeyData]
+    key_ids_removed: list[str]
+    user_upserts: list[UserData]
+    user_ids_removed: list[str]
+
+
+def _changed_records(
+    current: Dict[str, TRecord], previous: Dict[str, TRecord]
+) -> tuple[list[TRecord], list[str]]:
+    # A reload reuses the unchanged records, any other object is new or updated
+    return (
+        [v for v in current.values() if previous.get(v.id) is not v],
+        [v_id for v_id in previous if v_id not in current],
+    )
+
+
+class DatabaseState(Singleton):
+    """
+    The keys and users indexes, published together.
+
+    A reload or a batch of changes builds both new indexes first and swaps
+    them in with a single assignment, so no reader ever pairs the keys of one
+    version with the users of another (e.g. a user granted a key that is not
+    there yet).
+    """
+
+    # Replaced wholesale, readers take it once per lookup
+    index: _DatabaseIndex
+    # Triggered under the writers' lock, so listeners see the changes in the
+    # order they were made (and hold up the next writer while they run)
+    changed: Event["DatabaseState", DatabaseChange]
+    # Serializes the writers (reloads and applied changes), never the readers
+    _lock: threading.Lock
 
     def __init__(self):
-        keys, _ = parse_database()
-        self._keys_by_id = {v.id: v for v in keys}
-        self._keys_by_rf_id = {v.rf_id: v for v in keys}
+        keys, users = parse_database()
+        self._lock = threading.Lock()
+        self.changed = Event(self)
+        self.index = _DatabaseIndex(
+            keys=_build_keys_index(keys, None),
+            users=_build_users_index(users, keys, None),
+        )
+
+    def records(self) -> tuple[list[KeyData], list[UserData]]:
+        """Every key and user, both of the same version."""
+        index = self.index
+        return list(index.keys.by_id.values()), list(index.users.by_id.values())
+
+    def reload(self, keys: list[KeyData], users: list[UserData]):
+        with self._lock:
+            previous = self.index
+            self.index = _DatabaseIndex(
+                keys=_build_keys_index(keys, previous.keys),
+                users=_build_users_index(users, keys, previous.users),
+            )
+            key_upserts, key_ids_removed = _changed_records(
+                self.index.keys.by_id, previous.keys.by_id
+            )
+            user_upserts, user_ids_removed = _changed_records(
+                self.index.users.by_id, previous.users.by_id
+            )
+            if key_upserts or key_ids_removed or user_upserts or user_ids_removed:
+                self.changed.trigger(
+                    DatabaseChange(
+                        key_upserts=key_upserts,
+                        key_ids_removed=key_ids_removed,
+                        user_upserts=user_upserts,
+                        user_ids_removed=user_ids_removed,
+                    )
+                )
+
+    def apply(
+        self,
+        *,
+        key_upserts: list[KeyData],
+        key_ids_removed: list[str],
+        user_upserts: list[UserData],
+        user_ids_removed: list[str],
+    ):
+        """Inserts/updates/deletes keys and users by id, swapping in patched copies."""
+        with self._lock:
+            index = self.index
+            # Keeps the authorization matrix in step with the keys
+            key_ids_added = [v.id for v in key_upserts if v.id not in index.keys.by_id]
+            self.index = _DatabaseIndex(
+                keys=_patch_keys_index(index.keys, key_upserts, key_ids_removed),
+                users=_patch_users_index(
+                    index.users,
+                    user_upserts,
+                    user_ids_removed,
+                    key_ids_added=key_ids_added,
+                    key_ids_removed=key_ids_removed,
+                ),
+            )
+            self.changed.trigger(
+                DatabaseChange(
+                    key_upserts=key_upserts,
+                    key_ids_removed=key_ids_removed,
+                    user_upserts=user_upserts,
+                    user_ids_removed=user_ids_removed,
+                )
+            )
+
+
+class KeysDB(Singleton):
+    state: DatabaseState
+
+    def __init__(self, state: DatabaseState | None = None):
+        self.state = state if state is not None else DatabaseState()
+
+    def all(self) -> list[KeyData]:
+        return list(self.state.index.keys.by_id.values())
 
     def by_id(self, k_id: str) -> KeyData | None:
-        return self._keys_by_id.get(k_id)
+        return self.state.index.keys.by_id.get(k_id)
 
     def by_rf_id(self, rf_id: str) -> KeyData | None:
-        return self._keys_by_rf_id.get(rf_id)
+        return self.state.index.keys.by_rf_id.get(rf_id)
 
 
 class UsersDB(Singleton):
-    _users_by_id: Dict[str, UserData]
-    _users_by_rf_id: Dict[str, UserData]
-    _users_by_username: Dict[str, UserData]
+    state: DatabaseState
 
-    def __init__(self):
-        _, users = parse_database()
-        self._users_by_id = {v.id: v for v in users}
-        self._users_by_rf_id = {v.rf_id: v for v in users}
-        self._users_by_username = {v.username: v for v in users}
+    def __init__(self, state: DatabaseState | None = None):
+        self.state = state if state is not None else DatabaseState()
+
+    def all(self) -> list[UserData]:
+        return list(self.state.index.users.by_id.values())
 
     def by_id(self, k_id: str) -> UserData | None:
-        return self._users_by_id.get(k_id)
+        return self.state.index.users.by_id.get(k_id)
 
     def by_rf_id(self, rf_id: str) -> UserData | None:
-        return self._users_by_rf_id.get(rf_id)
+        return self.state.index.users.by_rf_id.get(rf_id)
 
     def by_username(self, username: str) -> UserData | None:
-        return self._users_by_username.get(username)
+        return self.state.index.users.by_username.get(username)
 
     def by_username_check_password(
         self, username: str, password: str
     ) -> UserData | None:
-        user = self._users_by_username.get(username)
+        user = self.state.index.users.by_username.get(username)
         if user is None:
             return None
-        if check_password(password, user.password):
+        if verify_user_password(user, password):
             return user
         return None
+
+    def is_authorized(self, user: UserData, key: KeyData) -> bool:
+        return self.state.index.users.authorization.is_authorized(user.id, key.id)
+
+    def search(self, query: str, limit: int, fuzzy: bool = False) -> list[UserData]:
+        search = self.state.index.users.search
+        if fuzzy:
+            return search.fuzzy(query, limit)
+        return search.prefix(query, limit)
+
+    def users_authorized_for(self, key: KeyData) -> list[UserData]:
+        index = self.state.index.users
+        return [
+            index.by_id[u_id]
+            for u_id in index.authorization.user_ids_authorized_for(key.id)
+        ]
+
+
+def shared_state(keys_db: KeysDB, users_db: UsersDB) -> DatabaseState:
+    """The state both databases read, which their writers must swap as a whole."""
+    if keys_db.state is not users_db.state:
+        raise ValueError("keys_db and users_db must share one DatabaseState")
+    return keys_db.state
+
+
+class DatabaseWatcher:
+    """
+    Polls the database files for changes and hot-reloads KeysDB and UsersDB.
+
+    The files are parsed and validated on the watcher thread, and the new
+    indexes are swapped in together, in one DatabaseState swap. An invalid edit
+    leaves the previous database in place and raises `reload_failed`.
+    """
+
+    reloaded: Event["DatabaseWatcher", None]
+    reload_failed: Event["DatabaseWatcher", Exception]
+    poll_interval_s: float | int
+    keys_db: KeysDB
+    users_db: UsersDB
+    state: DatabaseState
+    _fingerprint: tuple[tuple[int, int], ...]
+    _failed_fingerprint: tuple[tuple[int, int], ...] | None = None
+    # Commits the DatabaseWriter has not written yet
+    _writes_pending: bool = False
+    _lock: threading.Lock
+    _thread: threading.Thread | None = None
+
+    def __init__(
+        self,
+        *,
+        poll_interval_s: float | int,
+        keys_db: KeysDB | None = None,
+        users_db: UsersDB | None = None,
+    ):
+        self.reloaded = Event(self)
+        self.reload_failed = Event(self)
+        self.poll_interval_s = poll_interval_s
+        self.keys_db = keys_db if keys_db is not None else KeysDB()
+        self.users_db = users_db if users_db is not None else UsersDB()
+        self.state = shared_state(self.keys_db, self.users_db)
+        self._fingerprint = database_fingerprint()
+        self._lock = threading.Lock()
+
+    def hold_reloads(self):
+        """
+        Stops reloading until the next own_write, so the files don't revert a
+        commit that is not written yet. Waits for a reload in progress.
+        """
+        with self._lock:
+            self._writes_pending = True
+
+    @contextmanager
+    def own_write(self) -> Iterator[None]:
+        """
+        Holds off polling while the files are rewritten from the in-memory
+        database, then adopts them as current so they are not reloaded.
+        """
+        with self._lock:
+            yield
+            self._fingerprint = database_fingerprint()
+            self._failed_fingerprint = None
+            self._writes_pending = False
+
+    def check_now(self) -> bool:
+        with self._lock:
+            return self._check()
+
+    def _check(self) -> bool:
+        if self._writes_pending:
+            return False
+        fingerprint = None
+        try:
+            fingerprint = database_fingerprint()
+            if fingerprint in (self._fingerprint, self._failed_fingerprint):
+                return False
+            keys, users = _parse_database(fingerprint)
+        except Exception as ex:
+            # Keep serving the old database, and retry once the files change again
+            self._failed_fingerprint = fingerprint
+            logger.log(logging.ERROR, "Database reload failed: {0}", ex)
+            self.reload_failed.trigger(ex)
+            return False
+        self._fingerprint = fingerprint
+        self.state.reload(keys, users)
+        self.reloaded.trigger()
+        return True
+
+    def _run(self):
+        while True:
+            time.sleep(self.poll_interval_s)
+            self.check_now()
+
+    def start(self):
+        self._thread = threading.Thread(
+            target=self._run, name="DatabaseWatcher", daemon=True
+        )
+        self._thread.start()
@@ -0,0 +1,201 @@
+"""
+Compares the json and sqlite storage engines: open time, resident memory and
+by_rf_id lookup latency at several user counts, and for the json engine the
+median time a DatabaseWriter commit of one changed user takes.
+
+The json engine opens twice: "json" parses database.json and passwords.json
+(and writes the compiled snapshot), "json-snap" then loads that snapshot.
+
+    python database_benchmark.py [--users 1000 10000 100000]
+
+Each engine and size runs in a process of its own, on a generated database in
+a temporary directory.
+"""
+
+import argparse
+from collections.abc import Callable
+from dataclasses import replace
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+
+ENGINES = ("json", "json-snap", "sqlite")
+# Random lookups of existing users, most of them miss the sqlite LRU at 10k+ users
+COLD_LOOKUPS = 20000
+# The same few cards over and over, like a key left in its slot
+HOT_LOOKUPS = 20000
+HOT_SET_SIZE = 16
+# Commits of one renamed user, the writer thread isn't started so none is written
+COMMITS = 20
+
+
+def _rf_id(i: int) -> str:
+    return f"{i:010x}"
+
+
+def generate_database(directory: str, users: int, rf_id: Callable[[int], str] = _rf_id):
+    import bcrypt
+
+    # One real (cheap) hash for everyone, generating 100k would take hours
+    password = bcrypt.hashpw(b"benchmark", bcrypt.gensalt(4)).decode()
+    keys = max(10, users // 10)
+    with open(os.path.join(directory, "database.json"), "w") as f:
+        json.dump(
+            {
+                "keys": [
+                    {"id": f"k{i}", "rf_id": f"key-{i}", "name": f"Key {i}"}
+                    for i in range(keys)
+                ],
+                "users": [
+                    {
+                        "id": f"u{i}",
+                        "rf_id": rf_id(i),
+                        "name": f"User {i}",
+                        "username": f"user{i}",
+                        "authorized_for": [f"k{i % keys}", f"k{(i * 7) % keys}"],
+                    }
+                    for i in range(users)
+                ],
+            },
+            f,
+        )
+    with open(os.path.join(directory, "passwords.json"), "w") as f:
+        json.dump(
+            {
+                "passwords": [
+                    {"id": f"u{i}", "password": password} for i in range(users)
+                ]
+            },
+            f,
+        )
+
+
+def _rss_bytes() -> int:
+    with open("/proc/self/statm") as f:
+        return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+
+
+def _percentile_us(samples: list[float], q: float) -> float:
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(q * len(samples)))] * 1e6
+
+
+def _measure(engine: str, users: int) -> dict:
+    """Runs in the benchmark's own process, with the database in the cwd."""
+    import database
+
+    if engine == "json" and os.path.exists(database.SNAPSHOT_FILE):
+        os.remove(database.SNAPSHOT_FILE)
+    # Written by the cold open, json-snap must not fall back to parsing
+    assert engine != "json-snap" or os.path.exists(database.SNAPSHOT_FILE)
+    rss_before = _rss_bytes()
+    start = time.perf_counter()
+    if engine == "sqlite":
+        from sqlite_database import SqliteUsersDB
+
+        users_db = SqliteUsersDB("key_guard.db")
+    else:
+        users_db = database.UsersDB()
+    open_s = time.perf_counter() - start
+    rss_mb = (_rss_bytes() - rss_before) / 2**20
+
+    rng = random.Random(0)
+    cold = [_rf_id(rng.randrange(users)) for _ in range(COLD_LOOKUPS)]
+    hot_set = [_rf_id(rng.randrange(users)) for _ in range(HOT_SET_SIZE)]
+    hot = [hot_set[i % HOT_SET_SIZE] for i in range(HOT_LOOKUPS)]
+    result = {"open_s": open_s, "rss_mb": rss_mb}
+    for name, rf_ids in (("cold", cold), ("hot", hot)):
+        samples = []
+        for rf_id in rf_ids:
+            t = time.perf_counter()
+            user = users_db.by_rf_id(rf_id)
+            samples.append(time.perf_counter() - t)
+            assert user is not None
+        result[f"{name}_p50_us"] = _percentile_us(samples, 0.5)
+        result[f"{name}_p99_us"] = _percentile_us(samples, 0.99)
+    if engine == "json":
+        from database_writer import DatabaseWriter
+
+        writer = DatabaseWriter(write_delay_s=0, users_db=users_db)
+        samples = []
+        for i in range(COMMITS):
+            user = users_db.by_id(f"u{rng.randrange(users)}")
+            t = time.perf_counter()
+            with writer.transaction() as transaction:
+                transaction.update_user(replace(user, name=f"Renamed {i}"))
+            samples.append(time.perf_counter() - t)
+        result["commit_ms"] = _percentile_us(samples, 0.5) / 1e3
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Compare lookup latency and memory of the storage engines."
+    )
+    parser.add_argument("--users", type=int, nargs="+", default=[1000, 10000, 100000])
+    # Internal, imports the generated database or measures one engine in this
+    # process, in the database's directory
+    parser.add_argument("--step", choices=("import", *ENGINES), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.step == "import":
+        from sqlite_database import import_json_database
+
+        import_json_database("database.json", "passwords.json", "key_guard.db")
+        return
+    if args.step is not None:
+        print(json.dumps(_measure(args.step, args.users[0])))
+        return
+
+    here = os.path.dirname(os.path.abspath(__file__))
+    env = {
+        **os.environ,
+        "PYTHONPATH": os.pathsep.join(
+            v for v in (here, os.environ.get("PYTHONPATH")) if v
+        ),
+    }
+    print(
+        f"{'users':>7} {'engine':>9} {'open':>8} {'RSS':>9}"
+        f" {'cold p50':>9} {'cold p99':>9} {'hot p50':>8} {'hot p99':>8}"
+        f" {'commit':>9}"
+    )
+    for users in args.users:
+        with tempfile.TemporaryDirectory() as directory:
+            generate_database(directory, users)
+
+            def run(step: str) -> str:
+                return subprocess.run(
+                    [
+                        sys.executable,
+                        os.path.abspath(__file__),
+                        "--step",
+                        step,
+                        "--users",
+                        str(users),
+                    ],
+                    check=True,
+                    capture_output=True,
+                    text=True,
+                    cwd=directory,
+                    env=env,
+                ).stdout
+
+            run("import")
+            for engine in ENGINES:
+                r = json.loads(run(engine).splitlines()[-1])
+                commit = (
+                    f"{r['commit_ms']:>7.2f}ms" if "commit_ms" in r else f"{'-':>9}"
+                )
+                print(
+                    f"{users:>7} {engine:>9} {r['open_s']:>7.2f}s {r['rss_mb']:>6.1f} MB"
+                    f" {r['cold_p50_us']:>7.1f}us {r['cold_p99_us']:>7.1f}us"
+                    f" {r['hot_p50_us']:>6.1f}us {r['hot_p99_us']:>6.1f}us"
+                    f" {commit}"
+                )
+
+
+if __name__ == "__main__":
+    main()
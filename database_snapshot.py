@@ -0,0 +1,124 @@
+import hashlib
+import logging
+import marshal
+import mmap
+import os
+import struct
+import sys
+
+from data_objects import KeyData, UserData
+from logger_instance import logger
+
+# Layout: MAGIC, then _HEADER (format version, python major, minor), then a
+# marshal payload of (fingerprint, digest, key tuples, user tuples).
+# marshal is only stable within a python version, hence the version in the header.
+SNAPSHOT_MAGIC = b"KGDBSNAP"
+SNAPSHOT_FORMAT_VERSION = 1
+_HEADER = struct.Struct("<HBB")
+_PAYLOAD_OFFSET = len(SNAPSHOT_MAGIC) + _HEADER.size
+
+
+def source_digest(source_files: list[str | os.PathLike]) -> str:
+    h = hashlib.sha256()
+    for path in source_files:
+        with open(path, "rb") as f:
+            h.update(f.read())
+        h.update(b"\0")
+    return h.hexdigest()
+
+
+def load_snapshot(
+    snapshot_file: str | os.PathLike,
+    fingerprint: tuple[tuple[int, int], ...],
+    source_files: list[str | os.PathLike],
+) -> tuple[list[KeyData], list[UserData]] | None:
+    """
+    Returns the snapshot's records if it was built from the current source
+    files, otherwise None. The (mtime, size) fingerprint is checked first, and
+    only if that differs (e.g. files touched or copied) are the contents hashed.
+    A snapshot found current by its hash is rewritten with the new fingerprint,
+    so the next start doesn't hash again.
+    """
+    try:
+        with open(snapshot_file, "rb") as f, mmap.mmap(
+            f.fileno(), 0, access=mmap.ACCESS_READ
+        ) as mm:
+            if mm[: len(SNAPSHOT_MAGIC)] != SNAPSHOT_MAGIC:
+                return None
+            version, py_major, py_minor = _HEADER.unpack_from(mm, len(SNAPSHOT_MAGIC))
+            if (version, py_major, py_minor) != (
+                SNAPSHOT_FORMAT_VERSION,
+                *sys.version_info[:2],
+            ):
+                return None
+            with memoryview(mm) as view:
+                (
+                    snapshot_fingerprint,
+                    digest,
+                    key_rows,
+                    user_rows,
+                ) = marshal.loads(view[_PAYLOAD_OFFSET:])
+    except (OSError, ValueError, EOFError, TypeError):
+        return None
+    if snapshot_fingerprint != fingerprint:
+        if digest != source_digest(source_files):
+            return None
+        _write_payload(snapshot_file, (fingerprint, digest, key_rows, user_rows))
+    keys = [KeyData(id=k_id, rf_id=rf_id, name=name) for k_id, rf_id, name in key_rows]
+    users = [
+        UserData(
+            id=u_id,
+            rf_id=rf_id,
+            username=username,
+            password=password,
+            name=name,
+            authorized_for=authorized_for,
+        )
+        for u_id, rf_id, username, password, name, authorized_for in user_rows
+    ]
+    return keys, users
+
+
+def write_snapshot(
+    snapshot_file: str | os.PathLike,
+    fingerprint: tuple[tuple[int, int], ...],
+    source_files: list[str | os.PathLike],
+    keys: list[KeyData],
+    users: list[UserData],
+):
+    _write_payload(
+        snapshot_file,
+        (
+            fingerprint,
+            source_digest(source_files),
+            tuple((k.id, k.rf_id, k.name) for k in keys),
+            tuple(
+                (
+                    u.id,
+                    u.rf_id,
+                    u.username,
+                    u.password,
+                    u.name,
+                    tuple(u.authorized_for),
+                )
+                for u in users
+            ),
+        ),
+    )
+
+
+def _write_payload(snapshot_file: str | os.PathLike, payload: tuple):
+    tmp_file = f"{snapshot_file}.tmp"
+    try:
+        # The password hashes are in it, owner only like passwords.json
+        fd = os.open(tmp_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, "wb") as f:
+            # O_CREAT's mode is not applied to a leftover temp file
+            os.fchmod(f.fileno(), 0o600)
+            f.write(SNAPSHOT_MAGIC)
+            f.write(_HEADER.pack(SNAPSHOT_FORMAT_VERSION, *sys.version_info[:2]))
+            f.write(marshal.dumps(payload))
+        os.replace(tmp_file, snapshot_file)
+    except OSError as ex:
+        # The snapshot is only a startup cache, carry on without it
+        logger.log(logging.WARNING, "Could not write database snapshot: {0}", ex)
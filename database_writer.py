@@ -0,0 +1,451 @@
+from collections.abc import Iterator
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager, nullcontext
+from dataclasses import replace
+import json
+import logging
+import os
+import stat
+import threading
+import time
+from typing import Any
+
+import pyjson5
+
+from data_objects import KeyData, UserData
+from database import (
+    DATABASE_FILE,
+    PASSWORDS_FILE,
+    SNAPSHOT_FILE,
+    DatabaseState,
+    DatabaseWatcher,
+    KeysDB,
+    UsersDB,
+    bcrypt_cost_of,
+    database_fingerprint,
+    get_hashed_password,
+    shared_state,
+)
+from database_snapshot import write_snapshot
+from event import Event
+from logger_instance import logger
+
+# After a failed write the writer thread tries again after this delay, doubled
+# after every further failure up to the maximum
+WRITE_RETRY_DELAY_S = 1
+MAX_WRITE_RETRY_DELAY_S = 60
+
+
+class DatabaseTransaction:
+    """
+    A batch of changes, applied all at once (or not at all) on commit.
+
+    Operations are resolved in order against the database as it was when the
+    transaction commits, so e.g. a user added earlier in the same transaction
+    can be granted a key.
+    """
+
+    _ops: list[tuple[str, Any, Any]]
+
+    def __init__(self):
+        self._ops = []
+
+    def add_key(self, key: KeyData):
+        self._ops.append(("add-key", key, None))
+
+    def update_key(self, key: KeyData):
+        self._ops.append(("update-key", key, None))
+
+    def remove_key(self, k_id: str):
+        self._ops.append(("remove-key", k_id, None))
+
+    def add_user(self, user: UserData):
+        self._ops.append(("add-user", user, None))
+
+    def update_user(self, user: UserData):
+        # The stored password hash is kept, use set_password to change it
+        self._ops.append(("update-user", user, None))
+
+    def remove_user(self, u_id: str):
+        self._ops.append(("remove-user", u_id, None))
+
+    def grant(self, u_id: str, k_id: str):
+        self._ops.append(("grant", u_id, k_id))
+
+    def revoke(self, u_id: str, k_id: str):
+        self._ops.append(("revoke", u_id, k_id))
+
+    def set_password(self, u_id: str, plain_text_password: str):
+        # Hashed right away, so bcrypt doesn't run while the commit holds the lock
+        self.set_password_hash(u_id, get_hashed_password(plain_text_password))
+
+    def set_password_hash(self, u_id: str, hashed_password: str):
+        self._ops.append(("set-password-hash", u_id, hashed_password))
+
+
+def _check_unique(
+    kind: str,
+    field: str,
+    upserts: list[KeyData] | list[UserData],
+    changed_ids: set[str],
+    lookup,
+):
+    seen: dict[str, str] = {}
+    for v in upserts:
+        value = getattr(v, field)
+        if value in seen:
+            raise ValueError(f"Duplicate {kind} {field}: {value!r}")
+        seen[value] = v.id
+        owner = lookup(value)
+        if owner is not None and owner.id != v.id and owner.id not in changed_ids:
+            raise ValueError(f"Duplicate {kind} {field}: {value!r}")
+
+
+def _atomic_write_json(file: str | os.PathLike, document: dict):
+    # The replacement keeps the file's permissions, a new file is private (it may
+    # hold password hashes)
+    try:
+        mode = stat.S_IMODE(os.stat(file).st_mode)
+    except FileNotFoundError:
+        mode = 0o600
+    tmp_file = f"{file}.tmp"
+    fd = os.open(tmp_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, mode)
+    # Not narrowed by the umask
+    os.fchmod(fd, mode)
+    with open(fd, "w") as f:
+        json.dump(document, f, indent="\t", ensure_ascii=False)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_file, file)
+
+
+def _database_document(
+    keys: list[KeyData], users: list[UserData], previous: dict
+) -> dict:
+    # Roles only exist in the files, keep a user's roles while they still hold
+    # every key the role grants and write the remaining grants out directly
+    key_ids = {k.id for k in keys}
+    role_grants = {
+        v["id"]: [k_id for k_id in v["authorized_for"] if k_id in key_ids]
+        for v in previous.get("roles", [])
+    }
+    previous_roles = {v["id"]: v.get("roles", []) for v in previous.get("users", [])}
+    users_doc = []
+    for u in users:
+        granted = set(u.authorized_for)
+        roles = [
+            r
+            for r in previous_roles.get(u.id, [])
+            if r in role_grants and granted.issuperset(role_grants[r])
+        ]
+        by_roles = {k_id for r in roles for k_id in role_grants[r]}
+        record: dict[str, Any] = {
+            "id": u.id,
+            "rf_id": u.rf_id,
+            "name": u.name,
+            "username": u.username,
+            "authorized_for": [
+                k_id for k_id in u.authorized_for if k_id not in by_roles
+            ],
+        }
+        if roles:
+            record["roles"] = roles
+        users_doc.append(record)
+    return {
+        "keys": [{"id": k.id, "rf_id": k.rf_id, "name": k.name} for k in keys],
+        "roles": [{"id": r, "authorized_for": g} for r, g in role_grants.items()],
+        "users": users_doc,
+    }
+
+
+class DatabaseWriter:
+    """
+    The write path of the json database backend.
+
+    Transactions are validated and applied to the in-memory indexes, then
+    persisted write-behind: the writer thread waits write_delay_s for more
+    commits to pile up and rewrites database.json and passwords.json once for
+    all of them. Applying copies the indexes' maps, so a commit costs O(users),
+    not O(changes) (database_benchmark.py measures it). A failed write is
+    retried with backoff. Each file is replaced atomically and the watcher
+    adopts the result, so it does not reload our own writes. Until then the
+    watcher does not reload at all, the files would revert the commits.
+    Comments in database.json are not preserved.
+    """
+
+    committed: Event["DatabaseWriter", None]
+    written: Event["DatabaseWriter", None]
+    write_failed: Event["DatabaseWriter", Exception]
+    write_delay_s: float | int
+    keys_db: KeysDB
+    users_db: UsersDB
+    state: DatabaseState
+    watcher: DatabaseWatcher | None
+    _lock: threading.RLock
+    _dirty: threading.Condition
+    _rehash_pool: ThreadPoolExecutor
+    _rehashing: set[str]
+    _is_dirty: bool = False
+    # Failed writes in a row, the writer thread backs off while there are any
+    _failed_writes: int = 0
+    _thread: threading.Thread | None = None
+
+    def __init__(
+        self,
+        *,
+        write_delay_s: float | int,
+        keys_db: KeysDB | None = None,
+        users_db: UsersDB | None = None,
+        watcher: DatabaseWatcher | None = None,
+    ):
+        self.committed = Event(self)
+        self.written = Event(self)
+        self.write_failed = Event(self)
+        self.write_delay_s = write_delay_s
+        self.keys_db = keys_db if keys_db is not None else KeysDB()
+        self.users_db = users_db if users_db is not None else UsersDB()
+        self.state = shared_state(self.keys_db, self.users_db)
+        self.watcher = watcher
+        self._lock = threading.RLock()
+        self._dirty = threading.Condition()
+        self._rehash_pool = ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix="PasswordRehash"
+        )
+        self._rehashing = set()
+
+    @contextmanager
+    def transaction(self) -> Iterator[DatabaseTransaction]:
+        """Commits the transaction when the block exits without an exception."""
+        transaction = DatabaseTransaction()
+        yield transaction
+        self.commit(transaction)
+
+    def commit(self, transaction: DatabaseTransaction):
+        """Raises a ValueError, changing nothing, if the transaction is invalid."""
+        with self._lock:
+            keys: dict[str, KeyData | None] = {}
+            users: dict[str, UserData | None] = {}
+
+            def get_key(k_id: str) -> KeyData | None:
+                return keys[k_id] if k_id in keys else self.keys_db.by_id(k_id)
+
+            def find_user(u_id: str) -> UserData | None:
+                return users[u_id] if u_id in users else self.users_db.by_id(u_id)
+
+            def get_user(u_id: str) -> UserData:
+                user = find_user(u_id)
+                if user is None:
+                    raise ValueError(f"Unknown user {u_id!r}")
+                return user
+
+            for op, target, arg in transaction._ops:
+                match op:
+                    case "add-key":
+                        if get_key(target.id) is not None:
+                            raise ValueError(f"Key {target.id!r} already exists")
+                        keys[target.id] = target
+                    case "update-key":
+                        if get_key(target.id) is None:
+                            raise ValueError(f"Unknown key {target.id!r}")
+                        keys[target.id] = target
+                    case "remove-key":
+                        if get_key(target) is None:
+                            raise ValueError(f"Unknown key {target!r}")
+                        keys[target] = None
+                    case "add-user":
+                        if find_user(target.id) is not None:
+                            raise ValueError(f"User {target.id!r} already exists")
+                        users[target.id] = target
+                    case "update-user":
+                        users[target.id] = replace(
+                            target, password=get_user(target.id).password
+                        )
+                    case "remove-user":
+                        get_user(target)
+                        users[target] = None
+                    case "grant" | "revoke":
+                        user = get_user(target)
+                        grants = [k_id for k_id in user.authorized_for if k_id != arg]
+                        if op == "grant":
+                            grants.append(arg)
+                        users[target] = replace(user, authorized_for=tuple(grants))
+                    case "set-password-hash":
+                        users[target] = replace(get_user(target), password=arg)
+
+            key_ids_removed = [k_id for k_id, v in keys.items() if v is None]
+            # Like the grants table's ON DELETE CASCADE, a removed key is revoked from everyone
+            for k_id in key_ids_removed:
+                key = self.keys_db.by_id(k_id)
+                if key is None:
+                    continue
+                for u in self.users_db.users_authorized_for(key):
+                    user = find_user(u.id)
+                    if user is None:
+                        continue
+                    users[u.id] = replace(
+                        user,
+                        authorized_for=tuple(
+                            v for v in user.authorized_for if v != k_id
+                        ),
+                    )
+            key_upserts = [v for v in keys.values() if v is not None]
+            user_upserts = [v for v in users.values() if v is not None]
+            user_ids_removed = [u_id for u_id, v in users.items() if v is None]
+            _check_unique("key", "rf_id", key_upserts, set(keys), self.keys_db.by_rf_id)
+            _check_unique(
+                "user", "rf_id", user_upserts, set(users), self.users_db.by_rf_id
+            )
+            _check_unique(
+                "user", "username", user_upserts, set(users), self.users_db.by_username
+            )
+            for u in user_upserts:
+                for k_id in u.authorized_for:
+                    if get_key(k_id) is None:
+                        raise ValueError(
+                            f"User {u.id!r} is authorized for unknown key {k_id!r}"
+                        )
+
+            if self.watcher is not None:
+                self.watcher.hold_reloads()
+            self.state.apply(
+                key_upserts=key_upserts,
+                key_ids_removed=key_ids_removed,
+                user_upserts=user_upserts,
+                user_ids_removed=user_ids_removed,
+            )
+        with self._dirty:
+            self._is_dirty = True
+            self._dirty.notify()
+        self.committed.trigger()
+
+    def rehash_password(self, user: UserData, plain_text_password: str):
+        """
+        Re-hashes a just verified password with the current work factor, in
+        the background so the login isn't held up by it.
+        """
+        with self._lock:
+            if user.id in self._rehashing:
+                return
+            self._rehashing.add(user.id)
+        self._rehash_pool.submit(self._rehash, user, plain_text_password)
+
+    def _rehash(self, user: UserData, plain_text_password: str):
+        try:
+            hashed_password = get_hashed_password(plain_text_password)
+            new_cost = bcrypt_cost_of(hashed_password) or 0
+            old_cost = bcrypt_cost_of(user.password) or 0
+            if new_cost < old_cost:
+                logger.log(
+                    logging.WARNING,
+                    "Not re-hashing the password of {0}, cost {1} is below its {2}",
+                    user.username,
+                    new_cost,
+                    old_cost,
+                )
+                return
+            with self._lock:
+                current = self.users_db.by_id(user.id)
+                # Removed, or given a new password, while we were hashing
+                if current is None or current.password != user.password:
+                    return
+                with self.transaction() as transaction:
+                    transaction.set_password_hash(user.id, hashed_password)
+            logger.log(
+                logging.INFO,
+                "Re-hashed the password of {0} from cost {1} to {2}",
+                user.username,
+                old_cost,
+                new_cost,
+            )
+        except Exception as ex:
+            logger.log(
+                logging.ERROR,
+                "Re-hashing the password of {0} failed: {1}",
+                user.username,
+                ex,
+            )
+        finally:
+            with self._lock:
+                self._rehashing.discard(user.id)
+
+    def flush(self) -> bool:
+        """
+        Writes pending changes to the files now, on the calling thread. False
+        if that failed, the changes stay pending.
+        """
+        with self._dirty:
+            if not self._is_dirty:
+                return True
+            self._is_dirty = False
+        try:
+            with (
+                self.watcher.own_write() if self.watcher is not None else nullcontext()
+            ):
+                # Read in here, commits from now on hold off reloads until the next write
+                keys, users = self.state.records()
+                with open(DATABASE_FILE) as json_data:
+                    previous = pyjson5.load(json_data)
+                with open(PASSWORDS_FILE) as json_data:
+                    previous_passwords = pyjson5.load(json_data)["passwords"]
+                database_document = _database_document(keys, users, previous)
+                passwords = [{"id": u.id, "password": u.password} for u in users]
+                user_ids = {u.id for u in users}
+                removed_ids = {
+                    v["id"] for v in previous["users"] if v["id"] not in user_ids
+                }
+                # A user never exists in database.json without a password: new
+                # passwords are written first, and removed users keep theirs until
+                # database.json no longer lists them
+                _atomic_write_json(
+                    PASSWORDS_FILE,
+                    {
+                        "passwords": passwords
+                        + [v for v in previous_passwords if v["id"] in removed_ids]
+                    },
+                )
+                _atomic_write_json(DATABASE_FILE, database_document)
+                if removed_ids:
+                    _atomic_write_json(PASSWORDS_FILE, {"passwords": passwords})
+            write_snapshot(
+                SNAPSHOT_FILE,
+                database_fingerprint(),
+                [PASSWORDS_FILE, DATABASE_FILE],
+                keys,
+                users,
+            )
+        except Exception as ex:
+            # Still in memory, pending again so the writer thread retries it
+            with self._dirty:
+                self._is_dirty = True
+                self._failed_writes += 1
+                self._dirty.notify()
+            logger.log(logging.ERROR, "Writing the database failed: {0}", ex)
+            self.write_failed.trigger(ex)
+            return False
+        with self._dirty:
+            self._failed_writes = 0
+        self.written.trigger()
+        return True
+
+    def _run(self):
+        while True:
+            with self._dirty:
+                self._dirty.wait_for(lambda: self._is_dirty)
+                failed_writes = self._failed_writes
+            if failed_writes:
+                time.sleep(
+                    min(
+                        MAX_WRITE_RETRY_DELAY_S,
+                        WRITE_RETRY_DELAY_S * 2 ** (failed_writes - 1),
+                    )
+                )
+            else:
+                # Let the commits that follow in quick succession share one write
+                time.sleep(self.write_delay_s)
+            self.flush()
+
+    def start(self):
+        self._thread = threading.Thread(
+            target=self._run, name="DatabaseWriter", daemon=True
+        )
+        self._thread.start()
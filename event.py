@@ -1,19 +1,197 @@
+import asyncio
+from collections import deque
 from collections.abc import Callable
+from dataclasses import dataclass
+import logging
+import threading
+import time
 from types import EllipsisType
-from typing import Generic, TypeVar, Union
+from typing import Any, Generic, Literal, TypeVar, Union
 
+from logger_instance import logger
 
 TOrigin = TypeVar("TOrigin")
 TParameter = TypeVar("TParameter")
 
+Overflow = Literal["drop-oldest"] | Literal["coalesce"] | Literal["block"]
+
+
+@dataclass(frozen=True)
+class DispatchStats:
+    queued: int
+    delivered: int
+    dropped: int
+    coalesced: int
+    mean_latency_s: float
+    max_latency_s: float
+
+
+class QueuedDispatcher:
+    """
+    Delivers event calls on a worker thread instead of the triggering one.
+
+    At most max_queue calls wait at a time. When the queue is full:
+      - "drop-oldest" drops the oldest waiting call,
+      - "coalesce" folds the call into the latest waiting call to the same
+        listener from the same origin (or drops the oldest call if there is
+        none),
+      - "block" makes the triggering thread wait for room.
+    Calls are delivered in the order they were queued.
+    """
+
+    name: str
+    max_queue: int
+    overflow: Overflow
+    # [listener, origin, parameter, queued at]
+    _queue: deque[list]
+    _cond: threading.Condition
+    _delivered: int = 0
+    _dropped: int = 0
+    _coalesced: int = 0
+    _total_latency_s: float = 0
+    _max_latency_s: float = 0
+    _thread: threading.Thread | None = None
+
+    def __init__(self, *, name: str, max_queue: int, overflow: Overflow):
+        self.name = name
+        self.max_queue = max_queue
+        self.overflow = overflow
+        self._queue = deque()
+        self._cond = threading.Condition()
+
+    def submit(self, func: Callable, origin: Any, parameter: Any):
+        with self._cond:
+            if len(self._queue) >= self.max_queue:
+                match self.overflow:
+                    case "block":
+                        self._cond.wait_for(lambda: len(self._queue) < self.max_queue)
+                    case "coalesce":
+                        for call in reversed(self._queue):
+                            if call[0] is func and call[1] is origin:
+                                call[2] = parameter
+                                self._coalesced += 1
+                                return
+                        self._queue.popleft()
+                        self._dropped += 1
+                    case _:
+                        self._queue.popleft()
+                        self._dropped += 1
+            self._queue.append([func, origin, parameter, time.monotonic()])
+            self._cond.notify_all()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                self._cond.wait_for(lambda: len(self._queue) != 0)
+                func, origin, parameter, queued_at = self._queue.popleft()
+                # Wake a producer blocked on a full queue
+                self._cond.notify_all()
+                latency_s = time.monotonic() - queued_at
+                self._delivered += 1
+                self._total_latency_s += latency_s
+                self._max_latency_s = max(self._max_latency_s, latency_s)
+            try:
+                if parameter is ...:
+                    func(origin)
+                else:
+                    func(origin, parameter)
+            except Exception as ex:
+                logger.log(
+                    logging.ERROR, "({0}) Event listener failed: {1!r}", self.name, ex
+                )
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name=self.name, daemon=True)
+        self._thread.start()
+
+    def stats(self) -> DispatchStats:
+        with self._cond:
+            return DispatchStats(
+                queued=len(self._queue),
+                delivered=self._delivered,
+                dropped=self._dropped,
+                coalesced=self._coalesced,
+                mean_latency_s=(
+                    self._total_latency_s / self._delivered if self._delivered else 0
+                ),
+                max_latency_s=self._max_latency_s,
+            )
+
+
+class LoopDispatcher:
+    """
+    Delivers event calls as callbacks of an asyncio event loop, from whichever
+    thread triggers them, so listeners only ever run on the loop's thread.
+    The loop's own queue is unbounded.
+    """
+
+    name: str
+    loop: asyncio.AbstractEventLoop
+    _submitted: int = 0
+    _submitted_lock: threading.Lock
+    _delivered: int = 0
+    _total_latency_s: float = 0
+    _max_latency_s: float = 0
+
+    def __init__(self, *, name: str, loop: asyncio.AbstractEventLoop):
+        self.name = name
+        self.loop = loop
+        self._submitted_lock = threading.Lock()
+
+    def submit(self, func: Callable, origin: Any, parameter: Any):
+        with self._submitted_lock:
+            self._submitted += 1
+        self.loop.call_soon_threadsafe(
+            self._deliver, func, origin, parameter, time.monotonic()
+        )
+
+    def _deliver(self, func: Callable, origin: Any, parameter: Any, queued_at: float):
+        # Only ever runs on the loop's thread, no locking needed
+        latency_s = time.monotonic() - queued_at
+        self._delivered += 1
+        self._total_latency_s += latency_s
+        self._max_latency_s = max(self._max_latency_s, latency_s)
+        try:
+            if parameter is ...:
+                func(origin)
+            else:
+                func(origin, parameter)
+        except Exception as ex:
+            logger.log(
+                logging.ERROR, "({0}) Event listener failed: {1!r}", self.name, ex
+            )
+
+    def start(self):
+        # Calls are delivered once the loop runs
+        pass
+
+    def stats(self) -> DispatchStats:
+        return DispatchStats(
+            queued=self._submitted - self._delivered,
+            delivered=self._delivered,
+            dropped=0,
+            coalesced=0,
+            mean_latency_s=(
+                self._total_latency_s / self._delivered if self._delivered else 0
+            ),
+            max_latency_s=self._max_latency_s,
+        )
+
+
+Dispatcher = QueuedDispatcher | LoopDispatcher
+
 
 class Event(Generic[TOrigin, TParameter]):
-    _listeners: list[Callable[[TOrigin, TParameter], None]]
+    # Listener -> the dispatcher delivering to it, None to call it on the triggering
+    # thread. A dict keeps registration order and makes add/remove O(1).
+    _listeners: dict[Callable[[TOrigin, TParameter], None], Dispatcher | None]
 
-    def __init__(self, origin: TOrigin):
+    def __init__(self, origin: TOrigin, dispatcher: Dispatcher | None = None):
         self._origin = origin
-        # Initialise a list of listeners
-        self._listeners = []
+        # Used for the listeners added without a dispatcher of their own
+        self._dispatcher = dispatcher
+        # Initialise a dict of listeners
+        self._listeners = {}
 
     # Define a getter for the 'on' property which returns the decorator.
     @property
@@ -27,22 +205,38 @@ class Event(Generic[TOrigin, TParameter]):
 
         return wrapper
 
-    # Add and remove functions from the list of listeners.
-    def add_listener(self, func: Callable[[TOrigin, TParameter], None]):
+    def on_queue(self, dispatcher: Dispatcher):
+        # Like 'on', but the listener is called from the dispatcher's worker thread.
+        def wrapper(
+            func: Callable[[TOrigin, TParameter], None],
+        ) -> Callable[[TOrigin, TParameter], None]:
+            self.add_listener(func, dispatcher)
+            return func
+
+        return wrapper
+
+    # Add and remove functions from the dict of listeners.
+    def add_listener(
+        self,
+        func: Callable[[TOrigin, TParameter], None],
+        dispatcher: Dispatcher | None = None,
+    ):
         if func in self._listeners:
             return
-        self._listeners.append(func)
+        self._listeners[func] = (
+            dispatcher if dispatcher is not None else self._dispatcher
+        )
 
     def remove_listener(self, func: Callable[[TOrigin, TParameter], None]):
-        if func not in self._listeners:
-            return
-        self._listeners.remove(func)
+        self._listeners.pop(func, None)
 
     # Trigger events.
     def trigger(self, parameter: Union[TParameter, EllipsisType] = ...):
-        if parameter is ...:
-            for func in self._listeners:
+        # Copied, so a listener may add or remove listeners while being called
+        for func, dispatcher in list(self._listeners.items()):
+            if dispatcher is not None:
+                dispatcher.submit(func, self._origin, parameter)
+            elif parameter is ...:
                 func(self._origin)
-        else:
-            for func in self._listeners:
+            else:
                 func(self._origin, parameter)
@@ -0,0 +1,181 @@
+from collections.abc import Callable
+from dataclasses import dataclass
+from functools import wraps
+from threading import Lock
+import time
+from typing import Any
+
+from event import Dispatcher, Event
+
+
+@dataclass(frozen=True)
+class CoalescingPolicy:
+    # Repeats of the same (source, card id) within this window are folded into one summary
+    dedup_window_s: float | int
+    # Token bucket over all firings of the event type
+    rate_per_s: float | int
+    burst: int
+
+
+@dataclass(frozen=True)
+class CoalescedSummary:
+    event_name: str
+    source: str
+    card_id: str
+    count: int
+    suppressed: int
+    window_s: float
+
+    def __format__(self, format_spec):
+        return (
+            f"({self.source}) {self.event_name}: {self.card_id} seen {self.count} "
+            f"times in {self.window_s:.1f} s ({self.suppressed} suppressed)"
+        )
+
+
+@dataclass
+class _Window:
+    opened_at: float
+    count: int
+    suppressed: int
+
+
+@dataclass
+class _TokenBucket:
+    tokens: float
+    updated_at: float
+
+
+class EventCoalescer:
+    """
+    Deduplicates and rate limits noisy events before they reach their listeners.
+
+    The first firing for a (source, card id) is delivered, repeats inside the
+    policy's window are only counted, and when the window closes a
+    CoalescedSummary is raised on `summarized` if anything was suppressed.
+    Independently, each event type is capped by a token bucket.
+    """
+
+    summarized: Event["EventCoalescer", CoalescedSummary]
+    _policies: dict[str, CoalescingPolicy]
+    _windows: dict[tuple[str, str, str], _Window]
+    _buckets: dict[str, _TokenBucket]
+    _next_deadline: float
+    _lock: Lock
+
+    def __init__(self, policies: dict[str, CoalescingPolicy]):
+        self.summarized = Event(self)
+        self._policies = policies
+        self._windows = {}
+        self._buckets = {
+            name: _TokenBucket(tokens=policy.burst, updated_at=time.monotonic())
+            for name, policy in policies.items()
+        }
+        self._next_deadline = float("inf")
+        self._lock = Lock()
+
+    def coalesce(
+        self,
+        event_name: str,
+        key: Callable[[Any, Any], tuple[str, str]],
+        dispatcher: Dispatcher | None = None,
+    ) -> Callable[[Callable[[Any, Any], None]], Callable[[Any, Any], None]]:
+        """
+        Decorates an event listener, `key` maps (origin, parameter) to the
+        (source, card id) pair repeats are deduplicated on.
+
+        With a dispatcher, register the decorated listener to be called on the
+        triggering thread: repeats are dropped there and only admitted calls
+        are queued on the dispatcher, so a flood never fills its queue.
+        """
+        policy = self._policies[event_name]
+
+        def decorator(func: Callable[[Any, Any], None]) -> Callable[[Any, Any], None]:
+            @wraps(func)
+            def wrapper(origin, parameter):
+                source, card_id = key(origin, parameter)
+                if not self._admit(event_name, policy, source, card_id):
+                    return
+                if dispatcher is not None:
+                    dispatcher.submit(func, origin, parameter)
+                else:
+                    func(origin, parameter)
+
+            return wrapper
+
+        return decorator
+
+    def _admit(
+        self, event_name: str, policy: CoalescingPolicy, source: str, card_id: str
+    ) -> bool:
+        now = time.monotonic()
+        window_key = (event_name, source, card_id)
+        with self._lock:
+            window = self._windows.get(window_key)
+            if window is not None and now < window.opened_at + policy.dedup_window_s:
+                window.count += 1
+                window.suppressed += 1
+                return False
+        if window is not None:
+            self._close_window(window_key, window, now)
+        admitted = self._take_token(event_name, policy, now)
+        with self._lock:
+            self._windows[window_key] = _Window(
+                opened_at=now, count=1, suppressed=0 if admitted else 1
+            )
+            self._next_deadline = min(self._next_deadline, now + policy.dedup_window_s)
+        return admitted
+
+    def _take_token(self, event_name: str, policy: CoalescingPolicy, now: float):
+        with self._lock:
+            bucket = self._buckets[event_name]
+            bucket.tokens = min(
+                policy.burst,
+                bucket.tokens + (now - bucket.updated_at) * policy.rate_per_s,
+            )
+            bucket.updated_at = now
+            if bucket.tokens < 1:
+                return False
+            bucket.tokens -= 1
+            return True
+
+    def _close_window(
+        self, window_key: tuple[str, str, str], window: _Window, now: float
+    ):
+        with self._lock:
+            if self._windows.get(window_key) is not window:
+                return
+            del self._windows[window_key]
+        if window.suppressed == 0:
+            return
+        event_name, source, card_id = window_key
+        self.summarized.trigger(
+            CoalescedSummary(
+                event_name=event_name,
+                source=source,
+                card_id=card_id,
+                count=window.count,
+                suppressed=window.suppressed,
+                window_s=now - window.opened_at,
+            )
+        )
+
+    def flush(self):
+        """Closes expired windows, call this periodically from the main loop."""
+        now = time.monotonic()
+        if now < self._next_deadline:
+            return
+        with self._lock:
+            expired = []
+            next_deadline = float("inf")
+            for window_key, window in self._windows.items():
+                deadline = (
+                    window.opened_at + self._policies[window_key[0]].dedup_window_s
+                )
+                if now >= deadline:
+                    expired.append((window_key, window))
+                else:
+                    next_deadline = min(next_deadline, deadline)
+            self._next_deadline = next_deadline
+        for window_key, window in expired:
+            self._close_window(window_key, window, now)
@@ -1,18 +1,40 @@
+import asyncio
+from collections.abc import Callable
+from dataclasses import dataclass
 import datetime
+import functools
 import logging
 from threading import RLock
 import threading
 import time
+from typing import Any
 
 import gpiozero
 from data_objects import KeyData
-from database import KeysDB
+from database import KeysBackend, KeysDB
 from event import Event
 from logger_instance import logger
+from metrics import metrics
 from mfrc522 import SimpleMFRC522
 
 KEY_STOLEN_LIMIT = datetime.timedelta(seconds=1)
 
+READ_ID_SECONDS = metrics.histogram(
+    "key_guard_read_id_seconds", "Duration of one reader poll.", label="reader"
+)
+
+
+@dataclass(frozen=True)
+class KeySlotState:
+    """An immutable, versioned view of a key slot, safe to read from any thread."""
+
+    version: int
+    slot_name: str
+    current_key: KeyData | None
+    is_locked: bool
+    is_key_being_stolen: bool
+    is_relock_pending: bool
+
 
 class KeyStore:
     relocked: Event["KeyStore", None]
@@ -28,8 +50,10 @@ class KeyStore:
     reader_timeout_s: float | int
     relock_timeout_s: float | int
     solenoid_lock_wait_time_s: float | int
-    keys_db: KeysDB
+    keys_db: KeysBackend
     slot_name: str
+    # Published snapshot of the slot, readers on other threads must only use this
+    state: KeySlotState
     _past_stolen_key_card_id: str | None = None
     _is_key_being_stolen: bool = False
     _key_stolen_decision_time: datetime.datetime | None = None
@@ -38,7 +62,11 @@ class KeyStore:
     _is_key_locked: bool
     _solenoid_controller: gpiozero.DigitalOutputDevice
     _relock_key_timeout_ms: int
-    _relock_key_timeout_timer: threading.Timer | None = None
+    _relock_key_timeout_timer: threading.Timer | asyncio.TimerHandle | None = None
+    # Schedules a callback on the event loop in asyncio mode (loop.call_later)
+    _call_later: Callable[[float, Callable[[], None]], Any] | None
+    # Bumped on every lock and unlock, so a deferred lock finish can tell it is stale
+    _lock_generation: int = 0
 
     _initialization_state: bool
 
@@ -53,7 +81,8 @@ class KeyStore:
         reader_timeout_s: float | int,
         key_relock_timeout_s: float | int,
         solenoid_lock_wait_time_s: float | int,
-        keys_db: KeysDB | None = None,
+        keys_db: KeysBackend | None = None,
+        call_later: Callable[[float, Callable[[], None]], Any] | None = None,
     ):
         self.relocked = Event(self)
         self.unauthorized_key_place_attempted = Event(self)
@@ -73,8 +102,63 @@ class KeyStore:
         self._initialization_state = not init_locked
         self._solenoid_controller = solenoid_controller
         self._relock_key_timeout_ms = relock_key_timeout_ms
+        self._call_later = call_later
+        self.state = KeySlotState(
+            version=0,
+            slot_name=slot_name,
+            current_key=None,
+            is_locked=init_locked,
+            is_key_being_stolen=False,
+            is_relock_pending=False,
+        )
+
+    def _publish_state(self):
+        # Swap in a new snapshot only when something changed, rebinding the
+        # attribute is atomic so readers see either the old or the new state.
+        with self._lock:
+            state = self.state
+            is_relock_pending = self._relock_key_timeout_timer is not None
+            if (
+                state.current_key is self.current_key
+                and state.is_locked == self._is_key_locked
+                and state.is_key_being_stolen == self._is_key_being_stolen
+                and state.is_relock_pending == is_relock_pending
+            ):
+                return
+            self.state = KeySlotState(
+                version=state.version + 1,
+                slot_name=self.slot_name,
+                current_key=self.current_key,
+                is_locked=self._is_key_locked,
+                is_key_being_stolen=self._is_key_being_stolen,
+                is_relock_pending=is_relock_pending,
+            )
+
+    @property
+    def is_active(self) -> bool:
+        # Unlocked slots, pending relocks and pending theft decisions need fast polling
+        return (
+            not self._is_key_locked
+            or self._is_key_being_stolen
+            or self._initialization_state
+            or self._relock_key_timeout_timer is not None
+        )
+
+    @property
+    def state_version(self) -> int:
+        return self.state.version
 
     def tick(self):
+        self.process_card(self.read_card())
+
+    def read_card(self) -> str | None:
+        """The blocking (SPI) half of a tick, safe to run in an executor."""
+        read_at = time.perf_counter()
+        card_id = self.reader.read_id(timeout=self.reader_timeout_s)
+        READ_ID_SECONDS.observe(time.perf_counter() - read_at, self.slot_name)
+        return card_id
+
+    def process_card(self, card_id: str | None):
         # (a) If the key was being stolen and we are past the _key_stolen_decision_time threshold
         if (
             self._is_key_being_stolen
@@ -88,7 +172,6 @@ class KeyStore:
             self.key_stolen.trigger((key, None))
             self.current_key = None
 
-        card_id = self.reader.read_id(timeout=self.reader_timeout_s)
         try:
             if self.past_key_card_id == card_id:
                 self.past_key_card_id = card_id
@@ -172,30 +255,55 @@ class KeyStore:
             self.past_key_card_id = card_id
             if self._initialization_state:
                 self.lock_key(quick_lock=True)
+            self._publish_state()
 
     def lock_key(self, quick_lock: bool = False):
         with self._lock:
             logger.log(logging.INFO, "({0}) Locking key", self.slot_name)
             self._is_key_locked = True
+            self._lock_generation += 1
             if self._relock_key_timeout_timer != None:
                 self._relock_key_timeout_timer.cancel()
                 self._relock_key_timeout_timer = None
             if self._initialization_state:
                 self._initialization_state = False
             elif not quick_lock:
+                if self._call_later is not None:
+                    # Don't block the event loop while the solenoid settles
+                    self._call_later(
+                        self.solenoid_lock_wait_time_s,
+                        functools.partial(self._finish_lock, self._lock_generation),
+                    )
+                    self._publish_state()
+                    return
                 time.sleep(self.solenoid_lock_wait_time_s)
+            self._finish_lock(self._lock_generation)
+
+    def _finish_lock(self, generation: int):
+        with self._lock:
+            if generation != self._lock_generation:
+                # Unlocked again while waiting
+                return
             self._solenoid_controller.off()
+            self._publish_state()
             self.solenoid_locked.trigger()
 
     def unlock_key(self):
         with self._lock:
             logger.log(logging.INFO, "({0}) Unlocking key", self.slot_name)
             self._is_key_locked = False
+            self._lock_generation += 1
             self._solenoid_controller.on()
-            self._relock_key_timeout_timer = threading.Timer(
-                self._relock_key_timeout_ms, self._on_relock_key_timeout
-            )
-            self._relock_key_timeout_timer.start()
+            if self._call_later is not None:
+                self._relock_key_timeout_timer = self._call_later(
+                    self._relock_key_timeout_ms, self._on_relock_key_timeout
+                )
+            else:
+                self._relock_key_timeout_timer = threading.Timer(
+                    self._relock_key_timeout_ms, self._on_relock_key_timeout
+                )
+                self._relock_key_timeout_timer.start()
+            self._publish_state()
 
     def _on_relock_key_timeout(self):
         self._relock_key_timeout_timer = None
@@ -1,5 +1,33 @@
+import atexit
+import json
 import logging
 import logging.handlers
+import os
+import queue
+import threading
+
+from metrics import metrics
+
+LOG_FILE = "./key_guard.log"
+# "text" or "json" (one JSON object per line)
+LOG_FORMAT = os.environ.get("KEY_GUARD_LOG_FORMAT", "text")
+# "size" rotates at LOG_MAX_BYTES, "time" at LOG_ROTATE_WHEN, keeping LOG_BACKUP_COUNT files
+LOG_ROTATION = os.environ.get("KEY_GUARD_LOG_ROTATION", "size")
+LOG_MAX_BYTES = 10 * 1024 * 1024
+LOG_ROTATE_WHEN = "midnight"
+LOG_BACKUP_COUNT = 5
+# Records waiting for the writer thread, past this new ones are dropped
+LOG_QUEUE_SIZE = 10000
+# How long flush_logs waits for the writer to make room in a full queue
+LOG_FLUSH_TIMEOUT_S = 5
+# Passed by callers in extra=, e.g. extra={"event": "key-stolen", "slot": ...},
+# and written as their own fields in the json format
+STRUCTURED_FIELDS = ("event", "slot", "key_id", "user_id")
+
+LOG_RECORDS_DROPPED = metrics.counter(
+    "key_guard_log_records_dropped_total",
+    "Log records dropped because the writer thread fell behind.",
+)
 
 
 class BraceString(str):
@@ -21,18 +49,106 @@ class StyleAdapter(logging.LoggerAdapter):
         return msg, kwargs
 
 
+class JsonLinesFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            "time": self.formatTime(record),
+            "level": record.levelname,
+            "thread": record.threadName,
+            "message": record.getMessage(),
+        }
+        for field in STRUCTURED_FIELDS:
+            value = getattr(record, field, None)
+            if value is not None:
+                entry[field] = value
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+class LazyQueueHandler(logging.handlers.QueueHandler):
+    """
+    Hands records to the writer thread unformatted, so the logging thread
+    neither formats nor does I/O. The BraceString message and its args are
+    only combined when the record is written.
+    """
+
+    dropped: int = 0
+
+    def prepare(self, record):
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            # Never block the caller on a stalled disk
+            self.dropped += 1
+            LOG_RECORDS_DROPPED.inc()
+
+
+class FlushingQueueListener(logging.handlers.QueueListener):
+    def enqueue_sentinel(self):
+        # Behind whatever is queued, waiting for room unless the disk is hung
+        self.queue.put(self._sentinel, timeout=LOG_FLUSH_TIMEOUT_S)
+
+
 logger = logging.getLogger("mfrc522Logger")
-logFormatter = logging.Formatter(
-    "{asctime} [{threadName:12.12s}] [{levelname:8.8s}] {message}", style="{"
-)
+if LOG_FORMAT == "json":
+    logFormatter = JsonLinesFormatter()
+else:
+    logFormatter = logging.Formatter(
+        "{asctime} [{threadName:12.12s}] [{levelname:8.8s}] {message}", style="{"
+    )
 
-fileHandler = logging.FileHandler("./key_guard.log")
+if LOG_ROTATION == "time":
+    fileHandler = logging.handlers.TimedRotatingFileHandler(
+        LOG_FILE, when=LOG_ROTATE_WHEN, backupCount=LOG_BACKUP_COUNT
+    )
+else:
+    fileHandler = logging.handlers.RotatingFileHandler(
+        LOG_FILE, maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUP_COUNT
+    )
 fileHandler.setFormatter(logFormatter)
-logger.addHandler(fileHandler)
 
 consoleHandler = logging.StreamHandler()
 consoleHandler.setFormatter(logFormatter)
-logger.addHandler(consoleHandler)
+
+queueHandler = LazyQueueHandler(queue.Queue(LOG_QUEUE_SIZE))
+logger.addHandler(queueHandler)
+queueListener = FlushingQueueListener(queueHandler.queue, fileHandler, consoleHandler)
+queueListener.start()
+_flush_lock = threading.Lock()
+_flushed = False
+
+
+def flush_logs():
+    """
+    Writes out every queued record, then has later records written on the
+    logging thread. Call before os._exit, which skips atexit handlers.
+    """
+    global _flushed
+    with _flush_lock:
+        if _flushed:
+            return
+        _flushed = True
+        try:
+            queueListener.stop()
+        except queue.Full:
+            # The writer is stuck, what it has not written is lost
+            pass
+        logger.logger.removeHandler(queueHandler)
+        logger.logger.addHandler(fileHandler)
+        logger.logger.addHandler(consoleHandler)
+    if queueHandler.dropped:
+        logger.log(
+            logging.WARNING,
+            "{0} log records were dropped while the writer fell behind",
+            queueHandler.dropped,
+        )
+
+
+atexit.register(flush_logs)
 level = logging.getLevelName(logging.INFO)
 logger.setLevel(level)
 
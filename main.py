@@ -1,5 +1,8 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
 import logging
 import os
+import ssl
 import sys
 import threading
 import time
@@ -13,32 +16,34 @@ import input_timeout
 
 # from gpiozero.tones import Tone
 
-if True:
-    from typeguard import install_import_hook
+# Before the application modules are imported, "full" mode installs import hooks on them
+import type_checking
 
-    install_import_hook("event")
-    install_import_hook("user_store")
-    install_import_hook("key_store")
-    install_import_hook("data_objects")
-    install_import_hook("database")
-    install_import_hook("mfrc522")
-    install_import_hook("mfrc522.chip_select_lock")
-    install_import_hook("ws")
-    install_import_hook("ws.server")
-    install_import_hook("ws.key_selection_option")
+type_checking.configure_from_env()
 
-from typeguard import typechecked
+from type_checking import typechecked
 
 from user_store import UserStore
-from ws.server import WebsocketServer
-from key_store import KeyStore
+from utils import PhaseTimings
+from ws.server import WebsocketServer, load_server_ssl_context
+from key_store import KEY_STOLEN_LIMIT, KeyStore, KeySlotState
+from poll_scheduler import PollScheduler
+from sampling_profiler import SamplingProfiler
+from stall_watchdog import StallWatchdog
+from event import LoopDispatcher, QueuedDispatcher
+from metrics import metrics
+from event_coalescer import CoalescedSummary, CoalescingPolicy, EventCoalescer
+from session_manager import Session, SessionManager
 from data_objects import UserData, KeyData
 import database
+from database_writer import DatabaseWriter
+from password_verifier import PasswordVerifier, load_bcrypt_cost
+import replication
 from mfrc522 import SimpleMFRC522
 from mfrc522.chip_select_lock import ChipSelectLinesLock
 from ws.key_selection_option import KeySelectionOption
 
-from logger_instance import logger
+from logger_instance import flush_logs, logger
 
 
 def set_pin_mode():
@@ -56,29 +61,240 @@ def set_pin_mode():
 SOLENOID_LOCK_WAIT_TIME_S = 2
 RELOCK_KEY_TIMEOUT_S = 5
 READER_TIMEOUT_S = 0.1
+# Only when a reader doesn't answer the VersionReg probe at startup
+READER_HARD_RESET_S = 1
 MAIN_LOOP_DELAY_S = 1 / 10000
+# Locked slots are only presence-checked, a theft is reported at most
+# THEFT_DETECTION_BUDGET_S after the key leaves the slot
+THEFT_DETECTION_BUDGET_S = 2
+LOCKED_SLOT_POLL_INTERVAL_S = 0.25
+LOCKED_SLOT_MAX_POLL_INTERVAL_S = (
+    THEFT_DETECTION_BUDGET_S - KEY_STOLEN_LIMIT.total_seconds()
+)
+USER_READER_IDLE_POLL_INTERVAL_S = 0.1
+USER_READER_MAX_IDLE_POLL_INTERVAL_S = 0.5
+# After this long without any activity, idle poll intervals grow by IDLE_BACKOFF_FACTOR
+IDLE_BACKOFF_AFTER_S = 60
+IDLE_BACKOFF_FACTOR = 1.5
+# A poll loop iteration (its sleep included) or a single store tick running past its
+# budget is logged with every thread's stack. Set KEY_GUARD_STALL_RESTART_AFTER_S to
+# exit after a stall that long, for the service manager to restart us.
+STALL_LOOP_BUDGET_S = 10
+STALL_TICK_BUDGET_S = 5
+STALL_CHECK_INTERVAL_S = 1
+STALL_RESTART_AFTER_S = (
+    float(os.environ["KEY_GUARD_STALL_RESTART_AFTER_S"])
+    if "KEY_GUARD_STALL_RESTART_AFTER_S" in os.environ
+    else None
+)
 KEY_SELECTION_INPUT_TIMEOUT_S = 60
+MAX_CONCURRENT_SESSIONS = 4
+DATABASE_RELOAD_POLL_INTERVAL_S = 5
+# Changes made through database_writer are written back to the files after this delay,
+# so a burst of them is written once
+DATABASE_WRITE_DELAY_S = 1
+# "json" keeps the whole database in memory and hot-reloads database.json,
+# "sqlite" loads records lazily from SQLITE_DATABASE_FILE (see sqlite_database.py)
+DATABASE_BACKEND = os.environ.get("KEY_GUARD_DB_BACKEND", "json")
+SQLITE_DATABASE_FILE = "./key_guard.db"
+# "primary" publishes database changes to replicas over TLS on REPLICATION_PORT,
+# "replica" follows REPLICATION_PRIMARY_HOST instead of watching its own files
+REPLICATION_ROLE = os.environ.get("KEY_GUARD_REPLICATION_ROLE", "")
+REPLICATION_PRIMARY_HOST = os.environ.get("KEY_GUARD_REPLICATION_PRIMARY", "")
+# The primary's address on the network the cabinets share, required for "primary"
+REPLICATION_BIND_HOST = os.environ.get("KEY_GUARD_REPLICATION_BIND", "")
+REPLICATION_PORT = 2001
+# Replicas log in with a client certificate issued by REPLICATION_CA_FILE, and pin
+# the primary's key_guard.pem, copied to REPLICATION_PRIMARY_PEM_FILE on each replica
+REPLICATION_CA_FILE = "./replication_ca.pem"
+REPLICATION_PRIMARY_PEM_FILE = "./replication_primary.pem"
+REPLICATION_REPLICA_PEM_FILE = "./key_guard_replica.pem"
+REPLICATION_REPLICA_KEY_FILE = "./key_guard_replica.key"
+REPLICATION_LOG_SIZE = 1024
+REPLICATION_RETRY_INTERVAL_S = 5
+# bcrypt runs on a process pool, logins beyond PASSWORD_CHECK_MAX_IN_FLIGHT wait for
+# a slot, and any not checked within PASSWORD_CHECK_QUEUE_TIMEOUT_S are told to retry
+PASSWORD_CHECK_WORKERS = 2
+PASSWORD_CHECK_MAX_IN_FLIGHT = 8
+PASSWORD_CHECK_QUEUE_TIMEOUT_S = 5
+# Successful logins are remembered this long so quick retries skip bcrypt, 0 disables
+PASSWORD_CHECK_CACHE_TTL_S = 10
+# New hashes get the highest bcrypt cost that checks within this budget on this
+# device, calibrated once into BCRYPT_COST_FILE. Hashes made with another cost are
+# redone in the background on their next successful login.
+PASSWORD_CHECK_TARGET_S = 0.25
+BCRYPT_COST_FILE = "./bcrypt_cost.json"
+# "threads" serves websocket clients on threads of their own next to the poll loop,
+# "asyncio" runs the websocket server, the poll loop, the queued event listeners and the
+# relock timers in one event loop on the main thread, only reader SPI transfers and
+# password checks run off it
+RUNTIME = os.environ.get("KEY_GUARD_RUNTIME", "threads")
+# Listeners that log or message the websocket client run on worker threads, so a slow
+# client never delays reader polling. Noisy alerts are coalesced before they are
+# queued, and drop the oldest call past NOTIFICATION_QUEUE_SIZE waiting ones. Everything
+# else (thefts, returns, logins) is never dropped, past ALARM_QUEUE_SIZE waiting calls
+# the poll loop waits for room.
+NOTIFICATION_QUEUE_SIZE = 256
+ALARM_QUEUE_SIZE = 256
+# Prometheus text at http://METRICS_HOST:METRICS_PORT/metrics, local scrapers only
+METRICS_HOST = "127.0.0.1"
+METRICS_PORT = 9100
+# Holds the token admin websocket requests (e.g. "profiler") must carry, without the
+# file they are refused
+ADMIN_TOKEN_FILE = "./ws_admin_token"
+# Per websocket client. A client that falls this far behind is disconnected, and
+# resumes the alerts it missed when it reconnects.
+WS_CLIENT_SEND_QUEUE_SIZE = 256
+# Repeats of a noisy alert for the same (source, card) are folded into one summary per
+# window, and each alert type is capped by a token bucket
+ALERT_COALESCING_POLICIES = {
+    "unknown-key-placed": CoalescingPolicy(dedup_window_s=10, rate_per_s=1, burst=5),
+    "unauth-key-place-attempt": CoalescingPolicy(
+        dedup_window_s=10, rate_per_s=1, burst=5
+    ),
+    "unrecognized-user-card": CoalescingPolicy(
+        dedup_window_s=10, rate_per_s=1, burst=5
+    ),
+}
+
+startup_timings = PhaseTimings()
+
+password_verifier = PasswordVerifier(
+    max_workers=PASSWORD_CHECK_WORKERS,
+    max_in_flight=PASSWORD_CHECK_MAX_IN_FLIGHT,
+    queue_timeout_s=PASSWORD_CHECK_QUEUE_TIMEOUT_S,
+    cache_ttl_s=PASSWORD_CHECK_CACHE_TTL_S,
+)
+# Forked first, before the startup threads or any device is opened (only the log
+# listener thread runs yet, the workers never log)
+with startup_timings.phase("password-workers"):
+    password_verifier.start()
+database.set_password_verifier(password_verifier)
+
+with startup_timings.phase("gpio"):
+    solenoid1_controller = gpiozero.DigitalOutputDevice(24)
+    solenoid2_controller = gpiozero.DigitalOutputDevice(23)
+    set_pin_mode()
+    # Claimed high, so readers left running by a previous process aren't reset
+    reset_pin = gpiozero.DigitalOutputDevice(22, initial_value=True)
+    user_reader_select = gpiozero.DigitalOutputDevice(25)
+    key1_reader_select = gpiozero.DigitalOutputDevice(5)
+    key2_reader_select = gpiozero.DigitalOutputDevice(6)
+    lines_locks = ChipSelectLinesLock(
+        [user_reader_select, key1_reader_select, key2_reader_select]
+    )
+
+
+def init_readers() -> tuple[SimpleMFRC522, SimpleMFRC522, SimpleMFRC522]:
+    # One SPI bus for all readers, so they are set up one after the other
+    readers = (
+        SimpleMFRC522(bus=0, device=0, lock=lines_locks.individual_line_lock(0)),
+        SimpleMFRC522(bus=0, device=0, lock=lines_locks.individual_line_lock(1)),
+        SimpleMFRC522(bus=0, device=0, lock=lines_locks.individual_line_lock(2)),
+    )
+    if not all(reader.is_responding() for reader in readers):
+        logger.log(logging.WARNING, "A reader did not respond, hard resetting them")
+        reset_pin.off()
+        time.sleep(READER_HARD_RESET_S)
+        reset_pin.on()
+        for reader in readers:
+            reader.initialize()
+    return readers
+
+
+def read_pem_file_password() -> str:
+    with open("./key_guard_pem_password") as f:
+        return f.readline().strip()
+
+
+def init_server_ssl_context() -> ssl.SSLContext:
+    return load_server_ssl_context(
+        "./key_guard.pem", "./key_guard.key", read_pem_file_password()
+    )
 
-solenoid1_controller = gpiozero.DigitalOutputDevice(24)
-solenoid2_controller = gpiozero.DigitalOutputDevice(23)
-set_pin_mode()
-reset_pin = gpiozero.DigitalOutputDevice(22)
-
-reset_pin.off()
-time.sleep(1)
-reset_pin.on()
-
-_: database.UsersDB
-user_reader_select = gpiozero.DigitalOutputDevice(25)
-key1_reader_select = gpiozero.DigitalOutputDevice(5)
-key2_reader_select = gpiozero.DigitalOutputDevice(6)
-lines_locks = ChipSelectLinesLock(
-    [user_reader_select, key1_reader_select, key2_reader_select]
+
+# Reader bring-up and TLS setup run alongside the database loading below
+startup_pool = ThreadPoolExecutor(max_workers=2, thread_name_prefix="Startup")
+readers_future = startup_pool.submit(startup_timings.timed("readers", init_readers))
+server_ssl_context_future = startup_pool.submit(
+    startup_timings.timed("tls", init_server_ssl_context)
 )
-user_reader = SimpleMFRC522(bus=0, device=0, lock=lines_locks.individual_line_lock(0))
-key1_reader = SimpleMFRC522(bus=0, device=0, lock=lines_locks.individual_line_lock(1))
-key2_reader = SimpleMFRC522(bus=0, device=0, lock=lines_locks.individual_line_lock(2))
+
+keys_db: database.KeysBackend
+users_db: database.UsersBackend
+database_watcher: database.DatabaseWatcher | None
+database_writer: DatabaseWriter | None = None
+with startup_timings.phase("database"):
+    if DATABASE_BACKEND == "sqlite":
+        from sqlite_database import SqliteKeysDB, SqliteUsersDB
+
+        keys_db = SqliteKeysDB(SQLITE_DATABASE_FILE)
+        users_db = SqliteUsersDB(SQLITE_DATABASE_FILE)
+        database_watcher = None
+    else:
+        keys_db = database.KeysDB()
+        users_db = database.UsersDB()
+        database_watcher = (
+            database.DatabaseWatcher(
+                poll_interval_s=DATABASE_RELOAD_POLL_INTERVAL_S,
+                keys_db=keys_db,
+                users_db=users_db,
+            )
+            if REPLICATION_ROLE != "replica"
+            else None
+        )
+        if REPLICATION_ROLE != "replica":
+            database_writer = DatabaseWriter(
+                write_delay_s=DATABASE_WRITE_DELAY_S,
+                keys_db=keys_db,
+                users_db=users_db,
+                watcher=database_watcher,
+            )
+
+with startup_timings.phase("bcrypt"):
+    database.set_bcrypt_cost(
+        load_bcrypt_cost(BCRYPT_COST_FILE, PASSWORD_CHECK_TARGET_S),
+        rehash_password=(
+            database_writer.rehash_password if database_writer is not None else None
+        ),
+    )
+
+replication_primary: replication.ReplicationPrimary | None = None
+replication_replica: replication.ReplicationReplica | None = None
+if REPLICATION_ROLE != "" and DATABASE_BACKEND != "json":
+    raise ValueError("Replication is only supported with the json database backend")
+if REPLICATION_ROLE == "primary":
+    if REPLICATION_BIND_HOST == "":
+        raise ValueError("KEY_GUARD_REPLICATION_BIND must be set on the primary")
+    replication_server_ssl_context = replication.load_primary_ssl_context(
+        "./key_guard.pem",
+        "./key_guard.key",
+        read_pem_file_password(),
+        REPLICATION_CA_FILE,
+    )
+    replication_primary = replication.ReplicationPrimary(
+        log_size=REPLICATION_LOG_SIZE, keys_db=keys_db, users_db=users_db
+    )
+elif REPLICATION_ROLE == "replica":
+    replication_client_ssl_context = replication.load_replica_ssl_context(
+        REPLICATION_PRIMARY_PEM_FILE,
+        REPLICATION_REPLICA_PEM_FILE,
+        REPLICATION_REPLICA_KEY_FILE,
+        read_pem_file_password(),
+    )
+    replication_replica = replication.ReplicationReplica(
+        connect=lambda: replication.connect_tcp(
+            REPLICATION_PRIMARY_HOST, REPLICATION_PORT, replication_client_ssl_context
+        ),
+        retry_interval_s=REPLICATION_RETRY_INTERVAL_S,
+        keys_db=keys_db,
+        users_db=users_db,
+    )
+
+user_reader, key1_reader, key2_reader = readers_future.result()
 past_user_card_id: str | None = None
+event_loop = asyncio.new_event_loop() if RUNTIME == "asyncio" else None
+
 key1_store = KeyStore(
     slot_name="Key Slot 1",
     init_locked=False,
@@ -88,6 +304,8 @@ key1_store = KeyStore(
     reader_timeout_s=READER_TIMEOUT_S,
     key_relock_timeout_s=RELOCK_KEY_TIMEOUT_S,
     solenoid_lock_wait_time_s=SOLENOID_LOCK_WAIT_TIME_S,
+    keys_db=keys_db,
+    call_later=event_loop.call_later if event_loop is not None else None,
 )
 key2_store = KeyStore(
     slot_name="Key Slot 2",
@@ -98,31 +316,75 @@ key2_store = KeyStore(
     reader_timeout_s=READER_TIMEOUT_S,
     key_relock_timeout_s=RELOCK_KEY_TIMEOUT_S,
     solenoid_lock_wait_time_s=SOLENOID_LOCK_WAIT_TIME_S,
+    keys_db=keys_db,
+    call_later=event_loop.call_later if event_loop is not None else None,
 )
 key_stores = [key1_store, key2_store]
+session_manager = SessionManager(
+    max_sessions=MAX_CONCURRENT_SESSIONS,
+    session_timeout_s=KEY_SELECTION_INPUT_TIMEOUT_S,
+)
 user_store = UserStore(
     user_reader=user_reader,
     user_reader_timeout_s=READER_TIMEOUT_S,
+    session_manager=session_manager,
+    users_db=users_db,
 )
 
+alert_coalescer = EventCoalescer(ALERT_COALESCING_POLICIES)
+if event_loop is not None:
+    # The loop's queue never drops, one dispatcher does for both
+    notification_dispatcher = LoopDispatcher(name="Notifications", loop=event_loop)
+    alarm_dispatcher = notification_dispatcher
+else:
+    notification_dispatcher = QueuedDispatcher(
+        name="Notifications", max_queue=NOTIFICATION_QUEUE_SIZE, overflow="drop-oldest"
+    )
+    alarm_dispatcher = QueuedDispatcher(
+        name="Alarms", max_queue=ALARM_QUEUE_SIZE, overflow="block"
+    )
+
+
+def log_fields(
+    event: str,
+    slot: str | None = None,
+    key: KeyData | None = None,
+    user: UserData | None = None,
+) -> dict:
+    # The structured fields of a log record, see logger_instance.STRUCTURED_FIELDS
+    return {
+        "event": event,
+        "slot": slot,
+        "key_id": key.id if key is not None else None,
+        "user_id": user.id if user is not None else None,
+    }
+
+
+def slot_id_of(key_store: KeyStore) -> int:
+    return key_stores.index(key_store) + 1
+
 
 @typechecked
 def get_opts_for_key_slot(
-    user: UserData, slot_id: int, key_store: KeyStore
+    user: UserData, slot_id: int, slot_state: KeySlotState
 ) -> KeySelectionOption:
-    if key_store.current_key is None:
-        return KeySelectionOption.make_insert_key(slot_id, key_store.slot_name)
-    elif key_store.current_key.id in user.authorized_for:
+    if slot_state.current_key is None:
+        return KeySelectionOption.make_insert_key(slot_id, slot_state.slot_name)
+    elif users_db.is_authorized(user, slot_state.current_key):
         return KeySelectionOption.make_remove_key(
-            slot_id, key_store.slot_name, key_store.current_key.name
+            slot_id, slot_state.slot_name, slot_state.current_key.name
         )
     else:
-        return KeySelectionOption.make_access_denied(slot_id, key_store.slot_name)
+        return KeySelectionOption.make_access_denied(slot_id, slot_state.slot_name)
 
 
 @typechecked
 def get_key_selection_options(user: UserData) -> list[KeySelectionOption]:
-    return [get_opts_for_key_slot(user, i + 1, ks) for i, ks in enumerate(key_stores)]
+    # Take every slot's snapshot up front so the options are built from one view
+    slot_states = [ks.state for ks in key_stores]
+    return [
+        get_opts_for_key_slot(user, i + 1, state) for i, state in enumerate(slot_states)
+    ]
 
 
 @typechecked
@@ -130,17 +392,21 @@ def on_key_selected(user: UserData, iv: int) -> bool:
     i = iv - 1
     if not (0 <= i < len(key_stores)):
         return False
+    slot_state = key_stores[i].state
     if (
-        key_stores[i].current_key is None
-        or key_stores[i].current_key.id in user.authorized_for
+        slot_state.current_key is None
+        or users_db.is_authorized(user, slot_state.current_key)
     ):
         key_stores[i].unlock_key()
         logger.log(
             logging.INFO,
             "User {0}: Unlocked key slot '{1}' (current_key={2})",
             user,
-            key_stores[i].slot_name,
-            key_stores[i].current_key,
+            slot_state.slot_name,
+            slot_state.current_key,
+            extra=log_fields(
+                "key-slot-unlocked", slot_state.slot_name, slot_state.current_key, user
+            ),
         )
         return True
     else:
@@ -148,25 +414,32 @@ def on_key_selected(user: UserData, iv: int) -> bool:
             logging.WARNING,
             "User {0}: Attempted to unlock '{1}' (current_key={2}) which they are not authorized for",
             user,
-            key_stores[i].slot_name,
-            key_stores[i].current_key,
+            slot_state.slot_name,
+            slot_state.current_key,
+            extra=log_fields(
+                "key-slot-unlock-denied", slot_state.slot_name, slot_state.current_key, user
+            ),
         )
         return False
 
 
-with open("./key_guard_pem_password") as f:
-    pem_file_password = f.readline().strip()
-
+server_ssl_context = server_ssl_context_future.result()
+startup_pool.shutdown()
 
 websocket_server = WebsocketServer(
     secret_file="./ws_hmac",
-    user_key_selection_timeout_s=KEY_SELECTION_INPUT_TIMEOUT_S,
+    ssl_context=server_ssl_context,
+    session_manager=session_manager,
+    users_db=users_db,
     get_key_selection_options=get_key_selection_options,
-    get_current_user=lambda: user_store.current_user,
     on_key_selected=on_key_selected,
-    pem_file="./key_guard.pem",
-    private_key_file="./key_guard.key",
-    pem_file_password=pem_file_password,
+    admin_token_file=ADMIN_TOKEN_FILE if os.path.exists(ADMIN_TOKEN_FILE) else None,
+    # Samples the poll loop, which runs on the main thread
+    profiler=SamplingProfiler(thread_id=threading.main_thread().ident),
+    # Edited through the admin edit-database request
+    database_writer=database_writer,
+    client_send_queue_size=WS_CLIENT_SEND_QUEUE_SIZE,
+    slow_client_policy="disconnect",
 )
 
 
@@ -188,6 +461,14 @@ def on_client_disconnected(
 
 @key1_store.unauthorized_key_place_attempted.on
 @key2_store.unauthorized_key_place_attempted.on
+@alert_coalescer.coalesce(
+    "unauth-key-place-attempt",
+    key=lambda origin, data: (
+        origin.slot_name,
+        data if isinstance(data, str) else data.rf_id,
+    ),
+    dispatcher=notification_dispatcher,
+)
 @typechecked
 def on_unauthorized_key_place_attempted(origin: KeyStore, data: str | KeyData):
     logger.log(
@@ -195,12 +476,22 @@ def on_unauthorized_key_place_attempted(origin: KeyStore, data: str | KeyData):
         "({0}) An unknown user attempted to place a key: {1}",
         origin.slot_name,
         data,
+        extra=log_fields(
+            "unauth-key-place-attempt",
+            origin.slot_name,
+            data if isinstance(data, KeyData) else None,
+        ),
     )
     websocket_server.on_unauthorized_key_place_attempted(origin.slot_name, data)
 
 
 @key1_store.unknown_key_placed.on
 @key2_store.unknown_key_placed.on
+@alert_coalescer.coalesce(
+    "unknown-key-placed",
+    key=lambda origin, data: (origin.slot_name, data),
+    dispatcher=notification_dispatcher,
+)
 @typechecked
 def on_unknown_key_placed(origin: KeyStore, data: str):
     logger.log(
@@ -208,15 +499,17 @@ def on_unknown_key_placed(origin: KeyStore, data: str):
         "({0}) Unknown key placed: {1}",
         origin.slot_name,
         data,
+        extra=log_fields("unknown-key-placed", origin.slot_name),
     )
     websocket_server.on_unknown_key_placed(origin.slot_name, data)
 
 
-@key1_store.key_stolen.on
-@key2_store.key_stolen.on
+@key1_store.key_stolen.on_queue(alarm_dispatcher)
+@key2_store.key_stolen.on_queue(alarm_dispatcher)
 @typechecked
 def on_key_stolen(origin: KeyStore, data: tuple[KeyData, str | None]):
     key, replacement = data
+    fields = log_fields("key-stolen", origin.slot_name, key)
     if replacement is not None:
         logger.log(
             logging.WARNING,
@@ -224,64 +517,104 @@ def on_key_stolen(origin: KeyStore, data: tuple[KeyData, str | None]):
             origin.slot_name,
             key,
             replacement,
+            extra=fields,
         )
     else:
-        logger.log(logging.WARNING, "({0}) Key stolen: {1}", origin.slot_name, key)
+        logger.log(
+            logging.WARNING,
+            "({0}) Key stolen: {1}",
+            origin.slot_name,
+            key,
+            extra=fields,
+        )
+    if key is not None:
+        logger.log(
+            logging.WARNING,
+            "({0}) Users authorized for {1}: {2}",
+            origin.slot_name,
+            key.name,
+            ", ".join(u.username for u in users_db.users_authorized_for(key)),
+        )
     websocket_server.on_key_stolen(origin.slot_name, key, replacement)
 
 
-@key1_store.key_found.on
-@key2_store.key_found.on
+@key1_store.key_found.on_queue(alarm_dispatcher)
+@key2_store.key_found.on_queue(alarm_dispatcher)
 @typechecked
 def on_key_found(origin: KeyStore, key: KeyData):
-    logger.log(logging.INFO, "({0}) Key found: {1}", origin.slot_name, key)
-    websocket_server.on_key_slot_locked("success")
+    logger.log(
+        logging.INFO,
+        "({0}) Key found: {1}",
+        origin.slot_name,
+        key,
+        extra=log_fields("key-found", origin.slot_name, key),
+    )
+    websocket_server.on_key_slot_locked(slot_id_of(origin), "success")
 
 
-@key1_store.relocked.on
-@key2_store.relocked.on
+@key1_store.relocked.on_queue(alarm_dispatcher)
+@key2_store.relocked.on_queue(alarm_dispatcher)
 @typechecked
 def on_relock_key_timeout(origin: KeyStore, _: None = None):
     logger.log(logging.INFO, "({0}) Re-locking key", origin.slot_name)
-    websocket_server.on_key_slot_locked("no-change")
+    websocket_server.on_key_slot_locked(slot_id_of(origin), "no-change")
 
 
-@key1_store.key_uninserted.on
-@key2_store.key_uninserted.on
+@key1_store.key_uninserted.on_queue(alarm_dispatcher)
+@key2_store.key_uninserted.on_queue(alarm_dispatcher)
 @typechecked
 def on_key_uninserted(origin: KeyStore, key: KeyData):
-    logger.log(logging.INFO, "({0}) Key uninserted: {1}", origin.slot_name, key)
-    websocket_server.on_key_slot_locked("success")
+    logger.log(
+        logging.INFO,
+        "({0}) Key uninserted: {1}",
+        origin.slot_name,
+        key,
+        extra=log_fields("key-uninserted", origin.slot_name, key),
+    )
+    websocket_server.on_key_slot_locked(slot_id_of(origin), "success")
 
 
+# Not queued, the slot is released before the poll loop goes on
 @key1_store.solenoid_locked.on
 @key2_store.solenoid_locked.on
 @typechecked
 def on_solenoid_locked(origin: KeyStore, _: None = None):
-    user_store.logout_user()
-    websocket_server.on_key_slot_locked("success")
+    session_manager.release_slot(slot_id_of(origin))
 
 
-@user_store.user_found.on
+@key1_store.solenoid_locked.on_queue(alarm_dispatcher)
+@key2_store.solenoid_locked.on_queue(alarm_dispatcher)
 @typechecked
-def on_user_found(
-    source: UserStore, data: tuple[UserData, Literal["login"] | Literal["card"]]
-):
-    user, mode = data
-    logger.log(logging.INFO, "User found: {0}", user)
-    if mode != "login":
-        websocket_server.on_user_found(user)
-    threading.Timer(
-        function=user_store.logout_user,
-        interval=KEY_SELECTION_INPUT_TIMEOUT_S,
-    ).start()
+def notify_solenoid_locked(origin: KeyStore, _: None = None):
+    websocket_server.on_key_slot_locked(slot_id_of(origin), "success")
+
+
+@user_store.user_found.on_queue(alarm_dispatcher)
+@typechecked
+def on_user_found(source: UserStore, session: Session):
+    logger.log(
+        logging.INFO,
+        "User found: {0}",
+        session,
+        extra=log_fields("user-found", user=session.user),
+    )
+    websocket_server.on_user_found(session)
 
 
 @websocket_server.user_login.on
 @typechecked
-def on_user_login(source: WebsocketServer, user: UserData):
-    logger.log(logging.INFO, "User login with password: {0}", user)
-    user_store.on_user_login(user)
+def on_user_login(source: WebsocketServer, session: Session):
+    logger.log(logging.INFO, "User login with password: {0}", session)
+
+
+@session_manager.session_ended.on_queue(alarm_dispatcher)
+@typechecked
+def on_session_ended(
+    source: SessionManager,
+    data: tuple[Session, Literal["timeout"] | Literal["completed"]],
+):
+    session, reason = data
+    logger.log(logging.INFO, "Session ended ({0}): {1}", reason, session)
 
 
 @websocket_server.user_login_blocked.on
@@ -291,16 +624,17 @@ def on_user_login_blocked(source: WebsocketServer, v: tuple[str, str]):
     logger.log(logging.INFO, "User login blocked: {0}", username)
 
 
-@user_store.user_card_found_but_blocked.on
+@user_store.user_card_found_but_blocked.on_queue(alarm_dispatcher)
 @typechecked
 def on_user_card_blocked(source: UserStore, user: UserData):
+    active_users = [s.user for s in session_manager.state.sessions]
     logger.log(
         logging.INFO,
-        "User card {0} found but blocked, as another user {1} is currently logged in.",
+        "User card {0} found but blocked, as {1} users are already logged in.",
         user.name,
-        user_store.current_user,
+        len(active_users),
     )
-    websocket_server.on_user_card_found_but_blocked(user, user_store.current_user)
+    websocket_server.on_user_card_found_but_blocked(user, active_users)
 
 
 @websocket_server.user_login_failed.on
@@ -335,27 +669,143 @@ def on_key_selection_failed(
 
 
 @user_store.unknown_user_found.on
+@alert_coalescer.coalesce(
+    "unrecognized-user-card",
+    key=lambda origin, data: ("User Reader", data),
+    dispatcher=notification_dispatcher,
+)
 @typechecked
 def on_unknown_user_found(source: UserStore, card_id: str):
     logger.log(logging.WARNING, "Unknown user: Card ID: {0}", card_id)
     websocket_server.on_unknown_user_found(card_id)
 
 
+@typechecked
+def on_database_reloaded(source: database.DatabaseWatcher, _: None = None):
+    logger.log(logging.INFO, "Database reloaded")
+
+
+if database_watcher is not None:
+    database_watcher.reloaded.add_listener(on_database_reloaded)
+
+
+@typechecked
+def on_replication_applied(source: replication.ReplicationReplica, seq: int):
+    logger.log(logging.INFO, "Database replicated up to change set {0}", seq)
+
+
+if replication_replica is not None:
+    replication_replica.applied.add_listener(on_replication_applied)
+
+
+@alert_coalescer.summarized.on_queue(alarm_dispatcher)
+@typechecked
+def on_alert_summarized(source: EventCoalescer, summary: CoalescedSummary):
+    logger.log(logging.WARNING, "{0}", summary)
+    websocket_server.on_event_summary(
+        summary.event_name,
+        summary.source,
+        summary.card_id,
+        summary.count,
+        summary.window_s,
+    )
+
+
+def restart_after_stall():
+    # os._exit skips atexit, the stall report must not be left in the log queue
+    flush_logs()
+    logging.shutdown()
+    # Non-zero, so the service manager restarts us
+    os._exit(1)
+
+
+stall_watchdog = StallWatchdog(
+    loop_budget_s=STALL_LOOP_BUDGET_S,
+    tick_budget_s=STALL_TICK_BUDGET_S,
+    check_interval_s=STALL_CHECK_INTERVAL_S,
+    restart_after_s=STALL_RESTART_AFTER_S,
+    chip_select_lock=lines_locks,
+    restart=restart_after_stall,
+)
+
+
+async def run_async():
+    loop = asyncio.get_running_loop()
+    # One thread for every reader, they share the SPI bus and chip select lines
+    spi_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="SPI")
+    await asyncio.gather(
+        websocket_server.serve_async(),
+        poll_scheduler.run_forever_async(
+            lambda store: loop.run_in_executor(spi_executor, store.read_card)
+        ),
+    )
+
+
 try:
-    ws_thread = threading.Thread(target=websocket_server.serve_and_block, daemon=True)
-    ws_thread.start()
-    while True:
-        user_store.tick()
-        key1_store.tick()
-        key2_store.tick()
-        time.sleep(MAIN_LOOP_DELAY_S)
+    notification_dispatcher.start()
+    if alarm_dispatcher is not notification_dispatcher:
+        alarm_dispatcher.start()
+    metrics.serve_http(METRICS_HOST, METRICS_PORT)
+    if event_loop is None:
+        ws_thread = threading.Thread(
+            target=websocket_server.serve_and_block, daemon=True
+        )
+        ws_thread.start()
+    if database_watcher is not None:
+        database_watcher.start()
+    if database_writer is not None:
+        database_writer.start()
+    if replication_primary is not None:
+        threading.Thread(
+            target=replication_primary.serve_tcp,
+            args=(
+                REPLICATION_BIND_HOST,
+                REPLICATION_PORT,
+                replication_server_ssl_context,
+            ),
+            daemon=True,
+        ).start()
+    if replication_replica is not None:
+        replication_replica.start()
+    poll_scheduler = PollScheduler(
+        idle_backoff_after_s=IDLE_BACKOFF_AFTER_S,
+        idle_backoff_factor=IDLE_BACKOFF_FACTOR,
+        min_sleep_s=MAIN_LOOP_DELAY_S,
+        watchdog=stall_watchdog,
+    )
+    poll_scheduler.add(
+        user_store,
+        active_interval_s=MAIN_LOOP_DELAY_S,
+        idle_interval_s=USER_READER_IDLE_POLL_INTERVAL_S,
+        max_interval_s=USER_READER_MAX_IDLE_POLL_INTERVAL_S,
+        name="User Reader",
+    )
+    for key_store in key_stores:
+        poll_scheduler.add(
+            key_store,
+            active_interval_s=MAIN_LOOP_DELAY_S,
+            idle_interval_s=LOCKED_SLOT_POLL_INTERVAL_S,
+            max_interval_s=LOCKED_SLOT_MAX_POLL_INTERVAL_S,
+            name=key_store.slot_name,
+        )
+    poll_scheduler.add_housekeeping(alert_coalescer.flush)
+    stall_watchdog.start()
+    logger.log(logging.INFO, "Started in {0}", startup_timings.summary())
+    if event_loop is None:
+        poll_scheduler.run_forever()
+    else:
+        event_loop.run_until_complete(run_async())
 except Exception as ex:
     traceback.print_exc()
 finally:
+    if database_writer is not None:
+        database_writer.flush()
+    password_verifier.shutdown()
     key1_reader.cleanup()
     key2_reader.cleanup()
     user_reader.cleanup()
     GPIO.cleanup()
+    flush_logs()
     logging.shutdown()
     sys.stdout.flush()
     sys.stderr.flush()
@@ -0,0 +1,255 @@
+"""
+In-process metrics, exposed as Prometheus text over HTTP and as the
+websocket "metrics" request.
+
+Recording never takes a lock: every thread writes to its own shard, and a
+shard is only ever read (summed) by the exporter. When a thread exits (e.g. a
+websocket client's sender) its shard is folded into a retired total, so
+shards don't pile up with the connections.
+"""
+
+import bisect
+from collections.abc import Iterator
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import threading
+import time
+import weakref
+
+# Exponential histogram bounds, 10us to 100s with 8 buckets per power of 10
+DEFAULT_BOUNDS_S = tuple(1e-5 * 10 ** (i / 8) for i in range(57))
+
+
+def _label(label: str | None, value: str, extra: str = "") -> str:
+    labels = [] if label is None else [f'{label}="{_escape(value)}"']
+    if extra:
+        labels.append(extra)
+    return "{" + ",".join(labels) + "}" if labels else ""
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+class _ThreadSentinel:
+    # Only referenced from a thread's locals, collected when the thread exits
+    pass
+
+
+class _Sharded:
+    name: str
+    help: str
+    label: str | None
+    _local: threading.local
+    # The live threads' shards
+    _shards: list[dict]
+    # What the exited threads recorded, replaced (never changed) when one retires
+    _retired: dict
+    _shards_lock: threading.Lock
+
+    def __init__(self, name: str, help: str, label: str | None):
+        self.name = name
+        self.help = help
+        self.label = label
+        self._local = threading.local()
+        self._shards = []
+        self._retired = {}
+        self._shards_lock = threading.Lock()
+
+    def _shard(self) -> dict:
+        shard = getattr(self._local, "shard", None)
+        if shard is None:
+            # Once per thread
+            shard = self._local.shard = {}
+            self._local.sentinel = _ThreadSentinel()
+            weakref.finalize(self._local.sentinel, self._retire, shard)
+            with self._shards_lock:
+                self._shards.append(shard)
+        return shard
+
+    def _retire(self, shard: dict):
+        # The thread is gone, nothing writes to its shard anymore
+        with self._shards_lock:
+            self._shards = [v for v in self._shards if v is not shard]
+            self._retired = self._merged(self._retired, shard)
+
+    def _merged(self, a: dict, b: dict) -> dict:
+        raise NotImplementedError
+
+    def _all_shards(self) -> list[dict]:
+        with self._shards_lock:
+            return [self._retired, *self._shards]
+
+
+class Counter(_Sharded):
+    def inc(self, amount: int = 1, label_value: str = ""):
+        shard = self._shard()
+        shard[label_value] = shard.get(label_value, 0) + amount
+
+    def _merged(self, a: dict, b: dict) -> dict:
+        totals = dict(a)
+        for label_value, count in list(b.items()):
+            totals[label_value] = totals.get(label_value, 0) + count
+        return totals
+
+    def values(self) -> dict[str, int]:
+        totals: dict[str, int] = {}
+        for shard in self._all_shards():
+            totals = self._merged(totals, shard)
+        return totals
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        for label_value, count in sorted(self.values().items()):
+            lines.append(f"{self.name}{_label(self.label, label_value)} {count}")
+        return lines
+
+    def snapshot(self) -> dict:
+        return self.values()
+
+
+class Histogram(_Sharded):
+    bounds: tuple[float, ...]
+
+    def __init__(
+        self,
+        name: str,
+        help: str,
+        label: str | None,
+        bounds: tuple[float, ...] = DEFAULT_BOUNDS_S,
+    ):
+        super().__init__(name, help, label)
+        self.bounds = bounds
+
+    def observe(self, value: float, label_value: str = ""):
+        shard = self._shard()
+        row = shard.get(label_value)
+        if row is None:
+            # [bucket counts (the last one is +Inf), sum]
+            row = shard[label_value] = [[0] * (len(self.bounds) + 1), 0.0]
+        row[0][bisect.bisect_left(self.bounds, value)] += 1
+        row[1] += value
+
+    @contextmanager
+    def time(self, label_value: str = "") -> Iterator[None]:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, label_value)
+
+    def _merged(self, a: dict, b: dict) -> dict:
+        merged = dict(a)
+        for label_value, (counts, total) in list(b.items()):
+            m_counts, m_total = merged.get(
+                label_value, ([0] * (len(self.bounds) + 1), 0.0)
+            )
+            merged[label_value] = (
+                [x + y for x, y in zip(m_counts, counts)],
+                m_total + total,
+            )
+        return merged
+
+    def buckets(self) -> dict[str, tuple[list[int], float]]:
+        merged: dict[str, tuple[list[int], float]] = {}
+        for shard in self._all_shards():
+            merged = self._merged(merged, shard)
+        return merged
+
+    def quantile(self, counts: list[int], q: float) -> float:
+        # Linear interpolation within the bucket holding the q-th observation
+        rank = q * sum(counts)
+        seen = 0
+        for i, count in enumerate(counts):
+            if count and seen + count >= rank:
+                lower = self.bounds[i - 1] if i > 0 else 0.0
+                upper = self.bounds[i] if i < len(self.bounds) else self.bounds[-1]
+                return lower + (upper - lower) * (rank - seen) / count
+            seen += count
+        return 0.0
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        for label_value, (counts, total) in sorted(self.buckets().items()):
+            cumulative = 0
+            for bound, count in zip((*self.bounds, None), counts):
+                cumulative += count
+                le = "le=" + ('"+Inf"' if bound is None else f'"{bound:.6g}"')
+                labels = _label(self.label, label_value, le)
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            labels = _label(self.label, label_value)
+            lines.append(f"{self.name}_sum{labels} {total}")
+            lines.append(f"{self.name}_count{labels} {cumulative}")
+        return lines
+
+    def snapshot(self) -> dict:
+        return {
+            label_value: {
+                "count": sum(counts),
+                "sum": total,
+                "p50": self.quantile(counts, 0.5),
+                "p99": self.quantile(counts, 0.99),
+            }
+            for label_value, (counts, total) in self.buckets().items()
+        }
+
+
+class MetricsRegistry:
+    _metrics: dict[str, Counter | Histogram]
+    _lock: threading.Lock
+
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def counter(self, name: str, help: str, label: str | None = None) -> Counter:
+        with self._lock:
+            return self._metrics.setdefault(name, Counter(name, help, label))
+
+    def histogram(
+        self,
+        name: str,
+        help: str,
+        label: str | None = None,
+        bounds: tuple[float, ...] = DEFAULT_BOUNDS_S,
+    ) -> Histogram:
+        with self._lock:
+            return self._metrics.setdefault(name, Histogram(name, help, label, bounds))
+
+    def render_prometheus(self) -> str:
+        with self._lock:
+            metrics = list(self._metrics.values())
+        return "\n".join(line for m in metrics for line in m.render()) + "\n"
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            metrics = list(self._metrics.values())
+        return {m.name: m.snapshot() for m in metrics}
+
+    def serve_http(self, host: str, port: int) -> ThreadingHTTPServer:
+        """Serves GET /metrics on a daemon thread."""
+        registry = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path != "/metrics":
+                    self.send_error(404)
+                    return
+                body = registry.render_prometheus().encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        server = ThreadingHTTPServer((host, port), Handler)
+        threading.Thread(
+            target=server.serve_forever, name="Metrics", daemon=True
+        ).start()
+        return server
+
+
+metrics = MetricsRegistry()
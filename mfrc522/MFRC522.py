@@ -24,9 +24,6 @@
 import logging
 import traceback
 
-import RPi.GPIO as GPIO
-import spidev
-
 from mfrc522.chip_select_lock import ChipSelectLineLock
 
 
@@ -129,11 +126,20 @@ class MFRC522:
 
     serNum = []
 
-    def __init__(self, bus, device, lock: ChipSelectLineLock, spd=1000000):
-        self.spi = spidev.SpiDev(bus, device)
-        self.spi.max_speed_hz = spd
-        self.spi.open(bus, device)
+    # VersionReg of the MFRC522 v0.0/v1.0/v2.0 and of common FM17522 clones
+    KNOWN_VERSIONS = (0x90, 0x91, 0x92, 0x88, 0x12)
+
+    def __init__(self, bus, device, lock: ChipSelectLineLock, spd=1000000, spi=None):
+        # spi stands in for the bus device, e.g. a simulated chip off the Pi
+        if spi is None:
+            import spidev
+
+            spi = spidev.SpiDev(bus, device)
+            spi.max_speed_hz = spd
+            spi.open(bus, device)
+        self.spi = spi
         self.lock = lock
+        self._allocate_buffers()
 
         self.logger = logging.getLogger("mfrc522Logger")
 
@@ -145,20 +151,36 @@ class MFRC522:
             device,
         )
 
+    def _allocate_buffers(self):
+        # Reused by every register access and card transfer, so polling an empty
+        # field builds no lists of its own. All access is under self.lock.
+        self._register_buf = [0, 0]
+        self._request_buf = bytearray(1)
+        self._anticoll_buf = bytes((self.PICC_ANTICOLL, 0x20))
+        self._back_data = bytearray(self.MAX_LEN)
+        self._back_view = memoryview(self._back_data)
+
     def reset(self):
         with self.lock:
             self.write_register(self.CommandReg, self.PCD_RESETPHASE)
 
     def write_register(self, addr, val):
         with self.lock:
-            self.spi.xfer2([(addr << 1) & 0x7E, val])
+            buf = self._register_buf
+            buf[0] = (addr << 1) & 0x7E
+            buf[1] = val
+            self.spi.xfer2(buf)
 
     def read_register(self, addr):
         with self.lock:
-            val = self.spi.xfer2([((addr << 1) & 0x7E) | 0x80, 0])
-            return val[1]
+            buf = self._register_buf
+            buf[0] = ((addr << 1) & 0x7E) | 0x80
+            buf[1] = 0
+            return self.spi.xfer2(buf)[1]
 
     def close(self):
+        import RPi.GPIO as GPIO
+
         with self.lock:
             self.spi.close()
             GPIO.cleanup()
@@ -184,8 +206,10 @@ class MFRC522:
             self.clear_bit_mask(self.TxControlReg, 0x03)
 
     def _to_card(self, command, send_data):
+        # The returned data is a view of a reused buffer, only valid until the
+        # next transfer; copy it (bytes(...)) to keep it
         with self.lock:
-            back_data = []
+            n_back = 0
             back_len = 0
             status = self.MI_ERR
             irq_en = 0x00
@@ -204,8 +228,8 @@ class MFRC522:
 
             self.write_register(self.CommandReg, self.PCD_IDLE)
 
-            for i in range(len(send_data)):
-                self.write_register(self.FIFODataReg, send_data[i])
+            for b in send_data:
+                self.write_register(self.FIFODataReg, b)
 
             self.write_register(self.CommandReg, command)
 
@@ -241,20 +265,22 @@ class MFRC522:
                         if n > self.MAX_LEN:
                             n = self.MAX_LEN
 
+                        back_data = self._back_data
                         for i in range(n):
-                            back_data.append(self.read_register(self.FIFODataReg))
+                            back_data[i] = self.read_register(self.FIFODataReg)
+                        n_back = n
                 else:
                     status = self.MI_ERR
 
-            return status, back_data, back_len
+            return status, self._back_view[:n_back], back_len
 
     def send_request(self, req_mode):
         with self.lock:
-            tag_type = []
+            tag_type = self._request_buf
 
             self.write_register(self.BitFramingReg, 0x07)
 
-            tag_type.append(req_mode)
+            tag_type[0] = req_mode
             (status, back_data, backBits) = self._to_card(self.PCD_TRANSCEIVE, tag_type)
 
             if (status != self.MI_OK) | (backBits != 0x10):
@@ -263,17 +289,15 @@ class MFRC522:
         return status, backBits
 
     def anticoll(self):
+        # Like _to_card, returns a view that the next transfer overwrites
         with self.lock:
             ser_num_check = 0
 
-            ser_num = []
-
             self.write_register(self.BitFramingReg, 0x00)
 
-            ser_num.append(self.PICC_ANTICOLL)
-            ser_num.append(0x20)
-
-            (status, back_data, backBits) = self._to_card(self.PCD_TRANSCEIVE, ser_num)
+            (status, back_data, backBits) = self._to_card(
+                self.PCD_TRANSCEIVE, self._anticoll_buf
+            )
 
             if status == self.MI_OK:
                 if len(back_data) == 5:
@@ -364,6 +388,7 @@ class MFRC522:
                 self.logger.error("Error while reading!")
 
             if len(back_data) == 16:
+                back_data = list(back_data)
                 self.logger.debug("Sector " + str(block_addr) + " " + str(back_data))
                 return back_data
             else:
@@ -414,6 +439,13 @@ class MFRC522:
                 else:
                     self.logger.error("Authentication error")
 
+    def read_version(self):
+        return self.read_register(self.VersionReg)
+
+    def is_responding(self):
+        # A reader held in (or stuck after) power-down doesn't answer over SPI
+        return self.read_version() in self.KNOWN_VERSIONS
+
     def initialize(self):
         with self.lock:
             self.reset()
@@ -11,12 +11,19 @@ def uid_to_num(uid):
 
 class SimpleMFRC522:
     _reader = None
+    # A key left in its slot is read on every poll, its id is only formatted once
+    _last_uid = b""
+    _last_card_id = ""
+
+    # The field is off between reads, and a card in it needs a few ms after it
+    # comes back on before it can answer a request (ISO 14443-3 allows 5 ms)
+    ANTENNA_SETTLE_S = 0.005
 
     KEY = [0xFF, 0xFF, 0xFF, 0xFF, 0xFF, 0xFF]
     BLOCK_ADDRS = [8, 9, 10]
 
-    def __init__(self, bus, device, lock: ChipSelectLineLock, spd=1000000):
-        self._reader = MFRC522(bus, device, lock, spd)
+    def __init__(self, bus, device, lock: ChipSelectLineLock, spd=1000000, spi=None):
+        self._reader = MFRC522(bus, device, lock, spd, spi)
         self._reader.turn_antenna_off()
 
     def read(self):
@@ -30,31 +37,49 @@ class SimpleMFRC522:
 
     # @timing_decorator
     def read_id(self, timeout: float = -1) -> str | None:
-        if timeout == -1:
+        """
+        With a timeout, an empty field is answered after a single REQA, sent
+        once the field has settled; only a card that answered but failed
+        anticollision is retried until then. Without one (-1), blocks until a
+        card is read.
+        """
+        blocking = timeout == -1
+        if blocking:
             timeout = math.inf
         t1 = time.perf_counter()
         t_end = t1 + timeout
         with self._reader.lock:
             # print([v.value for v in self._reader.lock._csl._lines])
             self._reader.turn_antenna_on()
+        # Slept with the bus free for the other readers
+        time.sleep(self.ANTENNA_SETTLE_S)
+        with self._reader.lock:
             card_id = self._read_id_no_block()
-            if not card_id:
+            # Spinning on REQA over an empty field until t_end only burns CPU
+            if card_id == "" or (card_id is None and blocking):
                 tn = time.perf_counter()
                 while not card_id and tn < t_end:
                     card_id = self._read_id_no_block()
                     tn = time.perf_counter()
             self._reader.turn_antenna_off()
-            return card_id
+            return card_id or None
 
     # @timing
     def _read_id_no_block(self) -> str | None:
+        """
+        The card's id, None if no card answered the request, or "" if one did
+        but its uid could not be read.
+        """
         (status, TagType) = self._reader.send_request(self._reader.PICC_REQIDL)
         if status != self._reader.MI_OK:
             return None
         (status, uid) = self._reader.anticoll()
         if status != self._reader.MI_OK:
-            return None
-        return uid_to_num(uid)
+            return ""
+        if uid != self._last_uid:
+            self._last_uid = bytes(uid)
+            self._last_card_id = uid_to_num(uid)
+        return self._last_card_id
 
     def _auth_and_get_id(self):
         (status, TagType) = self._reader.send_request(self._reader.PICC_REQIDL)
@@ -63,6 +88,8 @@ class SimpleMFRC522:
         (status, uid) = self._reader.anticoll()
         if status != self._reader.MI_OK:
             return status, None
+        # Copied, select_tag reuses the buffer uid points into
+        uid = bytes(uid)
         card_id = uid_to_num(uid)
         self._reader.select_tag(uid)
         status = self._reader.auth(self._reader.PICC_AUTHENT1A, 11, self.KEY, uid)
@@ -110,6 +137,12 @@ class SimpleMFRC522:
         self._reader.stop_crypto1()
         return card_id, text[0 : (len(self.BLOCK_ADDRS) * 16)]
 
+    def is_responding(self) -> bool:
+        return self._reader.is_responding()
+
+    def initialize(self):
+        self._reader.initialize()
+
     def cleanup(self):
         self._reader.turn_antenna_off()
         self._reader.close()
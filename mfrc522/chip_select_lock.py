@@ -1,6 +1,8 @@
 from contextlib import contextmanager
 from dataclasses import dataclass
+import threading
 from threading import RLock
+import time
 
 import gpiozero
 
@@ -11,6 +13,8 @@ class ChipSelectLinesLock:
     _lines_locks: list[RLock]
     _current_line: int | None
     _num_lockings: int
+    # (thread name, line, monotonic time it was taken at) while a line is selected
+    _owner: tuple[str, int, float] | None
 
     def __init__(self, lines: list[gpiozero.DigitalOutputDevice]) -> None:
         self._lock = RLock()
@@ -18,6 +22,7 @@ class ChipSelectLinesLock:
         self._lines_locks = [RLock() for _ in self._lines]
         self._current_line = None
         self._num_lockings = 0
+        self._owner = None
         for line in self._lines:
             line.on()
 
@@ -34,7 +39,10 @@ class ChipSelectLinesLock:
             return ret
         ret = self._lines_locks[line].acquire()
         if not ret:
+            self._lock.release()
             return ret
+        if self._num_lockings == 0:
+            self._owner = (threading.current_thread().name, line, time.monotonic())
         self._num_lockings += 1
         self._current_line = line
         self._lines[self._current_line].off()
@@ -62,8 +70,11 @@ class ChipSelectLinesLock:
             self._lines[line].on()
             # print(self._num_lockings, [v.value for v in self._lines])
             self._current_line = None
+            self._owner = None
         self._lines_locks[line].release()
-        # self._lock.release()
+        # Readers are set up on one thread and polled on another, a bus left held
+        # here would never be selectable again
+        self._lock.release()
         # print(
         #     "Release After: ",
         #     self._num_lockings,
@@ -71,6 +82,10 @@ class ChipSelectLinesLock:
         #     [v.value for v in self._lines],
         # )
 
+    def owner(self) -> tuple[str, int, float] | None:
+        """The thread holding a line, the line, and since when (for stall reports)."""
+        return self._owner
+
     def individual_line_lock(self, line: int):
         return ChipSelectLineLock(self, line)
 
@@ -0,0 +1,100 @@
+"""
+Measures login bursts: N callers check a password at the same moment, as
+when a shift starts, through a PasswordVerifier set up like main.py's.
+
+    python password_benchmark.py [--callers 1 4 16 64] [--cost 10]
+
+Reports the p50/p99 latency of check() over the callers that got an answer,
+and how many were told the verifier was busy. The cache is off, every caller
+checks a hash of its own.
+"""
+
+import argparse
+import threading
+import time
+
+import bcrypt
+
+from password_verifier import PasswordVerifier, PasswordVerifierBusy
+
+# main.py's PASSWORD_CHECK_WORKERS, _MAX_IN_FLIGHT and _QUEUE_TIMEOUT_S
+DEFAULT_WORKERS = 2
+DEFAULT_MAX_IN_FLIGHT = 8
+DEFAULT_QUEUE_TIMEOUT_S = 5
+
+
+def _percentile_ms(samples: list[float], q: float) -> float:
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(q * len(samples)))] * 1e3
+
+
+def burst(
+    verifier: PasswordVerifier, hashed_passwords: list[str]
+) -> tuple[list[float], int]:
+    """Latencies of the answered checks, and the number of busy ones."""
+    barrier = threading.Barrier(len(hashed_passwords))
+    latencies: list[float] = []
+    busy = 0
+    lock = threading.Lock()
+
+    def login(i: int):
+        nonlocal busy
+        barrier.wait()
+        start = time.perf_counter()
+        try:
+            assert verifier.check(f"user{i}", "password", hashed_passwords[i])
+        except PasswordVerifierBusy:
+            with lock:
+                busy += 1
+            return
+        with lock:
+            latencies.append(time.perf_counter() - start)
+
+    threads = [
+        threading.Thread(target=login, args=(i,)) for i in range(len(hashed_passwords))
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return latencies, busy
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Measure password check latency under concurrent logins."
+    )
+    parser.add_argument("--callers", type=int, nargs="+", default=[1, 4, 16, 64])
+    parser.add_argument("--cost", type=int, default=10)
+    parser.add_argument("--workers", type=int, default=DEFAULT_WORKERS)
+    parser.add_argument("--max-in-flight", type=int, default=DEFAULT_MAX_IN_FLIGHT)
+    parser.add_argument("--queue-timeout", type=float, default=DEFAULT_QUEUE_TIMEOUT_S)
+    args = parser.parse_args()
+
+    verifier = PasswordVerifier(
+        max_workers=args.workers,
+        max_in_flight=args.max_in_flight,
+        queue_timeout_s=args.queue_timeout,
+    )
+    verifier.start()
+    hashed_passwords = [
+        bcrypt.hashpw(b"password", bcrypt.gensalt(args.cost)).decode()
+        for _ in range(max(args.callers))
+    ]
+    print(f"{'callers':>7} {'p50':>10} {'p99':>10} {'busy':>5}")
+    for callers in args.callers:
+        latencies, busy = burst(verifier, hashed_passwords[:callers])
+        p50 = f"{_percentile_ms(latencies, 0.5):7.1f} ms" if latencies else f"{'-':>10}"
+        p99 = (
+            f"{_percentile_ms(latencies, 0.99):7.1f} ms" if latencies else f"{'-':>10}"
+        )
+        print(f"{callers:>7} {p50} {p99} {busy:>5}")
+    print(
+        f"(cost {args.cost}, {args.workers} workers, {args.max_in_flight} in flight,"
+        f" {args.queue_timeout}s queue timeout)"
+    )
+    verifier.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,221 @@
+from concurrent.futures import Future, ProcessPoolExecutor, TimeoutError
+import hashlib
+import hmac
+import json
+import logging
+import math
+import multiprocessing
+import os
+import platform
+import secrets
+from threading import BoundedSemaphore, Lock
+import time
+
+import bcrypt
+
+from logger_instance import logger
+from metrics import metrics
+
+# Never calibrate below this, whatever the hardware
+MIN_BCRYPT_COST = 10
+MAX_BCRYPT_COST = 16
+
+BCRYPT_CHECK_SECONDS = metrics.histogram(
+    "key_guard_bcrypt_check_seconds",
+    "Duration of one bcrypt password check, waiting for a slot and a worker"
+    " included. Checks given up on as busy are not counted.",
+)
+
+# Cheap enough to time on any device, the result is extrapolated from it
+_PROBE_BCRYPT_COST = 6
+
+
+class PasswordVerifierBusy(Exception):
+    """Raised when a verification could not finish within the queue timeout."""
+
+
+def _checkpw(plain_text_password: bytes, hashed_password: bytes) -> bool:
+    return bcrypt.checkpw(plain_text_password, hashed_password)
+
+
+class PasswordVerifier:
+    """
+    Runs bcrypt verifications on a process pool.
+
+    At most max_in_flight verifications run or wait at a time, and a caller
+    whose verification has not finished within queue_timeout_s (waiting for a
+    slot and then for a worker) gets PasswordVerifierBusy.
+    Successful verifications can be remembered for cache_ttl_s, keyed by an
+    HMAC of (username, password, stored hash) under a per-process random key,
+    so neither the password nor anything reversible to it is kept.
+    """
+
+    queue_timeout_s: float | int
+    cache_ttl_s: float | int
+    max_cache_entries: int
+    _pool: ProcessPoolExecutor
+    _slots: BoundedSemaphore
+    _cache_key: bytes
+    _cache: dict[bytes, float]
+    _cache_lock: Lock
+
+    def __init__(
+        self,
+        *,
+        max_workers: int,
+        max_in_flight: int,
+        queue_timeout_s: float | int,
+        cache_ttl_s: float | int = 0,
+        max_cache_entries: int = 1024,
+    ):
+        # Fork so the workers don't re-import main.py (forkserver and spawn run
+        # it again), they only ever run _checkpw. See start() for when.
+        self._pool = ProcessPoolExecutor(
+            max_workers=max_workers, mp_context=multiprocessing.get_context("fork")
+        )
+        self._slots = BoundedSemaphore(max_in_flight)
+        self.queue_timeout_s = queue_timeout_s
+        self.cache_ttl_s = cache_ttl_s
+        self.max_cache_entries = max_cache_entries
+        self._cache_key = secrets.token_bytes(32)
+        self._cache = {}
+        self._cache_lock = Lock()
+
+    def start(self):
+        """
+        Forks every worker now. Otherwise the first login would fork them from
+        a websocket thread, into children inheriting whatever locks the other
+        threads hold at that moment. Call it before starting any threads.
+        """
+        # A fork pool starts all of its workers on the first submit
+        self._pool.submit(int).result()
+
+    def _cache_tag(self, username: str, password: str, hashed_password: str) -> bytes:
+        msg = b"\0".join(
+            (username.encode(), password.encode(), hashed_password.encode())
+        )
+        return hmac.new(self._cache_key, msg, hashlib.sha256).digest()
+
+    def _is_cached(self, tag: bytes) -> bool:
+        with self._cache_lock:
+            expires_at = self._cache.get(tag)
+            if expires_at is None:
+                return False
+            if time.monotonic() >= expires_at:
+                del self._cache[tag]
+                return False
+            return True
+
+    def _remember(self, tag: bytes):
+        now = time.monotonic()
+        with self._cache_lock:
+            if len(self._cache) >= self.max_cache_entries:
+                self._cache = {t: e for t, e in self._cache.items() if e > now}
+                # Still full of live entries, drop the oldest
+                while len(self._cache) >= self.max_cache_entries:
+                    del self._cache[next(iter(self._cache))]
+            self._cache[tag] = now + self.cache_ttl_s
+
+    def check(self, username: str, password: str, hashed_password: str) -> bool:
+        """Blocks the calling thread (only) until the hash has been verified."""
+        tag = None
+        if self.cache_ttl_s > 0:
+            tag = self._cache_tag(username, password, hashed_password)
+            if self._is_cached(tag):
+                return True
+        # Timed from here, waiting for a slot counts
+        start = time.perf_counter()
+        deadline = time.monotonic() + self.queue_timeout_s
+        if not self._slots.acquire(timeout=self.queue_timeout_s):
+            raise PasswordVerifierBusy()
+        try:
+            future = self._pool.submit(
+                _checkpw, password.encode(), hashed_password.encode()
+            )
+        except BaseException:
+            self._slots.release()
+            raise
+        # Held until the worker is done, a check given up on still occupies it
+        future.add_done_callback(self._release_slot)
+        try:
+            ok = future.result(timeout=max(0, deadline - time.monotonic()))
+        except TimeoutError:
+            future.cancel()
+            raise PasswordVerifierBusy() from None
+        BCRYPT_CHECK_SECONDS.observe(time.perf_counter() - start)
+        if ok and tag is not None:
+            self._remember(tag)
+        return ok
+
+    def _release_slot(self, future: Future):
+        self._slots.release()
+
+    def shutdown(self):
+        self._pool.shutdown(wait=False, cancel_futures=True)
+
+
+def measure_checkpw_s(cost: int, samples: int = 3) -> float:
+    hashed_password = bcrypt.hashpw(b"calibration", bcrypt.gensalt(cost))
+    best = math.inf
+    for _ in range(samples):
+        start = time.perf_counter()
+        bcrypt.checkpw(b"calibration", hashed_password)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def calibrate_bcrypt_cost(
+    target_s: float | int,
+    min_cost: int = MIN_BCRYPT_COST,
+    max_cost: int = MAX_BCRYPT_COST,
+) -> tuple[int, float]:
+    """
+    Returns the highest work factor whose checkpw takes at most target_s on
+    this device (but at least min_cost), and how long a check then takes.
+    """
+    # Each step of the cost doubles the work, so estimate from a cheap probe
+    probe_s = measure_checkpw_s(_PROBE_BCRYPT_COST)
+    cost = _PROBE_BCRYPT_COST + math.floor(math.log2(target_s / probe_s))
+    cost = max(min_cost, min(max_cost, cost))
+    checkpw_s = measure_checkpw_s(cost, samples=1)
+    while checkpw_s > target_s and cost > min_cost:
+        cost -= 1
+        checkpw_s = measure_checkpw_s(cost, samples=1)
+    return cost, checkpw_s
+
+
+def load_bcrypt_cost(calibration_file: str | os.PathLike, target_s: float | int) -> int:
+    """
+    Returns the work factor recorded in calibration_file, calibrating (and
+    recording) it first if the file is missing, was made for another target
+    or on other hardware.
+    """
+    machine = platform.platform()
+    try:
+        with open(calibration_file) as f:
+            recorded = json.load(f)
+        if recorded["targetS"] == target_s and recorded["machine"] == machine:
+            return recorded["cost"]
+    except (OSError, ValueError, KeyError, TypeError):
+        pass
+    cost, checkpw_s = calibrate_bcrypt_cost(target_s)
+    logger.log(
+        logging.INFO,
+        "Calibrated bcrypt cost {0}, a password check takes {1:.3f}s",
+        cost,
+        checkpw_s,
+    )
+    try:
+        with open(calibration_file, "w") as f:
+            json.dump(
+                {
+                    "cost": cost,
+                    "checkpwS": checkpw_s,
+                    "targetS": target_s,
+                    "machine": machine,
+                },
+                f,
+            )
+    except OSError as ex:
+        logger.log(logging.WARNING, "Could not record the bcrypt cost: {0}", ex)
+    return cost
@@ -0,0 +1,208 @@
+import asyncio
+import time
+from collections.abc import Awaitable, Callable
+from dataclasses import dataclass
+from typing import Protocol
+
+from metrics import metrics
+from stall_watchdog import StallWatchdog
+
+TICK_SECONDS = metrics.histogram(
+    "key_guard_tick_seconds", "Duration of one store tick.", label="store"
+)
+LOOP_PERIOD_SECONDS = metrics.histogram(
+    "key_guard_loop_period_seconds", "Time between poll loop iterations."
+)
+
+
+class PolledStore(Protocol):
+    @property
+    def is_active(self) -> bool: ...
+
+    @property
+    def state_version(self) -> int: ...
+
+    def tick(self) -> None: ...
+
+    # tick() split in two for the asyncio mode, tick() is process_card(read_card())
+    def read_card(self) -> str | None: ...
+
+    def process_card(self, card_id: str | None) -> None: ...
+
+
+@dataclass
+class _PollEntry:
+    store: PolledStore
+    active_interval_s: float
+    idle_interval_s: float
+    max_interval_s: float
+    next_tick_at: float = 0.0
+    last_version: int = -1
+    name: str = ""
+
+
+class PollScheduler:
+    """
+    Ticks each store at a cadence picked from its current state.
+
+    Active stores (a user session, an unlocked slot, a pending relock or theft
+    decision) are polled at their active interval. Idle stores are polled at
+    their idle interval, which is stretched by a growing backoff factor the
+    longer the whole cabinet stays idle, but never beyond the store's
+    max_interval_s (e.g. the theft detection latency budget for key slots).
+    """
+
+    _entries: list[_PollEntry]
+    _housekeeping: list[Callable[[], None]]
+    idle_backoff_after_s: float
+    idle_backoff_factor: float
+    min_sleep_s: float
+    _backoff: float
+    _max_backoff: float
+    _next_backoff_at: float
+    _last_run_at: float | None = None
+    watchdog: StallWatchdog | None
+
+    def __init__(
+        self,
+        *,
+        idle_backoff_after_s: float | int,
+        idle_backoff_factor: float | int,
+        min_sleep_s: float | int,
+        watchdog: StallWatchdog | None = None,
+    ):
+        self._entries = []
+        self._housekeeping = []
+        self.idle_backoff_after_s = idle_backoff_after_s
+        self.idle_backoff_factor = idle_backoff_factor
+        self.min_sleep_s = min_sleep_s
+        self.watchdog = watchdog
+        self._backoff = 1.0
+        self._max_backoff = 1.0
+        self._next_backoff_at = time.monotonic() + idle_backoff_after_s
+
+    def add(
+        self,
+        store: PolledStore,
+        *,
+        active_interval_s: float | int,
+        idle_interval_s: float | int,
+        max_interval_s: float | int,
+        name: str | None = None,
+    ):
+        assert 0 <= active_interval_s <= idle_interval_s <= max_interval_s
+        assert idle_interval_s > 0
+        self._max_backoff = max(self._max_backoff, max_interval_s / idle_interval_s)
+        self._entries.append(
+            _PollEntry(
+                store=store,
+                active_interval_s=active_interval_s,
+                idle_interval_s=idle_interval_s,
+                max_interval_s=max_interval_s,
+                name=name if name is not None else type(store).__name__,
+            )
+        )
+
+    def add_housekeeping(self, func: Callable[[], None]):
+        """Registers a cheap callback run once per loop iteration."""
+        self._housekeeping.append(func)
+
+    def _interval_for(self, entry: _PollEntry) -> float:
+        if entry.store.is_active:
+            return entry.active_interval_s
+        return min(entry.idle_interval_s * self._backoff, entry.max_interval_s)
+
+    def _note_activity(self, now: float):
+        self._backoff = 1.0
+        self._next_backoff_at = now + self.idle_backoff_after_s
+
+    def _start_iteration(self) -> float:
+        now = time.monotonic()
+        if self._last_run_at is not None:
+            LOOP_PERIOD_SECONDS.observe(now - self._last_run_at)
+        self._last_run_at = now
+        if self.watchdog is not None:
+            self.watchdog.loop_started()
+        return now
+
+    def _tick_started(self, entry: _PollEntry):
+        if self.watchdog is not None:
+            self.watchdog.tick_started(entry.name)
+
+    def _tick_finished(self, entry: _PollEntry, ticked_at: float) -> tuple[float, bool]:
+        """Returns the time now and whether the store's state changed."""
+        if self.watchdog is not None:
+            self.watchdog.tick_finished()
+        now = time.monotonic()
+        TICK_SECONDS.observe(now - ticked_at, entry.name)
+        changed = False
+        version = entry.store.state_version
+        if version != entry.last_version:
+            entry.last_version = version
+            changed = True
+        entry.next_tick_at = now + self._interval_for(entry)
+        return now, changed
+
+    def _defer_tick(self, entry: _PollEntry, now: float):
+        # Pull the next tick in if the store went active in the meantime
+        entry.next_tick_at = min(entry.next_tick_at, now + self._interval_for(entry))
+
+    def _finish_iteration(self, now: float, any_active: bool) -> float:
+        """Returns how long to sleep before the next iteration."""
+        for func in self._housekeeping:
+            func()
+
+        if any_active:
+            self._note_activity(now)
+        elif now >= self._next_backoff_at:
+            self._backoff = min(
+                self._backoff * self.idle_backoff_factor, self._max_backoff
+            )
+            self._next_backoff_at = now + self.idle_backoff_after_s
+
+        next_tick_at = min(entry.next_tick_at for entry in self._entries)
+        return max(next_tick_at - time.monotonic(), self.min_sleep_s)
+
+    def run_once(self):
+        now = self._start_iteration()
+        any_active = False
+        for entry in self._entries:
+            if now >= entry.next_tick_at:
+                self._tick_started(entry)
+                entry.store.tick()
+                now, changed = self._tick_finished(entry, now)
+                any_active = any_active or changed
+            else:
+                self._defer_tick(entry, now)
+            any_active = any_active or entry.store.is_active
+        time.sleep(self._finish_iteration(now, any_active))
+
+    def run_forever(self):
+        while True:
+            self.run_once()
+
+    async def run_once_async(
+        self, read_card: Callable[[PolledStore], Awaitable[str | None]]
+    ):
+        """
+        Like run_once, but only the card read blocks, and it is awaited (e.g. in
+        an executor). The rest of each tick runs on the event loop.
+        """
+        now = self._start_iteration()
+        any_active = False
+        for entry in self._entries:
+            if now >= entry.next_tick_at:
+                self._tick_started(entry)
+                entry.store.process_card(await read_card(entry.store))
+                now, changed = self._tick_finished(entry, now)
+                any_active = any_active or changed
+            else:
+                self._defer_tick(entry, now)
+            any_active = any_active or entry.store.is_active
+        await asyncio.sleep(self._finish_iteration(now, any_active))
+
+    async def run_forever_async(
+        self, read_card: Callable[[PolledStore], Awaitable[str | None]]
+    ):
+        while True:
+            await self.run_once_async(read_card)
@@ -0,0 +1,74 @@
+"""
+Measures the cost of one empty-field read_id, as an idle slot or user reader
+polls it, on a simulated MFRC522 with no card in its field.
+
+    python reader_benchmark.py [--reads 200] [--timeout 0.1]
+                               [--timer-ms 15] [--xfer-us 30]
+
+Two chips are simulated. "spi only" answers at once, so only the driver's
+own overhead is measured. "modeled" raises TimerIRq timer-ms after an
+unanswered request, as initialize's TReload of 30 at a prescaler of 0xD3E
+does, and keeps the CPU busy xfer-us per SPI transfer. The default of 30 us
+is an estimate of a 2 byte spidev transfer at 1 MHz. Measure your device
+before relying on the modeled figures.
+
+The timeout is main.py's READER_TIMEOUT_S. The CPU share is one reader's,
+polled every LOCKED_SLOT_POLL_INTERVAL_S.
+"""
+
+import argparse
+import logging
+import time
+
+from simulated_mfrc522 import SimulatedSpi, simulated_reader
+
+# main.py's READER_TIMEOUT_S and LOCKED_SLOT_POLL_INTERVAL_S
+DEFAULT_TIMEOUT_S = 0.1
+POLL_INTERVAL_S = 0.25
+# 30 timer ticks at 13.56 MHz / (2 * 0xD3E + 1)
+DEFAULT_TIMER_MS = 15
+DEFAULT_XFER_US = 30
+
+
+def _measure(spi: SimulatedSpi, reads: int, timeout: float) -> tuple[float, float]:
+    """Wall and CPU seconds per read."""
+    reader = simulated_reader(spi)
+    # Warms up the buffers and imports
+    reader.read_id(timeout=timeout)
+    wall = time.perf_counter()
+    cpu = time.process_time()
+    for _ in range(reads):
+        assert reader.read_id(timeout=timeout) is None
+    return (
+        (time.perf_counter() - wall) / reads,
+        (time.process_time() - cpu) / reads,
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Measure the CPU cost of polling an empty reader."
+    )
+    parser.add_argument("--reads", type=int, default=200)
+    parser.add_argument("--timeout", type=float, default=DEFAULT_TIMEOUT_S)
+    parser.add_argument("--timer-ms", type=float, default=DEFAULT_TIMER_MS)
+    parser.add_argument("--xfer-us", type=float, default=DEFAULT_XFER_US)
+    args = parser.parse_args()
+
+    logging.getLogger("mfrc522Logger").setLevel(logging.ERROR)
+    chips = {
+        "spi only": SimulatedSpi(),
+        "modeled": SimulatedSpi(timer_s=args.timer_ms / 1e3, xfer_s=args.xfer_us / 1e6),
+    }
+    print(f"{'chip':>8} {'wall/read':>11} {'cpu/read':>11} {'core share':>11}")
+    for name, spi in chips.items():
+        wall_s, cpu_s = _measure(spi, args.reads, args.timeout)
+        print(
+            f"{name:>8} {wall_s * 1e3:8.3f} ms {cpu_s * 1e3:8.3f} ms"
+            f" {min(1.0, cpu_s / POLL_INTERVAL_S) * 100:9.2f} %"
+        )
+    print(f"(one reader polled every {POLL_INTERVAL_S}s)")
+
+
+if __name__ == "__main__":
+    main()
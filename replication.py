@@ -0,0 +1,380 @@
+from collections import deque
+from collections.abc import Callable
+from dataclasses import asdict, dataclass
+import json
+import logging
+import os
+import secrets
+import socket
+import ssl
+import threading
+import time
+from typing import Any, Literal, Protocol
+
+from data_objects import KeyData, UserData
+from database import DatabaseChange, DatabaseState, KeysDB, UsersDB, shared_state
+from event import Event
+from logger_instance import logger
+
+
+@dataclass(frozen=True)
+class ChangeOp:
+    op: Literal["upsert"] | Literal["delete"]
+    kind: Literal["key"] | Literal["user"]
+    id: str
+    # Every field of the record for upserts, grants travel in the user's authorized_for
+    record: dict[str, Any] | None = None
+
+
+@dataclass(frozen=True)
+class ChangeSet:
+    seq: int
+    ops: tuple[ChangeOp, ...]
+
+
+def _key_from_record(record: dict[str, Any]) -> KeyData:
+    return KeyData(**record)
+
+
+def _user_from_record(record: dict[str, Any]) -> UserData:
+    return UserData(**{**record, "authorized_for": tuple(record["authorized_for"])})
+
+
+def apply_change_ops(keys_db: KeysDB, users_db: UsersDB, ops: list[ChangeOp]):
+    """Applies a change set's ops, keys first so new grants resolve."""
+    key_upserts = [
+        _key_from_record(v.record) for v in ops if v.kind == "key" and v.op == "upsert"
+    ]
+    key_deletes = [v.id for v in ops if v.kind == "key" and v.op == "delete"]
+    user_upserts = [
+        _user_from_record(v.record)
+        for v in ops
+        if v.kind == "user" and v.op == "upsert"
+    ]
+    user_deletes = [v.id for v in ops if v.kind == "user" and v.op == "delete"]
+    shared_state(keys_db, users_db).apply(
+        key_upserts=key_upserts,
+        key_ids_removed=key_deletes,
+        user_upserts=user_upserts,
+        user_ids_removed=user_deletes,
+    )
+
+
+class ReplicationTransport(Protocol):
+    def send(self, message: dict) -> None: ...
+
+    def receive(self) -> dict | None: ...
+
+    def close(self) -> None: ...
+
+
+class SocketTransport:
+    """Newline delimited JSON over a connected stream socket (TCP, TLS or a socketpair)."""
+
+    _sock: socket.socket
+    _send_lock: threading.Lock
+
+    def __init__(self, sock: socket.socket):
+        self._sock = sock
+        self._reader = sock.makefile("r", encoding="utf-8")
+        self._send_lock = threading.Lock()
+
+    def send(self, message: dict):
+        data = (json.dumps(message) + "\n").encode()
+        with self._send_lock:
+            self._sock.sendall(data)
+
+    def receive(self) -> dict | None:
+        line = self._reader.readline()
+        if not line:
+            return None
+        return json.loads(line)
+
+    def close(self):
+        self._reader.close()
+        self._sock.close()
+
+
+def _change_ops(change: DatabaseChange) -> list[ChangeOp]:
+    return [
+        *(
+            ChangeOp(op="upsert", kind="key", id=v.id, record=asdict(v))
+            for v in change.key_upserts
+        ),
+        *(ChangeOp(op="delete", kind="key", id=v) for v in change.key_ids_removed),
+        *(
+            ChangeOp(op="upsert", kind="user", id=v.id, record=asdict(v))
+            for v in change.user_upserts
+        ),
+        *(ChangeOp(op="delete", kind="user", id=v) for v in change.user_ids_removed),
+    ]
+
+
+def _change_set_message(epoch: str, change_set: ChangeSet) -> dict:
+    return {
+        "type": "changes",
+        "epoch": epoch,
+        "seq": change_set.seq,
+        "ops": [asdict(v) for v in change_set.ops],
+    }
+
+
+class ReplicationPrimary:
+    """
+    Publishes numbered change sets of the local database to replicas.
+
+    Every change of the local database (a commit or a reload) becomes a change
+    set as it is made, carrying only the changed records. The last log_size
+    change sets are kept so a reconnecting replica only receives what it
+    missed. A replica that is further behind, new, or that
+    last followed another run of the primary (a different epoch) gets a full
+    snapshot instead.
+    """
+
+    keys_db: KeysDB
+    users_db: UsersDB
+    state: DatabaseState
+    epoch: str
+    _seq: int
+    _log: deque[ChangeSet]
+    _replicas: list[ReplicationTransport]
+    _lock: threading.RLock
+
+    def __init__(self, *, log_size: int, keys_db: KeysDB, users_db: UsersDB):
+        self.keys_db = keys_db
+        self.users_db = users_db
+        self.state = shared_state(keys_db, users_db)
+        self.epoch = secrets.token_hex(8)
+        self._seq = 0
+        self._log = deque(maxlen=log_size)
+        self._replicas = []
+        self._lock = threading.RLock()
+        self.state.changed.add_listener(self._on_changed)
+
+    def _on_changed(self, state: DatabaseState, change: DatabaseChange):
+        # Under the state's lock, so change sets are numbered in the order applied
+        ops = _change_ops(change)
+        with self._lock:
+            self._seq += 1
+            change_set = ChangeSet(seq=self._seq, ops=tuple(ops))
+            self._log.append(change_set)
+            message = _change_set_message(self.epoch, change_set)
+            for replica in list(self._replicas):
+                self._send_or_drop(replica, message)
+
+    def _send_or_drop(self, replica: ReplicationTransport, message: dict):
+        try:
+            replica.send(message)
+        except OSError as ex:
+            logger.log(logging.WARNING, "Dropping replica: {0}", ex)
+            self._replicas.remove(replica)
+            replica.close()
+
+    def _catch_up(
+        self, replica: ReplicationTransport, epoch: str | None, last_seq: int
+    ):
+        with self._lock:
+            if replica not in self._replicas:
+                self._replicas.append(replica)
+            if epoch == self.epoch and last_seq == self._seq:
+                return
+            if (
+                epoch == self.epoch
+                and last_seq < self._seq
+                and len(self._log) != 0
+                and self._log[0].seq <= last_seq + 1
+            ):
+                for change_set in self._log:
+                    if change_set.seq > last_seq:
+                        self._send_or_drop(
+                            replica, _change_set_message(self.epoch, change_set)
+                        )
+                return
+            # May already hold a change that isn't numbered yet, the replica
+            # applies it once more when it arrives, which changes nothing
+            keys, users = self.state.records()
+            self._send_or_drop(
+                replica,
+                {
+                    "type": "snapshot",
+                    "epoch": self.epoch,
+                    "seq": self._seq,
+                    "keys": [asdict(v) for v in keys],
+                    "users": [asdict(v) for v in users],
+                },
+            )
+
+    def attach(self, replica: ReplicationTransport):
+        """Serves one replica until it disconnects, blocks the calling thread."""
+        try:
+            while (message := replica.receive()) is not None:
+                match message:
+                    case {"type": "hello", "lastSeq": int(last_seq)}:
+                        self._catch_up(replica, message.get("epoch"), last_seq)
+        except (OSError, ValueError) as ex:
+            logger.log(logging.WARNING, "Replica connection failed: {0}", ex)
+        finally:
+            with self._lock:
+                if replica in self._replicas:
+                    self._replicas.remove(replica)
+            replica.close()
+
+    def _accept_tls(self, conn: socket.socket, addr: Any, ssl_context: ssl.SSLContext):
+        # On the connection's own thread, so a stalled handshake holds up no one else
+        try:
+            conn = ssl_context.wrap_socket(conn, server_side=True)
+        except (OSError, ssl.SSLError) as ex:
+            logger.log(logging.WARNING, "Replica {0} rejected: {1}", addr, ex)
+            conn.close()
+            return
+        logger.log(logging.INFO, "Replica connected: {0}", addr)
+        self.attach(SocketTransport(conn))
+
+    def serve_tcp(self, host: str, port: int, ssl_context: ssl.SSLContext):
+        """
+        Accepts replicas over mutually authenticated TLS, blocks the calling
+        thread. A snapshot holds every password hash, so ssl_context must
+        require a client certificate (see load_primary_ssl_context).
+        """
+        if ssl_context.verify_mode != ssl.CERT_REQUIRED:
+            raise ValueError("Replicas must authenticate with a client certificate")
+        with socket.create_server((host, port)) as server:
+            while True:
+                conn, addr = server.accept()
+                threading.Thread(
+                    target=self._accept_tls,
+                    args=(conn, addr, ssl_context),
+                    daemon=True,
+                ).start()
+
+
+class ReplicationReplica:
+    """
+    Follows a primary, applying its change sets to the local indexes.
+
+    Change sets are applied in sequence order and are idempotent: ones already
+    applied are skipped, and a gap makes the replica ask to catch up again.
+    """
+
+    keys_db: KeysDB
+    users_db: UsersDB
+    state: DatabaseState
+    connect: Callable[[], ReplicationTransport]
+    retry_interval_s: float | int
+    applied: Event["ReplicationReplica", int]
+    epoch: str | None = None
+    applied_seq: int = -1
+
+    def __init__(
+        self,
+        *,
+        connect: Callable[[], ReplicationTransport],
+        retry_interval_s: float | int,
+        keys_db: KeysDB,
+        users_db: UsersDB,
+    ):
+        self.connect = connect
+        self.retry_interval_s = retry_interval_s
+        self.keys_db = keys_db
+        self.users_db = users_db
+        self.state = shared_state(keys_db, users_db)
+        self.applied = Event(self)
+
+    def _hello(self, transport: ReplicationTransport):
+        transport.send(
+            {"type": "hello", "epoch": self.epoch, "lastSeq": self.applied_seq}
+        )
+
+    def handle(self, transport: ReplicationTransport, message: dict):
+        match message:
+            case {"type": "snapshot", "epoch": str(epoch), "seq": int(seq)}:
+                keys = [_key_from_record(v) for v in message["keys"]]
+                users = [_user_from_record(v) for v in message["users"]]
+                self.state.reload(keys, users)
+                self.epoch = epoch
+                self.applied_seq = seq
+                self.applied.trigger(seq)
+            case {"type": "changes", "epoch": str(epoch), "seq": int(seq)}:
+                if epoch != self.epoch or seq > self.applied_seq + 1:
+                    # Missed something, or the primary restarted
+                    self._hello(transport)
+                elif seq == self.applied_seq + 1:
+                    apply_change_ops(
+                        self.keys_db,
+                        self.users_db,
+                        [ChangeOp(**v) for v in message["ops"]],
+                    )
+                    self.applied_seq = seq
+                    self.applied.trigger(seq)
+
+    def run_once(self):
+        transport = self.connect()
+        try:
+            self._hello(transport)
+            while (message := transport.receive()) is not None:
+                try:
+                    self.handle(transport, message)
+                except Exception as ex:
+                    # e.g. a malformed record. Nothing of the message was applied,
+                    # the hello after reconnecting catches up from applied_seq.
+                    logger.log(
+                        logging.ERROR,
+                        "Applying a replication message failed, reconnecting: {0}",
+                        ex,
+                    )
+                    return
+        finally:
+            transport.close()
+
+    def run(self):
+        while True:
+            try:
+                self.run_once()
+            except Exception as ex:
+                logger.log(logging.WARNING, "Replication connection failed: {0}", ex)
+            time.sleep(self.retry_interval_s)
+
+    def start(self):
+        threading.Thread(target=self.run, name="Replication", daemon=True).start()
+
+
+def connect_tcp(host: str, port: int, ssl_context: ssl.SSLContext) -> SocketTransport:
+    sock = socket.create_connection((host, port))
+    try:
+        sock = ssl_context.wrap_socket(sock, server_hostname=host)
+    except (OSError, ssl.SSLError):
+        sock.close()
+        raise
+    return SocketTransport(sock)
+
+
+def load_primary_ssl_context(
+    pem_file: str | os.PathLike,
+    private_key_file: str | os.PathLike,
+    pem_file_password: str,
+    replica_ca_file: str | os.PathLike,
+) -> ssl.SSLContext:
+    """Only replicas with a certificate issued by replica_ca_file get through."""
+    ssl_context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    ssl_context.load_cert_chain(
+        pem_file, keyfile=private_key_file, password=pem_file_password
+    )
+    ssl_context.verify_mode = ssl.CERT_REQUIRED
+    ssl_context.load_verify_locations(cafile=replica_ca_file)
+    return ssl_context
+
+
+def load_replica_ssl_context(
+    primary_pem_file: str | os.PathLike,
+    pem_file: str | os.PathLike,
+    private_key_file: str | os.PathLike,
+    pem_file_password: str,
+) -> ssl.SSLContext:
+    """Trusts the primary's (self-signed) certificate and presents the replica's."""
+    ssl_context = ssl.create_default_context(cafile=primary_pem_file)
+    # Cabinets are addressed by IP, the primary's certificate is pinned instead
+    ssl_context.check_hostname = False
+    ssl_context.load_cert_chain(
+        pem_file, keyfile=private_key_file, password=pem_file_password
+    )
+    return ssl_context
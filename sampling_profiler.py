@@ -0,0 +1,131 @@
+import os
+import sys
+import threading
+import time
+from types import CodeType, FrameType
+
+# Stacks past this many distinct ones are counted under OTHER_STACK
+DEFAULT_MAX_STACKS = 5000
+# Deeper stacks keep their innermost frames
+DEFAULT_MAX_DEPTH = 64
+OTHER_STACK = "[other]"
+
+
+class SamplingProfiler:
+    """
+    Samples one thread's stack at a fixed rate into collapsed-stack counts
+    ("outer;...;inner count" per line, as flamegraph.pl and speedscope read).
+
+    Only the sampler thread pays for sampling, the profiled thread runs
+    untouched, so this can be turned on in production. Memory is bounded by
+    max_stacks distinct stacks of at most max_depth frames.
+
+    The sampler needs the GIL to take a sample, so pure-Python stretches
+    shorter than sys.getswitchinterval() are under-sampled, while blocking
+    calls (SPI transfers, sleeps, socket I/O) are seen as they are.
+    """
+
+    thread_id: int
+    max_stacks: int
+    max_depth: int
+    _counts: dict[str, int]
+    _labels: dict[CodeType, str]
+    _samples: int
+    _lock: threading.Lock
+    _stop: threading.Event | None = None
+    _thread: threading.Thread | None = None
+    _rate_hz: float = 0
+
+    def __init__(
+        self,
+        *,
+        thread_id: int,
+        max_stacks: int = DEFAULT_MAX_STACKS,
+        max_depth: int = DEFAULT_MAX_DEPTH,
+    ):
+        self.thread_id = thread_id
+        self.max_stacks = max_stacks
+        self.max_depth = max_depth
+        self._counts = {}
+        self._labels = {}
+        self._samples = 0
+        self._lock = threading.Lock()
+
+    @property
+    def running(self) -> bool:
+        return self._thread is not None
+
+    @property
+    def rate_hz(self) -> float:
+        return self._rate_hz
+
+    @property
+    def samples(self) -> int:
+        return self._samples
+
+    def _label(self, code: CodeType) -> str:
+        label = self._labels.get(code)
+        if label is None:
+            module = os.path.splitext(os.path.basename(code.co_filename))[0]
+            label = self._labels[code] = f"{module}:{code.co_qualname}"
+        return label
+
+    def _sample(self, frame: FrameType):
+        labels = []
+        while frame is not None and len(labels) < self.max_depth:
+            labels.append(self._label(frame.f_code))
+            frame = frame.f_back
+        if frame is not None:
+            labels.append("[truncated]")
+        stack = ";".join(reversed(labels))
+        with self._lock:
+            if stack not in self._counts and len(self._counts) >= self.max_stacks:
+                stack = OTHER_STACK
+            self._counts[stack] = self._counts.get(stack, 0) + 1
+            self._samples += 1
+
+    def _run(self, stop: threading.Event, interval_s: float):
+        next_at = time.monotonic()
+        while not stop.is_set():
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is not None:
+                self._sample(frame)
+            del frame
+            # Keeps the rate when a sample takes a while, without bursts to catch up
+            next_at = max(next_at + interval_s, time.monotonic())
+            stop.wait(next_at - time.monotonic())
+
+    def start(self, rate_hz: float):
+        """Starts sampling, adding to the counts of earlier runs until reset."""
+        if self._thread is not None:
+            self.stop()
+        self._rate_hz = rate_hz
+        self._stop = threading.Event()
+        self._thread = threading.Thread(
+            target=self._run,
+            args=(self._stop, 1 / rate_hz),
+            name="Profiler",
+            daemon=True,
+        )
+        self._thread.start()
+
+    def stop(self):
+        if self._thread is None:
+            return
+        self._stop.set()
+        self._thread.join()
+        self._thread = None
+        self._stop = None
+
+    def reset(self):
+        with self._lock:
+            self._counts = {}
+            self._samples = 0
+
+    def collapsed(self) -> str:
+        with self._lock:
+            counts = list(self._counts.items())
+        return "".join(
+            f"{stack} {count}\n"
+            for stack, count in sorted(counts, key=lambda e: e[1], reverse=True)
+        )
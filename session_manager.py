@@ -0,0 +1,177 @@
+from dataclasses import dataclass
+import datetime
+import hmac
+import secrets
+from threading import RLock
+from typing import Literal
+
+from data_objects import UserData
+from event import Event
+
+
+@dataclass(frozen=True)
+class Session:
+    id: str
+    user: UserData
+    source: Literal["login"] | Literal["card"]
+    expires_at: datetime.datetime
+
+    def __format__(self, format_spec):
+        return f"{self.user} (session={self.id[:8]}, via {self.source})"
+
+
+@dataclass(frozen=True)
+class SessionsState:
+    """An immutable, versioned view of the active sessions, safe to read from any thread."""
+
+    version: int
+    sessions: tuple[Session, ...]
+    # (slot id, session id) pairs of the slots currently claimed
+    slot_claims: tuple[tuple[int, str], ...]
+
+
+class SessionManager:
+    """
+    Tracks several concurrently authenticated users.
+
+    Each session has its own id (carried in the user's JWT) and timeout, and
+    claims the key slots it unlocks. Exclusivity is per slot: a slot claimed by
+    one session cannot be unlocked by another until it relocks, but users
+    wanting different slots no longer wait for each other.
+
+    A JWT is good for one unlock: it carries a nonce, only the latest one
+    issued for the session is accepted, and it is consumed on use.
+    """
+
+    max_sessions: int
+    session_timeout_s: float | int
+    session_started: Event["SessionManager", Session]
+    session_ended: Event[
+        "SessionManager",
+        tuple[Session, Literal["timeout"] | Literal["completed"]],
+    ]
+    # Published snapshot of the sessions, readers on other threads must only use this
+    state: SessionsState
+    _sessions: dict[str, Session]
+    _session_id_by_user_id: dict[str, str]
+    _slot_claims: dict[int, str]
+    # Session id -> nonce of the token that may still be used
+    _token_nonces: dict[str, str]
+    _lock: RLock
+
+    def __init__(self, *, max_sessions: int, session_timeout_s: float | int):
+        self.max_sessions = max_sessions
+        self.session_timeout_s = session_timeout_s
+        self.session_started = Event(self)
+        self.session_ended = Event(self)
+        self.state = SessionsState(version=0, sessions=(), slot_claims=())
+        self._sessions = {}
+        self._session_id_by_user_id = {}
+        self._slot_claims = {}
+        self._token_nonces = {}
+        self._lock = RLock()
+
+    def _publish_state(self):
+        self.state = SessionsState(
+            version=self.state.version + 1,
+            sessions=tuple(self._sessions.values()),
+            slot_claims=tuple(self._slot_claims.items()),
+        )
+
+    def start_session(
+        self, user: UserData, source: Literal["login"] | Literal["card"]
+    ) -> Session | None:
+        """Returns the user's session, or None if the cabinet has no free session."""
+        self.expire_sessions()
+        with self._lock:
+            existing = self.session_for_user(user)
+            if existing is not None:
+                return existing
+            if len(self._sessions) >= self.max_sessions:
+                return None
+            session = Session(
+                id=secrets.token_urlsafe(16),
+                user=user,
+                source=source,
+                expires_at=datetime.datetime.now()
+                + datetime.timedelta(seconds=self.session_timeout_s),
+            )
+            self._sessions[session.id] = session
+            self._session_id_by_user_id[user.id] = session.id
+            self._publish_state()
+        self.session_started.trigger(session)
+        return session
+
+    def get(self, session_id: str) -> Session | None:
+        session = self._sessions.get(session_id)
+        if session is None or datetime.datetime.now() >= session.expires_at:
+            return None
+        return session
+
+    def session_for_user(self, user: UserData) -> Session | None:
+        session_id = self._session_id_by_user_id.get(user.id)
+        return self.get(session_id) if session_id is not None else None
+
+    def issue_token_nonce(self, session: Session) -> str:
+        """A nonce for a new token of the session, the session's older tokens stop working."""
+        nonce = secrets.token_urlsafe(16)
+        with self._lock:
+            if session.id in self._sessions:
+                self._token_nonces[session.id] = nonce
+        return nonce
+
+    def consume_token_nonce(self, session_id: str, nonce: str) -> bool:
+        """Whether the nonce is the session's latest, which it no longer is afterwards."""
+        with self._lock:
+            expected = self._token_nonces.get(session_id)
+            if expected is None or not hmac.compare_digest(expected, nonce):
+                return False
+            del self._token_nonces[session_id]
+            return True
+
+    def claim_slot(self, session: Session, slot_id: int) -> bool:
+        """Claims the slot for the session, fails if another session holds it."""
+        with self._lock:
+            holder = self._slot_claims.get(slot_id)
+            if holder is not None and holder != session.id:
+                return False
+            if session.id not in self._sessions:
+                return False
+            self._slot_claims[slot_id] = session.id
+            self._publish_state()
+            return True
+
+    def release_slot(self, slot_id: int, end_idle_session: bool = True):
+        """Releases the slot's claim, ending its session once it holds no other slot."""
+        with self._lock:
+            session_id = self._slot_claims.pop(slot_id, None)
+            if session_id is None:
+                return
+            ended = None
+            if end_idle_session and session_id not in self._slot_claims.values():
+                ended = self._remove_session(session_id)
+            self._publish_state()
+        if ended is not None:
+            self.session_ended.trigger((ended, "completed"))
+
+    def expire_sessions(self):
+        now = datetime.datetime.now()
+        if not any(now >= s.expires_at for s in self.state.sessions):
+            return
+        with self._lock:
+            expired = [
+                self._remove_session(s.id)
+                for s in list(self._sessions.values())
+                if now >= s.expires_at
+            ]
+            self._publish_state()
+        for session in expired:
+            self.session_ended.trigger((session, "timeout"))
+
+    def _remove_session(self, session_id: str) -> Session | None:
+        # Slot claims outlive an expired session, they are only dropped on relock
+        session = self._sessions.pop(session_id, None)
+        self._token_nonces.pop(session_id, None)
+        if session is not None:
+            self._session_id_by_user_id.pop(session.user.id, None)
+        return session
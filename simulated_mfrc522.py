@@ -0,0 +1,116 @@
+"""
+A simulated MFRC522 for tests and benchmarks off the Pi: SPI register
+accesses are answered like the chip would, with a card in its field or none,
+and the chip select lines are gpiozero mock pins.
+"""
+
+import time
+
+import gpiozero
+from gpiozero.pins.mock import MockFactory
+
+from mfrc522 import MFRC522, SimpleMFRC522
+from mfrc522.chip_select_lock import ChipSelectLinesLock
+
+
+def anticoll_answer(uid: bytes) -> bytes:
+    # The uid and its check byte, which read_id's card ids include
+    bcc = 0
+    for b in uid:
+        bcc ^= b
+    return uid + bytes((bcc,))
+
+
+class SimulatedSpi:
+    """
+    Answers register accesses like an MFRC522 with a card in its field (uid)
+    or none. Only what initialize, send_request and anticoll use is simulated.
+
+    By default the chip answers at once, which only leaves the SPI overhead
+    of the driver. timer_s models the receive timeout: TimerIRq only rises
+    that long after a transceive no card answered (initialize's TReload of 30
+    at a prescaler of 0xD3E is ~15 ms). xfer_s models how long each transfer
+    keeps the CPU busy.
+    """
+
+    uid: bytes | None
+    timer_s: float
+    xfer_s: float
+    _fifo: list[int]
+    _response: list[int]
+    _timer_irq_at: float = 0.0
+
+    def __init__(
+        self, uid: bytes | None = None, *, timer_s: float = 0.0, xfer_s: float = 0.0
+    ):
+        self.uid = uid
+        self.timer_s = timer_s
+        self.xfer_s = xfer_s
+        self._fifo = []
+        self._response = []
+
+    def xfer2(self, data: list[int]) -> list[int]:
+        if self.xfer_s:
+            # Busy, like the spidev ioctl
+            done_at = time.perf_counter() + self.xfer_s
+            while time.perf_counter() < done_at:
+                pass
+        addr = (data[0] >> 1) & 0x3F
+        if data[0] & 0x80:
+            return [0, self._read(addr)]
+        self._write(addr, data[1])
+        return [0, 0]
+
+    def close(self):
+        pass
+
+    def _read(self, addr: int) -> int:
+        match addr:
+            case MFRC522.CommIrqReg:
+                # RxIRq and IdleIRq, or TimerIRq once no card answered in time
+                if self._response:
+                    return 0x30
+                return 0x01 if time.perf_counter() >= self._timer_irq_at else 0x00
+            case MFRC522.FIFOLevelReg:
+                return len(self._response)
+            case MFRC522.FIFODataReg:
+                return self._response.pop(0) if self._response else 0
+            case MFRC522.VersionReg:
+                return 0x92
+            case _:
+                return 0
+
+    def _write(self, addr: int, value: int):
+        match addr:
+            case MFRC522.FIFOLevelReg if value & 0x80:
+                self._fifo.clear()
+            case MFRC522.FIFODataReg:
+                self._fifo.append(value)
+            case MFRC522.CommandReg if value == MFRC522.PCD_TRANSCEIVE:
+                self._response = self._transceive()
+                self._timer_irq_at = time.perf_counter() + self.timer_s
+
+    def _transceive(self) -> list[int]:
+        if self.uid is None:
+            return []
+        if self._fifo == [MFRC522.PICC_REQIDL]:
+            # ATQA
+            return [0x04, 0x00]
+        if self._fifo == [MFRC522.PICC_ANTICOLL, 0x20]:
+            return list(anticoll_answer(self.uid))
+        return []
+
+
+def simulated_reader(spi: SimulatedSpi | None = None) -> SimpleMFRC522:
+    """
+    A reader talking to spi, on a chip select line of a fresh mock pin factory
+    (so readers made one after another don't clash over a pin).
+    """
+    gpiozero.Device.pin_factory = MockFactory()
+    lines_lock = ChipSelectLinesLock([gpiozero.DigitalOutputDevice(25)])
+    return SimpleMFRC522(
+        0,
+        0,
+        lines_lock.individual_line_lock(0),
+        spi=spi if spi is not None else SimulatedSpi(),
+    )
@@ -0,0 +1,343 @@
+"""
+SQLite storage engine for keys and users, for deployments too large to keep
+the whole database resident.
+
+Records are loaded lazily through indexed lookups on id, rf_id and username,
+and the most recently used ones are kept in a bounded LRU. Search goes through
+an index of the same normalized terms as the in-memory engine's. The cache is
+dropped whenever another connection (e.g. the import tool) commits a change.
+
+Import the JSON files with:
+    python sqlite_database.py database.json passwords.json key_guard.db
+"""
+
+from abc import ABC, abstractmethod
+import argparse
+from collections import OrderedDict
+import os
+import sqlite3
+from threading import Lock
+from typing import Any
+
+from data_objects import KeyData, UserData
+from database import load_database_files, verify_user_password
+from user_search import (
+    FUZZY_MAX_EDIT_DISTANCE,
+    fuzzy_distances,
+    normalize,
+    search_terms,
+)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS keys (
+    id TEXT PRIMARY KEY,
+    rf_id TEXT NOT NULL UNIQUE,
+    name TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS users (
+    id TEXT PRIMARY KEY,
+    rf_id TEXT NOT NULL UNIQUE,
+    username TEXT NOT NULL UNIQUE,
+    name TEXT NOT NULL,
+    password TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS grants (
+    user_id TEXT NOT NULL REFERENCES users(id) ON DELETE CASCADE,
+    key_id TEXT NOT NULL REFERENCES keys(id) ON DELETE CASCADE,
+    PRIMARY KEY (user_id, key_id)
+) WITHOUT ROWID;
+-- user_search.search_terms of every user, for prefix range scans
+CREATE TABLE IF NOT EXISTS user_search_terms (
+    term TEXT NOT NULL,
+    user_id TEXT NOT NULL REFERENCES users(id) ON DELETE CASCADE,
+    PRIMARY KEY (term, user_id)
+) WITHOUT ROWID;
+"""
+
+# The statement texts are fixed, so sqlite3's statement cache keeps them prepared
+_KEY_BY = {
+    "id": "SELECT id, rf_id, name FROM keys WHERE id = ?",
+    "rf_id": "SELECT id, rf_id, name FROM keys WHERE rf_id = ?",
+}
+_USER_BY = {
+    "id": "SELECT id, rf_id, username, name, password FROM users WHERE id = ?",
+    "rf_id": "SELECT id, rf_id, username, name, password FROM users WHERE rf_id = ?",
+    "username": "SELECT id, rf_id, username, name, password FROM users WHERE username = ?",
+}
+_GRANTS_FOR_USER = "SELECT key_id FROM grants WHERE user_id = ? ORDER BY key_id"
+# Binary collation orders like Python's str comparison, the same order as
+# UserSearchIndex's sorted terms
+_TERMS_FROM = (
+    "SELECT term, user_id FROM user_search_terms WHERE term >= ?"
+    " ORDER BY term, user_id"
+)
+_ALL_TERMS = "SELECT term, user_id FROM user_search_terms"
+_INSERT_TERM = "INSERT OR IGNORE INTO user_search_terms (term, user_id) VALUES (?, ?)"
+_USER_NAMES_CHUNK = 500
+_USER_IDS_FOR_KEY = "SELECT user_id FROM grants WHERE key_id = ? ORDER BY user_id"
+
+DEFAULT_CACHE_SIZE = 4096
+# Rows per fetch of a fuzzy scan, lookups get the connection between them
+FUZZY_SCAN_BATCH = 2048
+
+_MISSING = object()
+
+
+class _LruCache:
+    _entries: OrderedDict[Any, Any]
+    capacity: int
+
+    def __init__(self, capacity: int):
+        self._entries = OrderedDict()
+        self.capacity = capacity
+
+    def get(self, key) -> Any:
+        value = self._entries.get(key, _MISSING)
+        if value is not _MISSING:
+            self._entries.move_to_end(key)
+        return value
+
+    def put(self, key, value):
+        self._entries[key] = value
+        self._entries.move_to_end(key)
+        if len(self._entries) > self.capacity:
+            self._entries.popitem(last=False)
+
+    def clear(self):
+        self._entries.clear()
+
+
+def _connect(db_file: str | os.PathLike, **kwargs) -> sqlite3.Connection:
+    conn = sqlite3.connect(db_file, **kwargs)
+    # Off by default and per connection, the grants' ON DELETE CASCADE needs it
+    conn.execute("PRAGMA foreign_keys = ON")
+    conn.executescript(SCHEMA)
+    return conn
+
+
+def _index_search_terms(conn: sqlite3.Connection):
+    rows = conn.execute("SELECT id, username, name FROM users").fetchall()
+    conn.executemany(
+        _INSERT_TERM,
+        (
+            (t, u_id)
+            for u_id, username, name in rows
+            for t in search_terms(
+                UserData(
+                    id=u_id,
+                    rf_id="",
+                    username=username,
+                    name=name,
+                    password="",
+                    authorized_for=(),
+                )
+            )
+        ),
+    )
+
+
+class _SqliteTable(ABC):
+    _conn: sqlite3.Connection
+    _lock: Lock
+    _cache: _LruCache
+    _data_version: int
+
+    def __init__(self, db_file: str | os.PathLike, cache_size: int):
+        # Shared between the polling and websocket threads, serialized by _lock
+        self._conn = _connect(db_file, check_same_thread=False, cached_statements=32)
+        self._lock = Lock()
+        self._cache = _LruCache(cache_size)
+        self._data_version = self._read_data_version()
+
+    def _read_data_version(self) -> int:
+        return self._conn.execute("PRAGMA data_version").fetchone()[0]
+
+    def _lookup(self, field: str, value: str):
+        with self._lock:
+            data_version = self._read_data_version()
+            if data_version != self._data_version:
+                self._data_version = data_version
+                self._cache.clear()
+            cached = self._cache.get((field, value))
+            if cached is not _MISSING:
+                return cached
+            # Misses are cached too, so an unknown card being re-read stays cheap
+            record = self._load(field, value)
+            self._cache.put((field, value), record)
+            return record
+
+    @abstractmethod
+    def _load(self, field: str, value: str): ...
+
+
+class SqliteKeysDB(_SqliteTable):
+    def __init__(
+        self, db_file: str | os.PathLike, cache_size: int = DEFAULT_CACHE_SIZE
+    ):
+        super().__init__(db_file, cache_size)
+
+    def _load(self, field: str, value: str) -> KeyData | None:
+        row = self._conn.execute(_KEY_BY[field], (value,)).fetchone()
+        if row is None:
+            return None
+        return KeyData(id=row[0], rf_id=row[1], name=row[2])
+
+    def by_id(self, k_id: str) -> KeyData | None:
+        return self._lookup("id", k_id)
+
+    def by_rf_id(self, rf_id: str) -> KeyData | None:
+        return self._lookup("rf_id", rf_id)
+
+
+class SqliteUsersDB(_SqliteTable):
+    def __init__(
+        self, db_file: str | os.PathLike, cache_size: int = DEFAULT_CACHE_SIZE
+    ):
+        super().__init__(db_file, cache_size)
+        # Databases imported before the search index existed
+        with self._conn:
+            if self._conn.execute(
+                "SELECT EXISTS (SELECT 1 FROM users)"
+                " AND NOT EXISTS (SELECT 1 FROM user_search_terms)"
+            ).fetchone()[0]:
+                _index_search_terms(self._conn)
+
+    def _load(self, field: str, value: str) -> UserData | None:
+        row = self._conn.execute(_USER_BY[field], (value,)).fetchone()
+        if row is None:
+            return None
+        grants = self._conn.execute(_GRANTS_FOR_USER, (row[0],)).fetchall()
+        return UserData(
+            id=row[0],
+            rf_id=row[1],
+            username=row[2],
+            name=row[3],
+            password=row[4],
+            authorized_for=tuple(v[0] for v in grants),
+        )
+
+    def by_id(self, k_id: str) -> UserData | None:
+        return self._lookup("id", k_id)
+
+    def by_rf_id(self, rf_id: str) -> UserData | None:
+        return self._lookup("rf_id", rf_id)
+
+    def by_username(self, username: str) -> UserData | None:
+        return self._lookup("username", username)
+
+    def by_username_check_password(
+        self, username: str, password: str
+    ) -> UserData | None:
+        user = self.by_username(username)
+        if user is None:
+            return None
+        if verify_user_password(user, password):
+            return user
+        return None
+
+    def is_authorized(self, user: UserData, key: KeyData) -> bool:
+        # The loaded record already carries its grants (roles expanded on import)
+        return key.id in user.authorized_for
+
+    def search(self, query: str, limit: int, fuzzy: bool = False) -> list[UserData]:
+        # The same matches and order as UserSearchIndex
+        query = normalize(query)
+        if fuzzy:
+            return self._fuzzy_search(query, limit)
+        found: dict[str, None] = {}
+        with self._lock:
+            cursor = self._conn.execute(_TERMS_FROM, (query,))
+            try:
+                for term, u_id in cursor:
+                    if len(found) >= limit or not term.startswith(query):
+                        break
+                    found[u_id] = None
+            finally:
+                cursor.close()
+        return [u for u_id in found if (u := self.by_id(u_id)) is not None]
+
+    def _fuzzy_search(self, query: str, limit: int) -> list[UserData]:
+        # Edit distances can't use the index, the terms are scanned in batches
+        best: dict[str, int] = {}
+        with self._lock:
+            cursor = self._conn.execute(_ALL_TERMS)
+        while True:
+            with self._lock:
+                batch = cursor.fetchmany(FUZZY_SCAN_BATCH)
+            if not batch:
+                break
+            for u_id, distance in fuzzy_distances(
+                query, batch, FUZZY_MAX_EDIT_DISTANCE
+            ).items():
+                if distance < best.get(u_id, FUZZY_MAX_EDIT_DISTANCE + 1):
+                    best[u_id] = distance
+        names: dict[str, str] = {}
+        u_ids = list(best)
+        for i in range(0, len(u_ids), _USER_NAMES_CHUNK):
+            chunk = u_ids[i : i + _USER_NAMES_CHUNK]
+            with self._lock:
+                names.update(
+                    self._conn.execute(
+                        "SELECT id, name FROM users WHERE id IN"
+                        f" ({', '.join('?' * len(chunk))})",
+                        chunk,
+                    ).fetchall()
+                )
+        ranked = sorted(
+            (u_id for u_id in best if u_id in names),
+            key=lambda u_id: (best[u_id], names[u_id]),
+        )
+        return [u for u_id in ranked[:limit] if (u := self.by_id(u_id)) is not None]
+
+    def users_authorized_for(self, key: KeyData) -> list[UserData]:
+        with self._lock:
+            rows = self._conn.execute(_USER_IDS_FOR_KEY, (key.id,)).fetchall()
+        return [u for (u_id,) in rows if (u := self.by_id(u_id)) is not None]
+
+
+def import_json_database(
+    database_file: str | os.PathLike,
+    passwords_file: str | os.PathLike,
+    db_file: str | os.PathLike,
+):
+    """Replaces the contents of the SQLite database with the JSON files' records."""
+    keys, users = load_database_files(database_file, passwords_file)
+    conn = _connect(db_file)
+    try:
+        with conn:
+            conn.execute("DELETE FROM grants")
+            conn.execute("DELETE FROM users")
+            conn.execute("DELETE FROM keys")
+            conn.executemany(
+                "INSERT INTO keys (id, rf_id, name) VALUES (?, ?, ?)",
+                ((k.id, k.rf_id, k.name) for k in keys),
+            )
+            conn.executemany(
+                "INSERT INTO users (id, rf_id, username, name, password)"
+                " VALUES (?, ?, ?, ?, ?)",
+                ((u.id, u.rf_id, u.username, u.name, u.password) for u in users),
+            )
+            conn.executemany(
+                "INSERT INTO grants (user_id, key_id) VALUES (?, ?)",
+                ((u.id, k_id) for u in users for k_id in u.authorized_for),
+            )
+            conn.executemany(
+                _INSERT_TERM, ((t, u.id) for u in users for t in search_terms(u))
+            )
+    finally:
+        conn.close()
+    return len(keys), len(users)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Import the JSON key/user database into SQLite."
+    )
+    parser.add_argument("database_file")
+    parser.add_argument("passwords_file")
+    parser.add_argument("db_file")
+    args = parser.parse_args()
+    n_keys, n_users = import_json_database(
+        args.database_file, args.passwords_file, args.db_file
+    )
+    print(f"Imported {n_keys} keys and {n_users} users into {args.db_file}")
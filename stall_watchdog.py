@@ -0,0 +1,131 @@
+from collections.abc import Callable
+import logging
+import sys
+import threading
+import time
+import traceback
+
+from logger_instance import logger
+from metrics import metrics
+from mfrc522.chip_select_lock import ChipSelectLinesLock
+
+STALLS = metrics.counter(
+    "key_guard_stalls_total",
+    "Poll loop iterations or store ticks that overran their budget.",
+    label="kind",
+)
+
+
+def format_thread_stacks() -> str:
+    names = {t.ident: t.name for t in threading.enumerate()}
+    return "\n".join(
+        f"Thread {names.get(ident, ident)}:\n" + "".join(traceback.format_stack(frame))
+        for ident, frame in sys._current_frames().items()
+    )
+
+
+class StallWatchdog:
+    """
+    Reports a poll loop that stops iterating, or a store tick that doesn't
+    return, from a thread of its own.
+
+    The poll loop calls loop_started once per iteration and brackets every
+    tick with tick_started/tick_finished; these only store a timestamp. When
+    an iteration or a tick runs past its budget, every thread's stack and the
+    chip select lock owner are logged once for that stall, and restart is
+    called if the stall lasts restart_after_s.
+    """
+
+    loop_budget_s: float
+    tick_budget_s: float
+    check_interval_s: float
+    restart_after_s: float | None
+    chip_select_lock: ChipSelectLinesLock | None
+    restart: Callable[[], None] | None
+    _loop_at: float | None = None
+    # (store name, monotonic time it started at) while a tick runs
+    _tick: tuple[str, float] | None = None
+    # Start time of the stall reported last, so each stall is reported once
+    _reported: float | None = None
+    _restarting: bool = False
+
+    def __init__(
+        self,
+        *,
+        loop_budget_s: float | int,
+        tick_budget_s: float | int,
+        check_interval_s: float | int,
+        restart_after_s: float | int | None = None,
+        chip_select_lock: ChipSelectLinesLock | None = None,
+        restart: Callable[[], None] | None = None,
+    ):
+        self.loop_budget_s = loop_budget_s
+        self.tick_budget_s = tick_budget_s
+        self.check_interval_s = check_interval_s
+        self.restart_after_s = restart_after_s
+        self.chip_select_lock = chip_select_lock
+        self.restart = restart
+
+    def loop_started(self):
+        self._loop_at = time.monotonic()
+
+    def tick_started(self, name: str):
+        self._tick = (name, time.monotonic())
+
+    def tick_finished(self):
+        self._tick = None
+
+    def _describe_chip_select(self, now: float) -> str:
+        owner = self.chip_select_lock.owner() if self.chip_select_lock else None
+        if owner is None:
+            return "not held"
+        thread_name, line, since = owner
+        return f"line {line} held by {thread_name} for {now - since:.1f}s"
+
+    def check(self):
+        now = time.monotonic()
+        loop_at = self._loop_at
+        tick = self._tick
+        if tick is not None and now - tick[1] > self.tick_budget_s:
+            kind, what, since = "tick", f"{tick[0]} tick", tick[1]
+        elif loop_at is not None and now - loop_at > self.loop_budget_s:
+            kind, what, since = "loop", "Poll loop", loop_at
+        else:
+            self._reported = None
+            return
+        if self._reported != since:
+            self._reported = since
+            STALLS.inc(label_value=kind)
+            logger.log(
+                logging.ERROR,
+                "{0} stalled for {1:.1f}s, chip select {2}\n{3}",
+                what,
+                now - since,
+                self._describe_chip_select(now),
+                format_thread_stacks(),
+            )
+        if (
+            self.restart is not None
+            and self.restart_after_s is not None
+            and now - since > self.restart_after_s
+            and not self._restarting
+        ):
+            self._restarting = True
+            logger.log(
+                logging.CRITICAL,
+                "{0} stalled for {1:.1f}s, restarting",
+                what,
+                now - since,
+            )
+            self.restart()
+
+    def _run(self):
+        while True:
+            time.sleep(self.check_interval_s)
+            try:
+                self.check()
+            except Exception as ex:
+                logger.log(logging.ERROR, "Stall check failed: {0!r}", ex)
+
+    def start(self):
+        threading.Thread(target=self._run, name="Watchdog", daemon=True).start()
@@ -0,0 +1,103 @@
+from dataclasses import replace
+import json
+
+import bcrypt
+import pytest
+
+import database
+import database_writer
+import singleton
+from data_objects import KeyData
+from database_writer import DatabaseWriter
+
+
+@pytest.fixture
+def writer(tmp_path, monkeypatch) -> DatabaseWriter:
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / "database.json").write_text(
+        json.dumps(
+            {
+                "keys": [{"id": "k1", "rf_id": "key-1", "name": "Key 1"}],
+                "users": [
+                    {
+                        "id": "u1",
+                        "rf_id": "0000000001",
+                        "name": "User 1",
+                        "username": "user1",
+                        "authorized_for": ["k1"],
+                    }
+                ],
+            }
+        )
+    )
+    (tmp_path / "passwords.json").write_text(
+        json.dumps({"passwords": [{"id": "u1", "password": "$2b$04$hash"}]})
+    )
+    # Fresh databases, read from this directory
+    monkeypatch.setattr(singleton._Singleton, "_instances", {})
+    database._parse_database.cache_clear()
+    yield DatabaseWriter(write_delay_s=0)
+    database._parse_database.cache_clear()
+
+
+def _key_ids() -> list[str]:
+    with open(database.DATABASE_FILE) as f:
+        return [v["id"] for v in json.load(f)["keys"]]
+
+
+def test_failed_write_is_written_by_the_next_flush(writer, monkeypatch):
+    with writer.transaction() as transaction:
+        transaction.add_key(KeyData(id="k2", rf_id="key-2", name="Key 2"))
+
+    atomic_write_json = database_writer._atomic_write_json
+    calls = 0
+
+    def fail_once(file, document):
+        nonlocal calls
+        calls += 1
+        if calls == 1:
+            raise OSError("disk full")
+        atomic_write_json(file, document)
+
+    monkeypatch.setattr(database_writer, "_atomic_write_json", fail_once)
+    assert writer.flush() is False
+    assert _key_ids() == ["k1"]
+
+    assert writer.flush() is True
+    assert _key_ids() == ["k1", "k2"]
+    # Nothing left pending
+    assert writer.flush() is True
+    assert calls == 3
+
+
+def _hash(cost: int) -> str:
+    return bcrypt.hashpw(b"secret", bcrypt.gensalt(cost)).decode()
+
+
+@pytest.mark.parametrize("stored_cost,rehashed", [(4, True), (5, False), (6, False)])
+def test_passwords_are_only_rehashed_upwards(
+    writer, monkeypatch, stored_cost: int, rehashed: bool
+):
+    rehashes = []
+    monkeypatch.setattr(database, "_password_verifier", None)
+    database.set_bcrypt_cost(5, lambda user, _: rehashes.append(user.id))
+    try:
+        user = database.UsersDB().by_id("u1")
+        user = replace(user, password=_hash(stored_cost))
+        assert database.verify_user_password(user, "secret")
+    finally:
+        database.set_bcrypt_cost(None)
+    assert rehashes == (["u1"] if rehashed else [])
+
+
+def test_rehash_never_lowers_the_cost(writer):
+    stored = _hash(6)
+    with writer.transaction() as transaction:
+        transaction.set_password_hash("u1", stored)
+    user = database.UsersDB().by_id("u1")
+    database.set_bcrypt_cost(5)
+    try:
+        writer._rehash(user, "secret")
+    finally:
+        database.set_bcrypt_cost(None)
+    assert database.UsersDB().by_id("u1").password == stored
@@ -0,0 +1,54 @@
+import threading
+
+from event import Event, QueuedDispatcher
+from event_coalescer import CoalescingPolicy, EventCoalescer
+
+FLOOD = 1000
+QUEUE_SIZE = 8
+POLICY = CoalescingPolicy(dedup_window_s=10, rate_per_s=1, burst=5)
+
+
+def test_flood_does_not_crowd_out_other_alerts():
+    coalescer = EventCoalescer(
+        {"unknown-key-placed": POLICY, "unrecognized-user-card": POLICY}
+    )
+    dispatcher = QueuedDispatcher(
+        name="Notifications", max_queue=QUEUE_SIZE, overflow="drop-oldest"
+    )
+    unknown_key_placed = Event("Slot 1")
+    unknown_user_found = Event("User Reader")
+    delivered = []
+
+    @unknown_user_found.on
+    @coalescer.coalesce(
+        "unrecognized-user-card",
+        key=lambda origin, data: (origin, data),
+        dispatcher=dispatcher,
+    )
+    def on_unknown_user_found(origin, card_id):
+        delivered.append(("unrecognized-user-card", card_id))
+
+    @unknown_key_placed.on
+    @coalescer.coalesce(
+        "unknown-key-placed",
+        key=lambda origin, data: (origin, data),
+        dispatcher=dispatcher,
+    )
+    def on_unknown_key_placed(origin, card_id):
+        delivered.append(("unknown-key-placed", card_id))
+
+    # Queued first, a flood coalesced behind the queue would push it out
+    unknown_user_found.trigger("user-card")
+    for i in range(FLOOD):
+        unknown_key_placed.trigger(f"key-{i % 3}")
+    assert dispatcher.stats().dropped == 0
+
+    dispatcher.start()
+    done = threading.Event()
+    dispatcher.submit(lambda origin, _: done.set(), None, None)
+    assert done.wait(5)
+    assert delivered[0] == ("unrecognized-user-card", "user-card")
+    # One per card id, the rest only counted for the summary
+    assert sorted(delivered[1:]) == [
+        ("unknown-key-placed", f"key-{i}") for i in range(3)
+    ]
@@ -0,0 +1,34 @@
+import gc
+import threading
+
+from metrics import Counter, Histogram
+
+THREADS = 50
+
+
+def _record_on_threads(record):
+    for _ in range(THREADS):
+        thread = threading.Thread(target=record)
+        thread.start()
+        thread.join()
+    gc.collect()
+
+
+def test_exited_threads_shards_are_retired():
+    counter = Counter("test_total", "Test.", "type")
+    histogram = Histogram("test_seconds", "Test.", None)
+
+    def record():
+        counter.inc(label_value="a")
+        histogram.observe(0.5)
+
+    _record_on_threads(record)
+    # Like a websocket client's sender thread per connection
+    assert counter._shards == []
+    assert histogram._shards == []
+    assert counter.values() == {"a": THREADS}
+    assert histogram.snapshot()[""]["count"] == THREADS
+
+    counter.inc(label_value="a")
+    assert len(counter._shards) == 1
+    assert counter.values() == {"a": THREADS + 1}
@@ -0,0 +1,40 @@
+import os
+import tracemalloc
+
+import pytest
+
+import mfrc522
+from mfrc522.SimpleMFRC522 import uid_to_num
+from simulated_mfrc522 import SimulatedSpi, anticoll_answer, simulated_reader
+
+POLLS = 500
+MFRC522_FILES = os.path.join(os.path.dirname(mfrc522.__file__), "*")
+UID = bytes((0x12, 0x34, 0x56, 0x78))
+# Blocks the interpreter's free lists (floats, tuples, memoryviews) may keep once,
+# anything kept per poll would show POLLS times
+FREE_LIST_SLACK_BLOCKS = 10
+
+
+@pytest.mark.parametrize("uid", [None, UID], ids=["empty-field", "card-present"])
+def test_polling_keeps_no_allocations(uid: bytes | None):
+    reader = simulated_reader(SimulatedSpi(uid))
+    # Allocations are all this counts, the field needn't settle
+    reader.ANTENNA_SETTLE_S = 0
+    expected = None if uid is None else uid_to_num(anticoll_answer(uid))
+    # Fills the card id cache
+    assert reader.read_id(timeout=0) == expected
+
+    filters = [tracemalloc.Filter(True, MFRC522_FILES)]
+    tracemalloc.start()
+    try:
+        before = tracemalloc.take_snapshot().filter_traces(filters)
+        for _ in range(POLLS):
+            assert reader.read_id(timeout=0) == expected
+        after = tracemalloc.take_snapshot().filter_traces(filters)
+    finally:
+        tracemalloc.stop()
+
+    grown = [s for s in after.compare_to(before, "lineno") if s.count_diff > 0]
+    assert sum(s.count_diff for s in grown) < FREE_LIST_SLACK_BLOCKS, "\n".join(
+        str(s) for s in grown
+    )
@@ -0,0 +1,94 @@
+"""
+Runtime type checking, selected per deployment with KEY_GUARD_TYPECHECK:
+
+    full      typeguard import hooks on the application modules, and every
+              boundary function checked (development)
+    boundary  only the boundary functions are checked: the event handlers and
+              the callbacks the websocket server calls into
+    sampled   like boundary, but only one call in KEY_GUARD_TYPECHECK_SAMPLE
+              is checked
+    off       no checks
+
+`configure` must run before the application modules are imported, the import
+hooks only apply to modules imported after them.
+
+Measure the per-tick cost of each mode with type_checking_benchmark.py.
+"""
+
+from collections.abc import Callable
+import functools
+import itertools
+import os
+from typing import Literal, TypeVar
+
+from typeguard import install_import_hook
+from typeguard import typechecked as _typeguard_typechecked
+
+TypeCheckMode = (
+    Literal["full"] | Literal["boundary"] | Literal["sampled"] | Literal["off"]
+)
+MODES: tuple[TypeCheckMode, ...] = ("full", "boundary", "sampled", "off")
+DEFAULT_SAMPLE_EVERY = 100
+
+# Instrumented by the import hooks in "full" mode
+CHECKED_MODULES = [
+    "event",
+    "user_store",
+    "key_store",
+    "data_objects",
+    "database",
+    "mfrc522",
+    "mfrc522.chip_select_lock",
+    "ws",
+    "ws.server",
+    "ws.client",
+    "ws.key_selection_option",
+]
+
+TFunc = TypeVar("TFunc", bound=Callable)
+
+_mode: TypeCheckMode = "full"
+_sample_every = DEFAULT_SAMPLE_EVERY
+
+
+def configure(mode: str, sample_every: int = DEFAULT_SAMPLE_EVERY):
+    global _mode, _sample_every
+    if mode not in MODES:
+        raise ValueError(
+            f"Unknown type checking mode {mode!r}, expected one of {MODES}"
+        )
+    _mode = mode
+    _sample_every = sample_every
+    if mode == "full":
+        for module in CHECKED_MODULES:
+            install_import_hook(module)
+
+
+def configure_from_env():
+    configure(
+        os.environ.get("KEY_GUARD_TYPECHECK", "full"),
+        int(os.environ.get("KEY_GUARD_TYPECHECK_SAMPLE", DEFAULT_SAMPLE_EVERY)),
+    )
+
+
+def mode() -> TypeCheckMode:
+    return _mode
+
+
+def typechecked(func: TFunc) -> TFunc:
+    """Checks a boundary function as the configured mode asks (see the module doc)."""
+    if _mode == "off":
+        return func
+    checked = _typeguard_typechecked(func)
+    if _mode != "sampled":
+        return checked
+    calls = itertools.count()
+    sample_every = _sample_every
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if next(calls) % sample_every == 0:
+            return checked(*args, **kwargs)
+        return func(*args, **kwargs)
+
+    return wrapper
@@ -0,0 +1,97 @@
+"""
+Measures the per-tick cost of each type checking mode (see type_checking.py)
+on an idle, locked key slot with a simulated reader:
+
+    python type_checking_benchmark.py [--ticks 20000]
+
+Each mode runs in a process of its own, the import hooks can't be undone.
+"""
+
+import argparse
+import logging
+import subprocess
+import sys
+import time
+
+import type_checking
+
+
+def benchmark_ticks(ticks: int) -> float:
+    """Mean seconds per tick of an idle, locked key slot (best of 3 rounds)."""
+    # Imported after configure(), so "full" mode instruments them
+    import gpiozero
+
+    from data_objects import KeyData
+    from event import Event
+    from key_store import KeyStore
+    from logger_instance import logger
+    from simulated_mfrc522 import simulated_reader
+
+    logger.setLevel(logging.ERROR)
+
+    class Keys:
+        def by_id(self, k_id: str) -> KeyData | None:
+            return None
+
+        def by_rf_id(self, rf_id: str) -> KeyData | None:
+            return None
+
+    reader = simulated_reader()
+    key_store = KeyStore(
+        slot_name="Benchmark",
+        init_locked=True,
+        solenoid_controller=gpiozero.DigitalOutputDevice(24),
+        relock_key_timeout_ms=1,
+        reader=reader,
+        reader_timeout_s=0,
+        key_relock_timeout_s=1,
+        solenoid_lock_wait_time_s=0,
+        keys_db=Keys(),
+    )
+
+    # Stands in for a handler of main.py, so boundary checks are counted too
+    @type_checking.typechecked
+    def on_tick(origin: KeyStore, version: int):
+        pass
+
+    ticked: Event[KeyStore, int] = Event(key_store)
+    ticked.add_listener(on_tick)
+    best = float("inf")
+    # The first round warms up caches (typeguard's included) and is discarded
+    for round in range(4):
+        start = time.perf_counter()
+        for _ in range(ticks):
+            key_store.tick()
+            ticked.trigger(key_store.state_version)
+        if round != 0:
+            best = min(best, (time.perf_counter() - start) / ticks)
+    return best
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Measure the per-tick overhead of each type checking mode."
+    )
+    parser.add_argument("--ticks", type=int, default=20000)
+    # Internal, runs one mode in this process
+    parser.add_argument("--mode", choices=type_checking.MODES, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.mode is not None:
+        type_checking.configure(args.mode)
+        print(benchmark_ticks(args.ticks))
+    else:
+        # One process per mode, the import hooks can't be undone
+        results = {}
+        for m in type_checking.MODES:
+            out = subprocess.run(
+                [sys.executable, __file__, "--mode", m, "--ticks", str(args.ticks)],
+                check=True,
+                capture_output=True,
+                text=True,
+            ).stdout
+            results[m] = float(out.split()[-1])
+        for m, tick_s in results.items():
+            print(
+                f"{m:>8}: {tick_s * 1e6:8.1f} us/tick"
+                f" ({tick_s / results['off']:.2f}x off)"
+            )
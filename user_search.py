@@ -0,0 +1,120 @@
+import bisect
+from collections.abc import Iterable
+import unicodedata
+
+from data_objects import UserData
+
+FUZZY_MAX_EDIT_DISTANCE = 2
+
+
+def normalize(text: str) -> str:
+    # Case and accent insensitive: "Ärya" matches "arya"
+    decomposed = unicodedata.normalize("NFKD", text)
+    stripped = "".join(c for c in decomposed if not unicodedata.combining(c))
+    return " ".join(stripped.casefold().split())
+
+
+def search_terms(user: UserData) -> list[str]:
+    name = normalize(user.name)
+    # The full name and each of its words, so "chu" finds "Aryan Chudasama"
+    return list(dict.fromkeys([normalize(user.username), name, *name.split(" ")]))
+
+
+def prefix_edit_distance(query: str, term: str, max_distance: int) -> int | None:
+    """
+    Smallest edit distance between the query and any prefix of the term, or
+    None once it must exceed max_distance.
+    """
+    previous = list(range(len(term) + 1))
+    for i, qc in enumerate(query, 1):
+        current = [i]
+        for j, tc in enumerate(term, 1):
+            current.append(
+                min(
+                    previous[j] + 1,
+                    current[j - 1] + 1,
+                    previous[j - 1] + (qc != tc),
+                )
+            )
+        if min(current) > max_distance:
+            return None
+        previous = current
+    best = min(previous)
+    return best if best <= max_distance else None
+
+
+def fuzzy_distances(
+    query: str, terms: Iterable[tuple[str, str]], max_distance: int
+) -> dict[str, int]:
+    """
+    The best edit distance of each user id with a (term, user id) pair close
+    enough to the normalized query.
+    """
+    best: dict[str, int] = {}
+    for term, u_id in terms:
+        if len(term) < len(query) - max_distance:
+            continue
+        distance = prefix_edit_distance(
+            query, term[: len(query) + max_distance], max_distance
+        )
+        if distance is not None and distance < best.get(u_id, max_distance + 1):
+            best[u_id] = distance
+    return best
+
+
+class UserSearchIndex:
+    """
+    As-you-type search over usernames and names.
+
+    Normalized terms are kept in a sorted array, so a prefix query is a bisect
+    plus a short scan. Fuzzy queries fall back to a scan with a bounded,
+    early-exiting edit distance. Instances are never mutated, `updated`
+    returns a patched copy.
+    """
+
+    # Sorted (term, user id) pairs
+    _terms: list[tuple[str, str]]
+    _users: dict[str, UserData]
+
+    def __init__(self, users: list[UserData]):
+        self._users = {u.id: u for u in users}
+        self._terms = sorted((t, u.id) for u in users for t in search_terms(u))
+
+    def updated(
+        self, users_upserted: list[UserData], user_ids_removed: list[str]
+    ) -> "UserSearchIndex":
+        index = UserSearchIndex.__new__(UserSearchIndex)
+        index._users = dict(self._users)
+        index._terms = list(self._terms)
+        for u_id in [*user_ids_removed, *(u.id for u in users_upserted)]:
+            old = index._users.pop(u_id, None)
+            if old is None:
+                continue
+            for t in search_terms(old):
+                i = bisect.bisect_left(index._terms, (t, u_id))
+                if i < len(index._terms) and index._terms[i] == (t, u_id):
+                    del index._terms[i]
+        for u in users_upserted:
+            index._users[u.id] = u
+            for t in search_terms(u):
+                bisect.insort(index._terms, (t, u.id))
+        return index
+
+    def prefix(self, query: str, limit: int) -> list[UserData]:
+        query = normalize(query)
+        found: dict[str, UserData] = {}
+        i = bisect.bisect_left(self._terms, (query, ""))
+        while i < len(self._terms) and len(found) < limit:
+            term, u_id = self._terms[i]
+            if not term.startswith(query):
+                break
+            found.setdefault(u_id, self._users[u_id])
+            i += 1
+        return list(found.values())
+
+    def fuzzy(
+        self, query: str, limit: int, max_distance: int = FUZZY_MAX_EDIT_DISTANCE
+    ) -> list[UserData]:
+        best = fuzzy_distances(normalize(query), self._terms, max_distance)
+        ranked = sorted(best, key=lambda u_id: (best[u_id], self._users[u_id].name))
+        return [self._users[u_id] for u_id in ranked[:limit]]
@@ -1,36 +1,60 @@
-from typing import Literal
+import time
+
 from data_objects import UserData
-from database import UsersDB
+from database import UsersBackend, UsersDB
 from event import Event
+from key_store import READ_ID_SECONDS
 from mfrc522 import SimpleMFRC522
+from session_manager import Session, SessionManager
 
 
 class UserStore:
     _past_user_card_id: str | None = None
     reader_timeout_s: float | int
     reader: SimpleMFRC522
-    users_db: UsersDB
+    users_db: UsersBackend
+    session_manager: SessionManager
     unknown_user_found: Event["UserStore", str]
     user_card_found_but_blocked: Event["UserStore", UserData]
-    user_found: Event["UserStore", tuple[UserData, Literal["login"] | Literal["card"]]]
-    current_user: UserData | None = None
+    user_found: Event["UserStore", Session]
 
     def __init__(
         self,
         *,
         user_reader: SimpleMFRC522,
         user_reader_timeout_s: float | int,
-        users_db: UsersDB | None = None,
+        session_manager: SessionManager,
+        users_db: UsersBackend | None = None,
     ):
         self.reader = user_reader
         self.reader_timeout_s = user_reader_timeout_s
+        self.session_manager = session_manager
         self.users_db = users_db if users_db is not None else UsersDB()
         self.unknown_user_found = Event(self)
         self.user_found = Event(self)
         self.user_card_found_but_blocked = Event(self)
 
+    @property
+    def is_active(self) -> bool:
+        # A user is mid-transaction, keep the user reader responsive
+        return len(self.session_manager.state.sessions) != 0
+
+    @property
+    def state_version(self) -> int:
+        return self.session_manager.state.version
+
     def tick(self):
+        self.process_card(self.read_card())
+
+    def read_card(self) -> str | None:
+        """The blocking (SPI) half of a tick, safe to run in an executor."""
+        read_at = time.perf_counter()
         card_id = self.reader.read_id(timeout=self.reader_timeout_s)
+        READ_ID_SECONDS.observe(time.perf_counter() - read_at, "User Reader")
+        return card_id
+
+    def process_card(self, card_id: str | None):
+        self.session_manager.expire_sessions()
         # if card_id is not None:
         #     logger.log(logging.INFO, "Past User: %s", past_user_card_id)
         #     logger.log(logging.INFO, "User: %s", card_id)
@@ -42,18 +66,12 @@ class UserStore:
             return
         user = self.users_db.by_rf_id(card_id)
         if user is not None:
-            if self.current_user is not None:
-                if self.current_user != user:
-                    self.user_card_found_but_blocked.trigger(user)
+            if self.session_manager.session_for_user(user) is not None:
+                return
+            session = self.session_manager.start_session(user, "card")
+            if session is None:
+                self.user_card_found_but_blocked.trigger(user)
             else:
-                self.current_user = user
-                self.user_found.trigger((user, "card"))
+                self.user_found.trigger(session)
         elif card_id is not None:
             self.unknown_user_found.trigger(card_id)
-
-    def on_user_login(self, user: UserData):
-        self.current_user = user
-        self.user_found.trigger((user, "login"))
-
-    def logout_user(self):
-        self.current_user = None
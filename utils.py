@@ -1,5 +1,6 @@
 from contextlib import contextmanager
 from functools import wraps
+from threading import Lock
 from time import perf_counter
 from logger_instance import logger
 import logging
@@ -33,3 +34,39 @@ def timing_wither(name):
     yield
     t2 = perf_counter()
     logger.log(logging.INFO, f"func:{name} took: {t2 - t1:2.4f} sec")
+
+
+class PhaseTimings:
+    """Durations of named phases, which may run in parallel (e.g. during startup)."""
+
+    _start: float
+    _phases: list[tuple[str, float]]
+    _lock: Lock
+
+    def __init__(self):
+        self._start = perf_counter()
+        self._phases = []
+        self._lock = Lock()
+
+    @contextmanager
+    def phase(self, name: str):
+        t1 = perf_counter()
+        try:
+            yield
+        finally:
+            with self._lock:
+                self._phases.append((name, perf_counter() - t1))
+
+    def timed(self, name: str, f):
+        # f wrapped to run as a phase, e.g. to submit it to an executor
+        @wraps(f)
+        def wrap(*args, **kw):
+            with self.phase(name):
+                return f(*args, **kw)
+
+        return wrap
+
+    def summary(self) -> str:
+        with self._lock:
+            phases = ", ".join(f"{name} {d:.3f}s" for name, d in self._phases)
+        return f"{perf_counter() - self._start:.3f}s ({phases})"
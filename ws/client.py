@@ -0,0 +1,222 @@
+import asyncio
+from collections import deque
+import threading
+import time
+from typing import Any, Literal
+
+from websockets import ConnectionClosed
+from websockets.asyncio.server import ServerConnection as AsyncServerConnection
+from websockets.sync.server import ServerConnection
+
+from metrics import metrics
+
+# "kiosk" is the cabinet's own screen (logins, key selection), "monitor" a display
+# that only watches alerts (e.g. the guard desk)
+ClientRole = Literal["kiosk"] | Literal["monitor"]
+CLIENT_ROLES: tuple[ClientRole, ...] = ("kiosk", "monitor")
+SlowClientPolicy = Literal["drop-oldest"] | Literal["disconnect"]
+
+MESSAGES_SENT = metrics.counter(
+    "key_guard_ws_messages_sent_total", "Websocket messages sent.", label="type"
+)
+SEND_SECONDS = metrics.histogram(
+    "key_guard_ws_send_seconds", "Duration of one websocket send.", label="type"
+)
+SLOW_CLIENT_OVERFLOWS = metrics.counter(
+    "key_guard_ws_slow_client_overflows_total",
+    "Messages dropped, or clients disconnected, because a send queue was full.",
+    label="policy",
+)
+
+
+class _Client:
+    websocket: Any
+    addr: Any
+    role: ClientRole
+    max_queue: int
+    slow_client_policy: SlowClientPolicy
+    # (encoded message, type)
+    _queue: deque[tuple[str, str]]
+    _closing: bool = False
+    # Disconnected by the "disconnect" policy
+    overflowed: bool = False
+
+    def __init__(
+        self,
+        *,
+        websocket: Any,
+        role: ClientRole,
+        max_queue: int,
+        slow_client_policy: SlowClientPolicy,
+    ):
+        self.websocket = websocket
+        self.addr = websocket.remote_address
+        self.role = role
+        self.max_queue = max_queue
+        self.slow_client_policy = slow_client_policy
+        self._queue = deque()
+
+    def _offer(self, encoded: str, type: str) -> bool:
+        """Queues a message, returns whether the sender should wake up."""
+        if self._closing:
+            return False
+        if len(self._queue) >= self.max_queue:
+            SLOW_CLIENT_OVERFLOWS.inc(label_value=self.slow_client_policy)
+            if self.slow_client_policy == "disconnect":
+                self.overflowed = True
+                self._closing = True
+                self._queue.clear()
+                return True
+            self._queue.popleft()
+        self._queue.append((encoded, type))
+        return True
+
+
+class ClientConnection(_Client):
+    """
+    A connected websocket client and its outbound queue.
+
+    Messages are queued without blocking and sent by a thread of the client's
+    own, so a slow client never holds up the thread that produced a message or
+    the other clients. When more than max_queue messages wait:
+      - "drop-oldest" drops the oldest waiting message,
+      - "disconnect" closes the connection, the client reconnects and resumes
+        the alerts it missed from their sequence numbers.
+    """
+
+    websocket: ServerConnection
+    _cond: threading.Condition
+
+    def __init__(
+        self,
+        *,
+        websocket: ServerConnection,
+        role: ClientRole,
+        max_queue: int,
+        slow_client_policy: SlowClientPolicy,
+    ):
+        super().__init__(
+            websocket=websocket,
+            role=role,
+            max_queue=max_queue,
+            slow_client_policy=slow_client_policy,
+        )
+        self._cond = threading.Condition()
+
+    def enqueue(self, encoded: str, type: str):
+        with self._cond:
+            if self._offer(encoded, type):
+                self._cond.notify()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                self._cond.wait_for(lambda: self._queue or self._closing)
+                if self._closing and not self._queue:
+                    break
+                encoded, type = self._queue.popleft()
+            start = time.perf_counter()
+            try:
+                self.websocket.send(encoded)
+            except ConnectionClosed:
+                break
+            SEND_SECONDS.observe(time.perf_counter() - start, type)
+            MESSAGES_SENT.inc(label_value=type)
+        if self.overflowed:
+            # 1013: try again later
+            self.websocket.close(1013, "send queue overflow")
+
+    def start(self):
+        threading.Thread(
+            target=self._run, name=f"WS {self.role} sender", daemon=True
+        ).start()
+
+    def close(self):
+        """Stops the sender once the messages already queued have been sent."""
+        with self._cond:
+            self._closing = True
+            self._cond.notify()
+
+    def disconnect(self):
+        self.close()
+        self.websocket.close()
+
+
+class AsyncClientConnection(_Client):
+    """
+    ClientConnection for the asyncio server, with a sender task instead of a
+    thread. Its methods are meant for the loop's thread, calls from other
+    threads are handed over to it.
+    """
+
+    websocket: AsyncServerConnection
+    _loop: asyncio.AbstractEventLoop
+    _loop_thread: int
+    _wake: asyncio.Event
+    _task: asyncio.Task | None = None
+
+    def __init__(
+        self,
+        *,
+        websocket: AsyncServerConnection,
+        role: ClientRole,
+        max_queue: int,
+        slow_client_policy: SlowClientPolicy,
+    ):
+        super().__init__(
+            websocket=websocket,
+            role=role,
+            max_queue=max_queue,
+            slow_client_policy=slow_client_policy,
+        )
+        self._loop = asyncio.get_running_loop()
+        self._loop_thread = threading.get_ident()
+        self._wake = asyncio.Event()
+
+    def enqueue(self, encoded: str, type: str):
+        if threading.get_ident() != self._loop_thread:
+            self._loop.call_soon_threadsafe(self.enqueue, encoded, type)
+            return
+        if self._offer(encoded, type):
+            self._wake.set()
+
+    async def _run(self):
+        while True:
+            await self._wake.wait()
+            self._wake.clear()
+            while self._queue:
+                encoded, type = self._queue.popleft()
+                start = time.perf_counter()
+                try:
+                    await self.websocket.send(encoded)
+                except ConnectionClosed:
+                    return
+                SEND_SECONDS.observe(time.perf_counter() - start, type)
+                MESSAGES_SENT.inc(label_value=type)
+            if self._closing:
+                break
+        if self.overflowed:
+            # 1013: try again later
+            await self.websocket.close(1013, "send queue overflow")
+
+    def start(self):
+        self._task = self._loop.create_task(self._run())
+
+    def close(self):
+        """Stops the sender once the messages already queued have been sent."""
+        if threading.get_ident() != self._loop_thread:
+            self._loop.call_soon_threadsafe(self.close)
+            return
+        self._closing = True
+        self._wake.set()
+
+    def disconnect(self):
+        if threading.get_ident() != self._loop_thread:
+            self._loop.call_soon_threadsafe(self.disconnect)
+            return
+        self.close()
+        self._loop.create_task(self.websocket.close())
+
+
+# What the server's request handlers send through
+Client = ClientConnection | AsyncClientConnection
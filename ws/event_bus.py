@@ -0,0 +1,59 @@
+from collections import deque
+import itertools
+import json
+import secrets
+import threading
+
+
+class SequencedEventBus:
+    """
+    Numbers outbound events and keeps the last `capacity` of them.
+
+    Every published event gets "epoch" and "seq" fields. seq increases by one
+    per event, and epoch changes when the process restarts, so a client that
+    remembers both can ask for exactly the events it missed.
+
+    Hold `lock` around publishing and sending (and around a replay), so a
+    client never receives events out of sequence order. Events sent live
+    before a resume request are replayed again, clients skip any seq they
+    have already seen.
+    """
+
+    epoch: str
+    lock: threading.RLock
+    _seq: int
+    # (seq, encoded event)
+    _ring: deque[tuple[int, str]]
+
+    def __init__(self, capacity: int):
+        self.epoch = secrets.token_hex(8)
+        self.lock = threading.RLock()
+        self._seq = 0
+        self._ring = deque(maxlen=capacity)
+
+    @property
+    def seq(self) -> int:
+        return self._seq
+
+    def publish(self, event: dict) -> str:
+        """Returns the encoded event, ready to send."""
+        with self.lock:
+            self._seq += 1
+            encoded = json.dumps({**event, "epoch": self.epoch, "seq": self._seq})
+            self._ring.append((self._seq, encoded))
+            return encoded
+
+    def since(self, epoch: str | None, last_seq: int) -> tuple[bool, list[str]]:
+        """
+        Returns whether the buffer still covers everything after last_seq, and
+        the buffered events after it (all of them after a restart).
+        """
+        with self.lock:
+            if epoch != self.epoch:
+                last_seq = 0
+            complete = last_seq >= self._seq - len(self._ring)
+            missed = max(0, min(len(self._ring), self._seq - last_seq))
+            return complete, [
+                e
+                for _, e in itertools.islice(self._ring, len(self._ring) - missed, None)
+            ]
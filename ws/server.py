@@ -1,320 +1,849 @@
 from collections.abc import Callable
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
 import datetime
+import hmac
 import json
 import os
 import ssl
+import threading
 from typing import Any, Literal, Union
+from urllib.parse import parse_qs, urlsplit
 import jwt
 from websockets import ConnectionClosedError
+from websockets.asyncio.server import ServerConnection as AsyncServerConnection
+from websockets.asyncio.server import serve as async_serve
 from websockets.sync.server import serve, ServerConnection
 
 from data_objects import KeyData, UserData
-from database import UsersDB
+from database import UsersBackend, UsersDB
+from database_writer import DatabaseTransaction, DatabaseWriter
 from event import Event
+from metrics import metrics
+from password_verifier import PasswordVerifierBusy
+from sampling_profiler import SamplingProfiler
+from session_manager import Session, SessionManager
+from ws.client import (
+    CLIENT_ROLES,
+    AsyncClientConnection,
+    Client,
+    ClientConnection,
+    ClientRole,
+    SlowClientPolicy,
+)
+from ws.event_bus import SequencedEventBus
 from ws.key_selection_option import KeySelectionOption
 
+MAX_USER_SEARCH_RESULTS = 20
+# Alerts kept for clients that reconnect and resume from their last seen seq
+EVENT_REPLAY_BUFFER_SIZE = 512
+# Messages waiting to be sent to one client, see ClientConnection for what happens
+# past it
+DEFAULT_CLIENT_SEND_QUEUE_SIZE = 256
+DEFAULT_PROFILER_RATE_HZ = 100
+MAX_PROFILER_RATE_HZ = 1000
+
+# Anything else is counted as "unknown", clients don't get to pick label values
+REQUEST_TYPES = (
+    "echo",
+    "login",
+    "unlock-key-slot",
+    "resume",
+    "search-users",
+    "metrics",
+    "profiler",
+    "edit-database",
+)
+# Refused from monitors, which only watch the alerts
+KIOSK_ONLY_REQUESTS = ("login", "unlock-key-slot")
+MESSAGES_RECEIVED = metrics.counter(
+    "key_guard_ws_messages_received_total",
+    "Websocket requests received.",
+    label="type",
+)
+
+
+def _send(client: Client, message: dict):
+    client.enqueue(json.dumps(message), message["type"])
+
+
+def _active_users_fields(active_users: list[UserData]) -> dict:
+    return {
+        "activeUsers": [u.name for u in active_users],
+        # For kiosks from before concurrent sessions, which show a single user
+        "currentUser": active_users[0].name if active_users else None,
+    }
+
+
+def _add_edit_op(transaction: DatabaseTransaction, i: int, op: Any):
+    """
+    Adds one op of an edit-database request, its records use database.json's
+    field names. Raises a ValueError for a malformed op.
+    """
+    match op:
+        case {
+            "op": "add-key" | "update-key" as kind,
+            "key": {"id": str(k_id), "rf_id": str(rf_id), "name": str(name)},
+        }:
+            key = KeyData(id=k_id, rf_id=rf_id, name=name)
+            if kind == "add-key":
+                transaction.add_key(key)
+            else:
+                transaction.update_key(key)
+        case {"op": "remove-key", "keyId": str(k_id)}:
+            transaction.remove_key(k_id)
+        case {
+            "op": "add-user" | "update-user" as kind,
+            "user": {
+                "id": str(u_id),
+                "rf_id": str(rf_id),
+                "name": str(name),
+                "username": str(username),
+                "authorized_for": list(authorized_for),
+            },
+        } if all(isinstance(v, str) for v in authorized_for):
+            user = UserData(
+                id=u_id,
+                rf_id=rf_id,
+                username=username,
+                password="",
+                name=name,
+                authorized_for=tuple(authorized_for),
+            )
+            if kind == "update-user":
+                transaction.update_user(user)
+                return
+            # Never without a password
+            password = op.get("password")
+            if not isinstance(password, str):
+                raise ValueError(f"Op {i}: add-user needs a password")
+            transaction.add_user(user)
+            transaction.set_password(u_id, password)
+        case {"op": "remove-user", "userId": str(u_id)}:
+            transaction.remove_user(u_id)
+        case {
+            "op": "grant" | "revoke" as kind,
+            "userId": str(u_id),
+            "keyId": str(k_id),
+        }:
+            if kind == "grant":
+                transaction.grant(u_id, k_id)
+            else:
+                transaction.revoke(u_id, k_id)
+        case {"op": "set-password", "userId": str(u_id), "password": str(password)}:
+            transaction.set_password(u_id, password)
+        case _:
+            # Not echoed back, it may hold a password
+            raise ValueError(f"Op {i} is malformed")
+
+
+def load_server_ssl_context(
+    pem_file: str | os.PathLike,
+    private_key_file: str | os.PathLike,
+    pem_file_password: str,
+) -> ssl.SSLContext:
+    ssl_context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    ssl_context.load_cert_chain(
+        pem_file, keyfile=private_key_file, password=pem_file_password
+    )
+    return ssl_context
+
 
 class WebsocketServer:
-    _main_conn: ServerConnection | None = None
-    _main_conn_addr: Any | None = None
-    _last_jwt: str | None = None
+    # The cabinet's own screen, a newer kiosk connection replaces it
+    _kiosk: ClientConnection | None = None
+    # Rebound as a whole on (dis)connects, so a broadcast iterates it without a lock
+    _clients: tuple[ClientConnection, ...] = ()
+    _clients_lock: threading.Lock
+    client_send_queue_size: int
+    slow_client_policy: SlowClientPolicy
     _secret: str
-    user_key_selection_timeout_s: float | int
-    users_db: UsersDB
+    users_db: UsersBackend
+    session_manager: SessionManager
     get_key_selection_options: Callable[[UserData], list[KeySelectionOption]]
-    get_current_user: Callable[[], UserData | None]
     on_key_selected: Callable[[UserData, int], bool]
     client_connected: Event["WebsocketServer", Any]
     client_disconnected: Event[
         "WebsocketServer",
         tuple[Any, Literal["from-server-side"] | Literal["from-client-side"]],
     ]
-    user_login: Event["WebsocketServer", UserData]
+    user_login: Event["WebsocketServer", Session]
     user_login_blocked: Event["WebsocketServer", tuple[str, str]]
     user_login_failed: Event["WebsocketServer", tuple[str, str]]
     key_selection_failed: Event[
         "WebsocketServer",
         tuple[Literal["timeout"] | Literal["invalid-jwt"], str | dict, int],
     ]
-    _last_key_selection_req_id: str | None = None
+    # Request ids of the unlock-key-slot requests waiting for their slot to relock
+    _pending_key_selection_req_ids: dict[int, str]
+    # Held from checking a slot's pending request to recording the new one
+    _key_selection_lock: threading.RLock
     _ssl_context: ssl.SSLContext
+    _event_bus: SequencedEventBus
+    # Admin requests are refused without one
+    _admin_token: str | None = None
+    profiler: SamplingProfiler | None
+    # Admin edits of the database, None when it can't be edited (e.g. a replica)
+    database_writer: DatabaseWriter | None
+    # Runs the edits one at a time, off the client threads and the event loop
+    # (setting a password hashes it)
+    _database_edits: ThreadPoolExecutor
 
     def __init__(
         self,
         *,
         secret_file: str | os.PathLike,
-        pem_file: str | os.PathLike,
-        private_key_file: str | os.PathLike,
-        pem_file_password: str,
-        user_key_selection_timeout_s: float | int,
+        ssl_context: ssl.SSLContext,
+        session_manager: SessionManager,
         get_key_selection_options: Callable[[UserData], list[KeySelectionOption]],
-        get_current_user: Callable[[], UserData | None],
         on_key_selected: Callable[[UserData, int], bool],
-        users_db: UsersDB | None = None,
+        users_db: UsersBackend | None = None,
+        admin_token_file: str | os.PathLike | None = None,
+        profiler: SamplingProfiler | None = None,
+        database_writer: DatabaseWriter | None = None,
+        client_send_queue_size: int = DEFAULT_CLIENT_SEND_QUEUE_SIZE,
+        slow_client_policy: SlowClientPolicy = "disconnect",
     ):
         self.users_db = users_db if users_db is not None else UsersDB()
-        self.user_key_selection_timeout_s = user_key_selection_timeout_s
+        self.session_manager = session_manager
         self.get_key_selection_options = get_key_selection_options
         self.on_key_selected = on_key_selected
-        self.get_current_user = get_current_user
+        self._pending_key_selection_req_ids = {}
+        self._key_selection_lock = threading.RLock()
+        self._event_bus = SequencedEventBus(EVENT_REPLAY_BUFFER_SIZE)
         self.user_login = Event(self)
         self.user_login_blocked = Event(self)
         self.user_login_failed = Event(self)
         self.key_selection_failed = Event(self)
         self.client_connected = Event(self)
         self.client_disconnected = Event(self)
-        self._ssl_context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
-        self._ssl_context.load_cert_chain(
-            pem_file, keyfile=private_key_file, password=pem_file_password
-        )
+        self._ssl_context = ssl_context
         with open(secret_file, "r") as r:
             self._secret = r.read()
+        if admin_token_file is not None:
+            with open(admin_token_file, "r") as r:
+                self._admin_token = r.read().strip() or None
+        self.profiler = profiler
+        self.database_writer = database_writer
+        self._database_edits = ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix="DatabaseEdits"
+        )
+        self._clients_lock = threading.Lock()
+        self.client_send_queue_size = client_send_queue_size
+        self.slow_client_policy = slow_client_policy
+
+    @staticmethod
+    def _role_of(path: str) -> ClientRole | None:
+        # Picked when connecting, e.g. wss://cabinet:2000/?role=monitor
+        roles = parse_qs(urlsplit(path).query).get("role", ["kiosk"])
+        return roles[0] if roles[0] in CLIENT_ROLES else None
+
+    def _add_client(self, client: Client):
+        with self._clients_lock:
+            replaced = self._kiosk if client.role == "kiosk" else None
+            if client.role == "kiosk":
+                self._kiosk = client
+            self._clients = (
+                *(c for c in self._clients if c is not replaced),
+                client,
+            )
+        if replaced is not None:
+            self.client_disconnected.trigger((replaced.addr, "from-server-side"))
+            replaced.disconnect()
+
+    def _remove_client(self, client: Client):
+        with self._clients_lock:
+            self._clients = tuple(c for c in self._clients if c is not client)
+            if self._kiosk is client:
+                self._kiosk = None
+
+    def _parse_request(self, client: Client, message: str | bytes) -> Any:
+        """Decodes and counts a request, None when it was refused (and answered)."""
+        event = json.loads(message)
+        request_type = isinstance(event, dict) and event.get("type")
+        MESSAGES_RECEIVED.inc(
+            label_value=request_type if request_type in REQUEST_TYPES else "unknown"
+        )
+        if client.role != "kiosk" and request_type in KIOSK_ONLY_REQUESTS:
+            _send(
+                client,
+                {"id": event.get("id"), "type": request_type, "status": "forbidden"},
+            )
+            return None
+        return event
 
     def _echo(self, websocket: ServerConnection):
-        if self._main_conn is not None and self._main_conn is not websocket:
-            self.client_disconnected.trigger((self._main_conn_addr, "from-server-side"))
-            self._main_conn.close()
-        self.client_connected.trigger(websocket.socket.getsockname())
-        addr = websocket.socket.getsockname()
-        self._main_conn = websocket
-        self._main_conn_addr = addr
+        role = self._role_of(websocket.request.path)
+        if role is None:
+            # 1008: policy violation
+            websocket.close(1008, "unknown role")
+            return
+        client = ClientConnection(
+            websocket=websocket,
+            role=role,
+            max_queue=self.client_send_queue_size,
+            slow_client_policy=self.slow_client_policy,
+        )
+        addr = client.addr
+        self.client_connected.trigger(addr)
+        client.start()
+        self._add_client(client)
         try:
             for message in websocket:
-                event = json.loads(message)
+                event = self._parse_request(client, message)
                 match event:
-                    case {"type": "echo"}:
-                        websocket.send(message)
                     case {
                         "type": "login",
                         "username": str(username),
                         "password": str(password),
                         "id": str(id),
                     }:
-                        curr_user = self.get_current_user()
-                        if curr_user is not None:
-                            self.user_login_blocked.trigger((username, password))
-                            websocket.send(
-                                json.dumps(
-                                    {
-                                        "id": id,
-                                        "type": "login",
-                                        "status": "blocked",
-                                        "currentUser": curr_user.name,
-                                    }
-                                )
-                            )
-                        else:
+                        if self._is_cabinet_full():
+                            self._send_login_blocked(client, id, username, password)
+                            continue
+                        try:
                             user = self.users_db.by_username_check_password(
                                 username, password
                             )
-                            if user is not None:
-                                self.user_login.trigger(user)
-                                self._send_login_message(websocket, id, user)
-                            else:
-                                self.user_login_failed.trigger((username, password))
-                                websocket.send(
-                                    json.dumps(
-                                        {"id": id, "type": "login", "status": "failed"}
-                                    )
-                                )
+                        except PasswordVerifierBusy:
+                            _send(client, {"id": id, "type": "login", "status": "busy"})
+                            continue
+                        self._finish_login(client, id, username, password, user)
+                    case None:
+                        pass
+                    case _:
+                        self._handle_request(client, event, message)
+        except ConnectionClosedError:
+            pass
+        finally:
+            self._remove_client(client)
+            client.close()
+        self.client_disconnected.trigger(
+            (addr, "from-server-side" if client.overflowed else "from-client-side")
+        )
+
+    async def _echo_async(self, websocket: AsyncServerConnection):
+        # The asyncio mode's _echo, requests are handled on the event loop
+        role = self._role_of(websocket.request.path)
+        if role is None:
+            await websocket.close(1008, "unknown role")
+            return
+        client = AsyncClientConnection(
+            websocket=websocket,
+            role=role,
+            max_queue=self.client_send_queue_size,
+            slow_client_policy=self.slow_client_policy,
+        )
+        addr = client.addr
+        self.client_connected.trigger(addr)
+        client.start()
+        self._add_client(client)
+        try:
+            async for message in websocket:
+                event = self._parse_request(client, message)
+                match event:
                     case {
-                        "type": "unlock-key-slot",
-                        "jwt": str(enc_jwt),
-                        "slotId": int(slot_id),
+                        "type": "login",
+                        "username": str(username),
+                        "password": str(password),
                         "id": str(id),
                     }:
-                        self._handle_unlock_key_slot(websocket, id, enc_jwt, slot_id)
+                        if self._is_cabinet_full():
+                            self._send_login_blocked(client, id, username, password)
+                            continue
+                        try:
+                            # Only the password check leaves the loop
+                            user = await asyncio.get_running_loop().run_in_executor(
+                                None,
+                                self.users_db.by_username_check_password,
+                                username,
+                                password,
+                            )
+                        except PasswordVerifierBusy:
+                            _send(client, {"id": id, "type": "login", "status": "busy"})
+                            continue
+                        self._finish_login(client, id, username, password, user)
+                    case None:
+                        pass
+                    case _:
+                        self._handle_request(client, event, message)
         except ConnectionClosedError:
-            self.client_disconnected.trigger((addr, "from-client-side"))
+            pass
+        finally:
+            self._remove_client(client)
+            client.close()
+        self.client_disconnected.trigger(
+            (addr, "from-server-side" if client.overflowed else "from-client-side")
+        )
+
+    def _finish_login(
+        self,
+        client: Client,
+        id: str,
+        username: str,
+        password: str,
+        user: UserData | None,
+    ):
+        # After the password check
+        session = (
+            self.session_manager.start_session(user, "login")
+            if user is not None
+            else None
+        )
+        if session is not None:
+            self.user_login.trigger(session)
+            self._send_login_message(client, id, session)
+        elif user is not None:
+            self._send_login_blocked(client, id, username, password)
         else:
-            self.client_disconnected.trigger((addr, "from-client-side"))
+            self.user_login_failed.trigger((username, password))
+            _send(client, {"id": id, "type": "login", "status": "failed"})
 
-    def _send_login_message(
-        self, websocket: ServerConnection, req_id: str | None, user: UserData
+    def _handle_request(self, client: Client, event: Any, message: str | bytes):
+        # Every request but login, which the _echo variants check the password of
+        match event:
+            case {"type": "echo"}:
+                client.enqueue(message, "echo")
+            case {
+                "type": "unlock-key-slot",
+                "jwt": str(enc_jwt),
+                "slotId": int(slot_id),
+                "id": str(id),
+            }:
+                self._handle_unlock_key_slot(client, id, enc_jwt, slot_id)
+            case {"type": "resume", "lastSeq": int(last_seq), "id": str(id)}:
+                self._handle_resume(client, id, event.get("epoch"), last_seq)
+            case {
+                "type": "search-users",
+                "query": str(query),
+                "id": str(id),
+            }:
+                self._handle_search_users(
+                    client,
+                    id,
+                    event.get("jwt"),
+                    event.get("adminToken"),
+                    query,
+                    event.get("limit", MAX_USER_SEARCH_RESULTS),
+                    event.get("fuzzy", False) is True,
+                )
+            case {"type": "metrics", "id": str(id)}:
+                admin_token = event.get("adminToken")
+                if not (isinstance(admin_token, str) and self._is_admin(admin_token)):
+                    _send(
+                        client, {"id": id, "type": "metrics", "status": "unauthorized"}
+                    )
+                    return
+                _send(
+                    client,
+                    {
+                        "id": id,
+                        "type": "metrics",
+                        "metrics": metrics.snapshot(),
+                    },
+                )
+            case {
+                "type": "profiler",
+                "action": "start" | "stop" | "dump" | "reset" as action,
+                "adminToken": str(admin_token),
+                "id": str(id),
+            }:
+                self._handle_profiler(
+                    client,
+                    id,
+                    admin_token,
+                    action,
+                    event.get("rateHz", DEFAULT_PROFILER_RATE_HZ),
+                )
+            case {
+                "type": "edit-database",
+                "ops": list(ops),
+                "adminToken": str(admin_token),
+                "id": str(id),
+            }:
+                self._handle_edit_database(client, id, admin_token, ops)
+
+    def _is_cabinet_full(self) -> bool:
+        return (
+            len(self.session_manager.state.sessions)
+            >= self.session_manager.max_sessions
+        )
+
+    def _send_login_blocked(
+        self, client: Client, id: str, username: str, password: str
     ):
+        self.user_login_blocked.trigger((username, password))
+        _send(
+            client,
+            {
+                "id": id,
+                "type": "login",
+                "status": "blocked",
+                **_active_users_fields(
+                    [s.user for s in self.session_manager.state.sessions]
+                ),
+            },
+        )
+
+    def _send_login_message(self, client: Client, req_id: str | None, session: Session):
+        user = session.user
         encoded_jwt = jwt.encode(
             {
+                "sessionId": session.id,
+                "nonce": self.session_manager.issue_token_nonce(session),
                 "username": str(user.username),
-                "expiresAt": (
-                    datetime.datetime.now()
-                    + datetime.timedelta(seconds=self.user_key_selection_timeout_s)
-                ).isoformat(),
+                "expiresAt": session.expires_at.isoformat(),
             },
             self._secret,
             algorithm="HS256",
         )
-        self._last_jwt = encoded_jwt
         v = {} if req_id is not None else {"id": req_id}
-        websocket.send(
-            json.dumps(
+        _send(
+            client,
+            {
+                "type": "login",
+                **v,
+                "status": "success",
+                "jwt": encoded_jwt,
+                "name": user.name,
+                "keyData": [
+                    v.get_json_dict() for v in self.get_key_selection_options(user)
+                ],
+            },
+        )
+
+    def _handle_resume(
+        self,
+        client: Client,
+        id: str,
+        epoch: str | None,
+        last_seq: int,
+    ):
+        with self._event_bus.lock:
+            complete, missed = self._event_bus.since(epoch, last_seq)
+            # "gap" tells the client that older alerts were lost and it should resync
+            _send(
+                client,
                 {
-                    "type": "login",
-                    **v,
-                    "status": "success",
-                    "jwt": encoded_jwt,
-                    "name": user.name,
-                    "keyData": [
-                        v.get_json_dict() for v in self.get_key_selection_options(user)
-                    ],
-                }
+                    "id": id,
+                    "type": "resume",
+                    "status": "ok" if complete else "gap",
+                    "epoch": self._event_bus.epoch,
+                    "seq": self._event_bus.seq,
+                    "replayed": len(missed),
+                },
             )
+            for encoded in missed:
+                # Counted apart from live alerts
+                client.enqueue(encoded, "replay")
+
+    def _publish(self, event: dict):
+        # Sequenced and buffered even with no client connected, for its replay.
+        # Encoded once for every client, queueing never blocks on a slow one.
+        with self._event_bus.lock:
+            encoded = self._event_bus.publish(event)
+            for client in self._clients:
+                client.enqueue(encoded, event["type"])
+
+    def _handle_search_users(
+        self,
+        client: Client,
+        id: str,
+        enc_jwt: Any,
+        admin_token: Any,
+        query: str,
+        limit: Any,
+        fuzzy: bool,
+    ):
+        # The directory is only for a logged in user or an admin
+        if not (
+            isinstance(enc_jwt, str) and self._session_from_jwt(enc_jwt) is not None
+        ) and not (isinstance(admin_token, str) and self._is_admin(admin_token)):
+            _send(client, {"id": id, "type": "search-users", "status": "unauthorized"})
+            return
+        if not isinstance(limit, int) or limit < 1:
+            limit = MAX_USER_SEARCH_RESULTS
+        users = self.users_db.search(
+            query, min(limit, MAX_USER_SEARCH_RESULTS), fuzzy=fuzzy
+        )
+        _send(
+            client,
+            {
+                "id": id,
+                "type": "search-users",
+                "results": [{"username": u.username, "name": u.name} for u in users],
+            },
         )
 
-    def _handle_unlock_key_slot(
-        self, websocket: ServerConnection, id: str, enc_jwt: str, slot_id: int
+    def _session_from_jwt(self, enc_jwt: str) -> Session | None:
+        """
+        The live session a token was issued for. The token's nonce is left
+        unconsumed, it is only spent by unlocking a slot.
+        """
+        try:
+            decoded_jwt = jwt.decode(enc_jwt, self._secret, algorithms=["HS256"])
+        except jwt.InvalidTokenError:
+            return None
+        match decoded_jwt:
+            case {"sessionId": str(session_id), "expiresAt": str(expires_at)}:
+                try:
+                    expired = (
+                        datetime.datetime.now()
+                        >= datetime.datetime.fromisoformat(expires_at)
+                    )
+                except ValueError:
+                    return None
+                return None if expired else self.session_manager.get(session_id)
+        return None
+
+    def _is_admin(self, admin_token: str) -> bool:
+        return self._admin_token is not None and hmac.compare_digest(
+            admin_token.encode(), self._admin_token.encode()
+        )
+
+    def _handle_edit_database(
+        self, client: Client, id: str, admin_token: str, ops: list
     ):
-        if self._last_jwt != enc_jwt:
-            WebsocketServer._send_unlock_key_failed(
-                websocket, id, "Authentication Token is outdated"
-            )
+        if not self._is_admin(admin_token):
+            _send(client, {"id": id, "type": "edit-database", "status": "unauthorized"})
             return
-        if self._last_key_selection_req_id is not None:
-            WebsocketServer._send_unlock_key_failed(
-                websocket, id, "Another key unlocking is already in progress"
+        if self.database_writer is None:
+            _send(client, {"id": id, "type": "edit-database", "status": "unavailable"})
+            return
+        self._database_edits.submit(self._edit_database, client, id, ops)
+
+    def _edit_database(self, client: Client, id: str, ops: list):
+        # On the edits thread, all ops are committed in one transaction or none are
+        try:
+            with self.database_writer.transaction() as transaction:
+                for i, op in enumerate(ops):
+                    _add_edit_op(transaction, i, op)
+        except ValueError as ex:
+            _send(
+                client,
+                {
+                    "id": id,
+                    "type": "edit-database",
+                    "status": "invalid",
+                    "error": str(ex),
+                },
             )
             return
+        _send(client, {"id": id, "type": "edit-database", "status": "ok"})
+
+    def _handle_profiler(
+        self,
+        client: Client,
+        id: str,
+        admin_token: str,
+        action: str,
+        rate_hz: Any,
+    ):
+        if not self._is_admin(admin_token):
+            _send(client, {"id": id, "type": "profiler", "status": "unauthorized"})
+            return
+        profiler = self.profiler
+        if profiler is None:
+            _send(client, {"id": id, "type": "profiler", "status": "unavailable"})
+            return
+        collapsed = None
+        match action:
+            case "start":
+                if not isinstance(rate_hz, (int, float)) or rate_hz <= 0:
+                    rate_hz = DEFAULT_PROFILER_RATE_HZ
+                profiler.start(min(rate_hz, MAX_PROFILER_RATE_HZ))
+            case "stop":
+                profiler.stop()
+                collapsed = profiler.collapsed()
+            case "dump":
+                collapsed = profiler.collapsed()
+            case "reset":
+                profiler.reset()
+        _send(
+            client,
+            {
+                "id": id,
+                "type": "profiler",
+                "status": "ok",
+                "running": profiler.running,
+                "rateHz": profiler.rate_hz,
+                "samples": profiler.samples,
+                # Collapsed stacks, one "outer;...;inner count" per line
+                **({} if collapsed is None else {"collapsed": collapsed}),
+            },
+        )
+
+    def _handle_unlock_key_slot(
+        self, client: Client, id: str, enc_jwt: str, slot_id: int
+    ):
         try:
             decoded_jwt = jwt.decode(enc_jwt, self._secret, algorithms=["HS256"])
             match decoded_jwt:
                 case {
+                    "sessionId": str(session_id),
+                    "nonce": str(nonce),
                     "username": str(username),
                     "expiresAt": str(expiresAt),
                 }:
                     maxT = datetime.datetime.fromisoformat(expiresAt)
                     if datetime.datetime.now() < maxT:
-                        user = self.users_db.by_username(username)
-                        if self.on_key_selected(user, slot_id):
-                            self._last_key_selection_req_id = id
-                            return
-                        else:
+                        session = self.session_manager.get(session_id)
+                        # Single use, a replayed or superseded token is refused
+                        if (
+                            session is None
+                            or not self.session_manager.consume_token_nonce(
+                                session_id, nonce
+                            )
+                        ):
                             WebsocketServer._send_unlock_key_failed(
-                                websocket, id, "Access Denied"
+                                client, id, "Authentication Token is outdated"
                             )
                             return
+                        # One decision per slot at a time, across client threads
+                        with self._key_selection_lock:
+                            if (
+                                slot_id in self._pending_key_selection_req_ids
+                                or not self.session_manager.claim_slot(session, slot_id)
+                            ):
+                                WebsocketServer._send_unlock_key_failed(
+                                    client, id, "Key slot is in use by another user"
+                                )
+                                return
+                            if self.on_key_selected(session.user, slot_id):
+                                self._pending_key_selection_req_ids[slot_id] = id
+                                return
+                            self.session_manager.release_slot(
+                                slot_id, end_idle_session=False
+                            )
+                        WebsocketServer._send_unlock_key_failed(
+                            client, id, "Access Denied"
+                        )
+                        return
                     else:
                         self.key_selection_failed.trigger(
                             ["timeout", decoded_jwt, slot_id]
                         )
-                        WebsocketServer._send_unlock_key_failed(
-                            websocket, id, "Timed out"
-                        )
+                        WebsocketServer._send_unlock_key_failed(client, id, "Timed out")
                         return
                 case _:
                     self.key_selection_failed.trigger(
                         ["invalid-jwt", decoded_jwt, slot_id]
                     )
                     WebsocketServer._send_unlock_key_failed(
-                        websocket, id, "Invalid JWT Format"
+                        client, id, "Invalid JWT Format"
                     )
                     return
-            WebsocketServer._send_unlock_key_failed(websocket, id)
+            WebsocketServer._send_unlock_key_failed(client, id)
         except jwt.InvalidSignatureError:
             self.key_selection_failed.trigger(["invalid-jwt", enc_jwt, slot_id])
             WebsocketServer._send_unlock_key_failed(
-                websocket, id, "Invalid signature for JWT token"
+                client, id, "Invalid signature for JWT token"
             )
             return
-        finally:
-            self._last_jwt = None
 
     @staticmethod
-    def _send_unlock_key_failed(
-        websocket: ServerConnection, id: str, reason: str | None
-    ):
-        websocket.send(
-            json.dumps(
-                {
-                    "id": id,
-                    "type": "unlock-key-slot",
-                    "status": "failed",
-                    "reason": reason,
-                }
-            )
+    def _send_unlock_key_failed(client: Client, id: str, reason: str | None):
+        _send(
+            client,
+            {
+                "id": id,
+                "type": "unlock-key-slot",
+                "status": "failed",
+                "reason": reason,
+            },
         )
 
     def serve_and_block(self):
         with serve(self._echo, "", 2000, ssl=self._ssl_context) as server:
             server.serve_forever()
 
-    def on_user_found(self, user: UserData):
-        if self._main_conn is not None:
-            self._send_login_message(self._main_conn, None, user)
+    async def serve_async(self):
+        async with async_serve(
+            self._echo_async, "", 2000, ssl=self._ssl_context
+        ) as server:
+            await server.serve_forever()
 
-    def on_key_slot_locked(self, mode: Literal["no-change"] | Literal["success"]):
-        if self._main_conn is not None and self._last_key_selection_req_id is not None:
-            self._main_conn.send(
-                json.dumps(
-                    {
-                        "type": "unlock-key-slot",
-                        "id": self._last_key_selection_req_id,
-                        "status": mode,
-                    }
-                )
+    def on_user_found(self, session: Session):
+        # Only the cabinet's screen logs in, monitors never see a session's JWT
+        kiosk = self._kiosk
+        if kiosk is not None:
+            self._send_login_message(kiosk, None, session)
+
+    def on_key_slot_locked(
+        self, slot_id: int, mode: Literal["no-change"] | Literal["success"]
+    ):
+        with self._key_selection_lock:
+            req_id = self._pending_key_selection_req_ids.pop(slot_id, None)
+        kiosk = self._kiosk
+        if kiosk is not None and req_id is not None:
+            _send(
+                kiosk,
+                {
+                    "type": "unlock-key-slot",
+                    "id": req_id,
+                    "status": mode,
+                },
             )
-            self._last_key_selection_req_id = None
 
     def on_key_stolen(self, slotName: str, key: KeyData, replacement: str | None):
-        if self._main_conn is not None:
-            self._main_conn.send(
-                json.dumps(
-                    {
-                        "type": "key-stolen",
-                        "slotName": slotName,
-                        "keyName": key.name,
-                        **(
-                            {}
-                            if replacement is None
-                            else {"deceptiveReplacement": replacement}
-                        ),
-                    }
-                )
-            )
+        self._publish(
+            {
+                "type": "key-stolen",
+                "slotName": slotName,
+                "keyName": key.name,
+                **(
+                    {} if replacement is None else {"deceptiveReplacement": replacement}
+                ),
+            }
+        )
 
     def on_unauthorized_key_place_attempted(self, slotName: str, key: KeyData | str):
-        if self._main_conn is not None:
-            self._main_conn.send(
-                json.dumps(
-                    {
-                        "type": "unauth-key-place-attempt",
-                        "slotName": slotName,
-                        "keyName": key if isinstance(key, str) else key.name,
-                    }
-                )
-            )
+        self._publish(
+            {
+                "type": "unauth-key-place-attempt",
+                "slotName": slotName,
+                "keyName": key if isinstance(key, str) else key.name,
+            }
+        )
 
     def on_unknown_key_placed(self, slotName: str, keyId: str):
-        if self._main_conn is not None:
-            self._main_conn.send(
-                json.dumps(
-                    {
-                        "type": "unknown-key-placed",
-                        "slotName": slotName,
-                        "keyId": keyId,
-                    }
-                )
-            )
+        self._publish(
+            {
+                "type": "unknown-key-placed",
+                "slotName": slotName,
+                "keyId": keyId,
+            }
+        )
+
+    def on_event_summary(
+        self, eventName: str, source: str, cardId: str, count: int, windowS: float
+    ):
+        self._publish(
+            {
+                "type": "event-summary",
+                "event": eventName,
+                "source": source,
+                "cardId": cardId,
+                "count": count,
+                "windowS": windowS,
+            }
+        )
 
     def on_unknown_user_found(self, cardId: str):
-        if self._main_conn is not None:
-            self._main_conn.send(
-                json.dumps(
-                    {
-                        "type": "unrecognized-user-card",
-                        "cardId": cardId,
-                    }
-                )
-            )
+        self._publish(
+            {
+                "type": "unrecognized-user-card",
+                "cardId": cardId,
+            }
+        )
 
     def on_user_card_found_but_blocked(
-        self, blockedUser: UserData, currentUser: UserData
+        self, blockedUser: UserData, activeUsers: list[UserData]
     ):
-        if self._main_conn is not None:
-            self._main_conn.send(
-                json.dumps(
-                    {
-                        "type": "user-card-blocked",
-                        "blockedUser": blockedUser.name,
-                        "currentUser": currentUser.name,
-                    }
-                )
-            )
+        self._publish(
+            {
+                "type": "user-card-blocked",
+                "blockedUser": blockedUser.name,
+                **_active_users_fields(activeUsers),
+            }
+        )